@@ -0,0 +1,130 @@
+"""
+Usage:
+python benchmark_sampling.py -c [checkpoint] -o [output] -s ddim -s dpmsolver++ -k 100,20,10,5 -n 50
+
+Sweeps sampler / number of inference steps, reports predict_action latency
+and rollout success (test/mean_score) from the checkpoint's env_runner.
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode='w', buffering=1)
+
+import os
+import time
+import pathlib
+import click
+import hydra
+import torch
+import dill
+import numpy as np
+from omegaconf import open_dict
+import json
+from torch.utils.data import DataLoader
+from diffusion_policy.workspace.base_workspace import BaseWorkspace
+from diffusion_policy.common.pytorch_util import dict_apply
+
+
+def measure_latency(policy, obs_dict, n_warmup=3, n_trials=20):
+    with torch.no_grad():
+        for _ in range(n_warmup):
+            policy.predict_action(obs_dict)
+        if policy.device.type == 'cuda':
+            torch.cuda.synchronize(policy.device)
+        times = list()
+        for _ in range(n_trials):
+            start = time.perf_counter()
+            policy.predict_action(obs_dict)
+            if policy.device.type == 'cuda':
+                torch.cuda.synchronize(policy.device)
+            times.append(time.perf_counter() - start)
+    return float(np.mean(times)), float(np.std(times))
+
+
+@click.command()
+@click.option('-c', '--checkpoint', required=True)
+@click.option('-o', '--output_dir', required=True)
+@click.option('-d', '--device', default='cuda:0')
+@click.option('-s', '--sampler', multiple=True, default=['ddim', 'dpmsolver++'],
+    type=click.Choice(['ddpm', 'ddim', 'dpmsolver++']))
+@click.option('-k', '--inference_steps', default='100,50,20,10,5')
+@click.option('-n', '--n_test', default=50, help='rollouts per setting, 0 to only measure latency')
+@click.option('-b', '--batch_size', default=None, type=int, help='predict_action batch size, defaults to env_runner.n_envs')
+@click.option('--n_trials', default=20)
+def main(checkpoint, output_dir, device, sampler, inference_steps, n_test, batch_size, n_trials):
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    # load checkpoint
+    payload = torch.load(open(checkpoint, 'rb'), pickle_module=dill)
+    cfg = payload['cfg']
+
+    cls = hydra.utils.get_class(cfg._target_)
+    workspace = cls(cfg, output_dir=output_dir)
+    workspace: BaseWorkspace
+    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
+
+    policy = workspace.model
+    if cfg.training.use_ema:
+        policy = workspace.ema_model
+    device = torch.device(device)
+    policy.to(device)
+    policy.eval()
+
+    # observation batch for latency
+    if batch_size is None:
+        batch_size = cfg.task.env_runner.get('n_envs', None) or 1
+    dataset = hydra.utils.instantiate(cfg.task.dataset)
+    batch = next(iter(DataLoader(dataset, batch_size=batch_size, shuffle=True)))
+    def to_policy_input(x):
+        x = x.to(device)
+        if x.dtype == torch.uint8:
+            # dataset with gpu_image_aug returns raw images
+            x = x.to(torch.float32) / 255.
+        return x
+    obs_dict = dict_apply(batch['obs'], to_policy_input)
+
+    env_runner = None
+    if n_test > 0:
+        with open_dict(cfg):
+            cfg.task.env_runner.n_test = n_test
+            cfg.task.env_runner.n_train = 0
+            cfg.task.env_runner.n_train_vis = 0
+            cfg.task.env_runner.n_test_vis = 0
+        env_runner = hydra.utils.instantiate(
+            cfg.task.env_runner,
+            output_dir=output_dir)
+
+    steps = [int(x) for x in inference_steps.split(',')]
+    results = list()
+    for scheduler_type in sampler:
+        for n_steps in steps:
+            policy.set_inference_scheduler(
+                scheduler_type=scheduler_type, 
+                num_inference_steps=n_steps)
+            latency_mean, latency_std = measure_latency(
+                policy, obs_dict, n_trials=n_trials)
+            result = {
+                'sampler': scheduler_type,
+                'inference_steps': n_steps,
+                'batch_size': batch_size,
+                'latency_mean': latency_mean,
+                'latency_std': latency_std
+            }
+            if env_runner is not None:
+                runner_log = env_runner.run(policy)
+                result['test/mean_score'] = float(runner_log['test/mean_score'])
+            print(result)
+            results.append(result)
+
+    print(f"{'sampler':<12} {'steps':>6} {'latency (ms)':>14} {'success':>8}")
+    for r in results:
+        print(f"{r['sampler']:<12} {r['inference_steps']:>6} "
+            f"{r['latency_mean']*1000:>8.1f} ±{r['latency_std']*1000:>4.1f} "
+            f"{r.get('test/mean_score', float('nan')):>8.3f}")
+
+    out_path = os.path.join(output_dir, 'sampling_benchmark.json')
+    json.dump(results, open(out_path, 'w'), indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Usage:
+python benchmark_training.py -o [output] -O task=square_image_abs -O task.dataset.use_cache=True -m fp32 -m bf16 -m fp16 -m bf16:fused
+
+Measures training throughput (steps/sec) of the hybrid transformer
+workspace for precision/optimizer modes against the fp32 baseline.
+Mode is <precision>[:fused|:foreach], precision one of fp32, bf16, fp16.
+"""
+
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode='w', buffering=1)
+
+import os
+import time
+import json
+import pathlib
+import contextlib
+import click
+import hydra
+import torch
+from omegaconf import OmegaConf, open_dict
+from diffusion_policy.common.pytorch_util import dict_apply, create_dataloader
+from diffusion_policy.workspace.train_diffusion_transformer_hybrid_workspace import TrainDiffusionTransformerHybridWorkspace
+
+OmegaConf.register_new_resolver("eval", eval, replace=True)
+
+
+def measure_throughput(workspace, batches, device, precision, n_warmup=10):
+    model = workspace.model
+    optimizer = workspace.optimizer
+    scaler = torch.cuda.amp.GradScaler(enabled=(precision == 'fp16'))
+    autocast = contextlib.nullcontext
+    if precision != 'fp32':
+        dtype = torch.bfloat16 if precision == 'bf16' else torch.float16
+        autocast = lambda: torch.autocast(device_type=device.type, dtype=dtype)
+
+    model.train()
+    loss_sum = torch.zeros((), device=device)
+    for i, batch in enumerate(batches):
+        if i == n_warmup:
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+        with autocast():
+            loss = model.compute_loss(batch)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+        loss_sum += loss.detach().float()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    n_steps = len(batches) - n_warmup
+    return n_steps / (time.perf_counter() - start), loss_sum.item() / len(batches)
+
+
+@click.command()
+@click.option('-o', '--output_dir', required=True)
+@click.option('-cn', '--config_name', default='train_diffusion_transformer_hybrid_workspace')
+@click.option('-O', '--override', multiple=True, help='hydra overrides')
+@click.option('-m', '--mode', multiple=True, default=['fp32', 'bf16', 'fp16', 'bf16:fused'])
+@click.option('-n', '--n_steps', default=100, help='timed steps per mode')
+@click.option('-b', '--n_batches', default=20, help='distinct batches kept on device')
+def main(output_dir, config_name, override, mode, n_steps, n_batches):
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with hydra.initialize(version_base=None, config_path='diffusion_policy/config'):
+        cfg = hydra.compose(config_name=config_name, overrides=list(override))
+    device = torch.device(cfg.training.device)
+
+    # batches are loaded once so the dataloader doesn't bound throughput
+    dataset = hydra.utils.instantiate(cfg.task.dataset)
+    dataloader = create_dataloader(dataset, **cfg.dataloader)
+    batches = list()
+    for batch in dataloader:
+        batch = dict_apply(batch, lambda x: x.to(device))
+        for key in getattr(dataset, 'rgb_keys', []):
+            if (key in batch['obs']) and (batch['obs'][key].dtype == torch.uint8):
+                batch['obs'][key] = batch['obs'][key].to(torch.float32) / 255.
+        batches.append(batch)
+        if len(batches) >= n_batches:
+            break
+    normalizer = dataset.get_normalizer()
+    n_warmup = 10
+    batches = [batches[i % len(batches)] for i in range(n_steps + n_warmup)]
+
+    results = list()
+    for this_mode in mode:
+        precision, _, optim = this_mode.partition(':')
+        assert precision in ('fp32', 'bf16', 'fp16')
+        assert optim in ('', 'fused', 'foreach')
+        with open_dict(cfg):
+            cfg.training.use_ema = False
+            cfg.optimizer.fused = (optim == 'fused')
+            cfg.optimizer.foreach = True if (optim == 'foreach') else None
+        # same initial weights for every mode
+        torch.manual_seed(cfg.training.seed)
+        workspace = TrainDiffusionTransformerHybridWorkspace(cfg, output_dir=output_dir)
+        workspace.model.set_normalizer(normalizer)
+        workspace.model.to(device)
+
+        steps_per_sec, mean_loss = measure_throughput(
+            workspace, batches, device, precision, n_warmup=n_warmup)
+        result = {
+            'mode': this_mode,
+            'steps_per_sec': steps_per_sec,
+            'mean_loss': mean_loss,
+            'batch_size': cfg.dataloader.batch_size
+        }
+        print(result)
+        results.append(result)
+        del workspace
+        if device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    baseline = next((r['steps_per_sec'] for r in results if r['mode'] == 'fp32'), None)
+    print(f"{'mode':<14} {'steps/s':>8} {'speedup':>8}")
+    for r in results:
+        speedup = r['steps_per_sec'] / baseline if baseline else float('nan')
+        r['speedup'] = speedup
+        print(f"{r['mode']:<14} {r['steps_per_sec']:>8.2f} {speedup:>8.2f}")
+
+    out_path = os.path.join(output_dir, 'training_benchmark.json')
+    json.dump(results, open(out_path, 'w'), indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 from typing import Optional, Dict
 import os
+import glob
 
 class TopKCheckpointManager:
     def __init__(self,
@@ -54,6 +55,7 @@ class TopKCheckpointManager:
             if not os.path.exists(self.save_dir):
                 os.mkdir(self.save_dir)
 
-            if os.path.exists(delete_path):
-                os.remove(delete_path)
+            for path in [delete_path] + glob.glob(glob.escape(delete_path) + '.*.safetensors'):
+                if os.path.exists(path):
+                    os.remove(path)
             return ckpt_path
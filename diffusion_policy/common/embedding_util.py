@@ -0,0 +1,69 @@
+from typing import List, Optional
+import concurrent.futures
+import numpy as np
+import torch
+from tqdm import tqdm
+from diffusion_policy.common.replay_buffer import ReplayBuffer, get_optimal_chunks
+
+
+def _read_steps(replay_buffer, keys, start, end):
+    return dict((key, replay_buffer[key][start:end]) for key in keys)
+
+
+def compute_replay_embeddings(
+        replay_buffer: ReplayBuffer,
+        policy,
+        rgb_keys: List[str],
+        lowdim_keys: List[str],
+        embedding_key: str='embedding',
+        batch_size: int=1024,
+        n_prefetch: int=4,
+        device: Optional[torch.device]=None):
+    """
+    Run policy.obs_encoder over every step of a zarr ReplayBuffer and store
+    the features as replay_buffer[embedding_key] (n_steps, Do) float32.
+    Steps are read in contiguous slices of batch_size by a thread pool
+    (decoding overlaps with the GPU pass), images are expected as
+    uint8 T,H,W,C like in the robomimic replay buffers.
+    """
+    assert replay_buffer.backend == 'zarr'
+    if device is None:
+        device = policy.device
+    keys = list(rgb_keys) + list(lowdim_keys)
+    n_steps = replay_buffer.n_steps
+    starts = list(range(0, n_steps, batch_size))
+
+    emb_arr = None
+    policy.eval()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_prefetch) as executor, \
+            torch.no_grad():
+        futures = dict()
+        for i, start in enumerate(tqdm(starts, desc="Computing embeddings")):
+            # keep n_prefetch batches in flight
+            for j in range(i, min(i + n_prefetch, len(starts))):
+                if j not in futures:
+                    futures[j] = executor.submit(_read_steps, replay_buffer, keys,
+                        starts[j], min(starts[j] + batch_size, n_steps))
+            np_obs = futures.pop(i).result()
+
+            obs = dict()
+            for key in rgb_keys:
+                x = torch.from_numpy(np_obs[key]).to(device, non_blocking=True)
+                obs[key] = x.permute(0,3,1,2).to(torch.float32) / 255.
+            for key in lowdim_keys:
+                obs[key] = torch.from_numpy(
+                    np_obs[key].astype(np.float32)).to(device, non_blocking=True)
+            nobs = policy.normalizer.normalize(obs)
+            emb = policy.obs_encoder(nobs).to('cpu').numpy().astype(np.float32)
+
+            if emb_arr is None:
+                shape = (n_steps,) + emb.shape[1:]
+                emb_arr = replay_buffer.data.zeros(
+                    name=embedding_key,
+                    shape=shape,
+                    chunks=get_optimal_chunks(shape=shape, dtype=np.float32),
+                    dtype=np.float32,
+                    compressor=None,
+                    overwrite=True)
+            emb_arr[start:start+len(emb)] = emb
+    return emb_arr
@@ -0,0 +1,99 @@
+from typing import Tuple
+import os
+import json
+import hashlib
+import numpy as np
+import torch.nn as nn
+
+
+def get_module_digest(module: nn.Module) -> str:
+    """
+    md5 of the parameters and buffers of module, identifies the weights
+    (e.g. the obs_encoder_dir checkpoint) features were computed with.
+    """
+    md5 = hashlib.md5()
+    for key, value in sorted(module.state_dict().items()):
+        md5.update(key.encode('utf-8'))
+        md5.update(value.detach().cpu().contiguous().numpy().tobytes())
+    return md5.hexdigest()
+
+
+class FrameFeatureCache:
+    """
+    On-disk memoization of per-frame obs encoder features, indexed by
+    replay buffer row (= episode, step). Only valid for a frozen encoder
+    in eval mode, i.e. a deterministic (center) crop; meta stores the
+    crop, the encoder weights digest and the dataset fingerprint, a cache
+    of another crop, encoder or dataset is discarded.
+    Features of a row are computed once and reused afterwards, so the
+    frames must not be color jittered while the cache is used (the
+    dataset and workspace skip the jitter, see return_frame_idx).
+    """
+    def __init__(self, cache_dir: str, n_frames: int, feature_dim: int,
+            crop_shape=None, dtype=np.float32, encoder_digest=None,
+            dataset_fingerprint=None):
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.meta = {
+            'n_frames': int(n_frames),
+            'feature_dim': int(feature_dim),
+            'crop_shape': None if crop_shape is None else list(crop_shape),
+            'dtype': np.dtype(dtype).str,
+            'encoder_digest': encoder_digest,
+            'dataset_fingerprint': dataset_fingerprint
+        }
+        self.features = None
+        self.valid = None
+
+    @property
+    def features_path(self):
+        return os.path.join(self.cache_dir, 'features.npy')
+
+    @property
+    def valid_path(self):
+        return os.path.join(self.cache_dir, 'valid.npy')
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, 'meta.json')
+
+    def _open(self):
+        if self.features is not None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        meta = None
+        if os.path.isfile(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        if (meta == self.meta) and os.path.isfile(self.features_path) \
+                and os.path.isfile(self.valid_path):
+            self.features = np.load(self.features_path, mmap_mode='r+')
+            self.valid = np.load(self.valid_path, mmap_mode='r+')
+            return
+
+        shape = (self.meta['n_frames'], self.meta['feature_dim'])
+        self.features = np.lib.format.open_memmap(self.features_path,
+            mode='w+', dtype=np.dtype(self.meta['dtype']), shape=shape)
+        self.valid = np.lib.format.open_memmap(self.valid_path,
+            mode='w+', dtype=bool, shape=(shape[0],))
+        with open(self.meta_path, 'w') as f:
+            json.dump(self.meta, f)
+
+    def lookup(self, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        rows: (N,) replay buffer rows
+        returns (N, feature_dim) features (garbage where not hit) and (N,) hit mask
+        """
+        self._open()
+        return self.features[rows], self.valid[rows]
+
+    def store(self, rows: np.ndarray, features: np.ndarray):
+        self._open()
+        self.features[rows] = features
+        self.valid[rows] = True
+
+    def __getstate__(self):
+        # memmaps are reopened lazily, don't pickle their content
+        state = self.__dict__.copy()
+        state['features'] = None
+        state['valid'] = None
+        return state
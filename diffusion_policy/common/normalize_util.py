@@ -221,3 +221,46 @@ def array_to_stats(arr: np.ndarray):
         'std': np.std(arr, axis=0)
     }
     return stat
+
+
+def array_to_stats_streaming(arr, chunk_length=None):
+    """
+    Same as array_to_stats in a single pass over chunks of axis 0, 
+    never loads the whole (zarr) array. Mean/std are accumulated in 
+    float64 (Welford/Chan merge) and cast to the array dtype.
+    """
+    if chunk_length is None:
+        chunk_length = arr.chunks[0] if hasattr(arr, 'chunks') else len(arr)
+    # large enough for few reads, small enough for low peak memory
+    row_nbytes = max(int(np.prod(arr.shape[1:])) * arr.dtype.itemsize, 1)
+    chunk_length = max(chunk_length, (1 << 24) // row_nbytes // chunk_length * chunk_length)
+
+    n = 0
+    arr_min = arr_max = mean = m2 = None
+    for start in range(0, arr.shape[0], chunk_length):
+        x = np.asarray(arr[start:start+chunk_length])
+        x_min = np.min(x, axis=0)
+        x_max = np.max(x, axis=0)
+        x = x.astype(np.float64)
+        n_b = x.shape[0]
+        mean_b = np.mean(x, axis=0)
+        m2_b = np.sum(np.square(x - mean_b), axis=0)
+        if n == 0:
+            arr_min, arr_max, mean, m2 = x_min, x_max, mean_b, m2_b
+        else:
+            arr_min = np.minimum(arr_min, x_min)
+            arr_max = np.maximum(arr_max, x_max)
+            delta = mean_b - mean
+            mean = mean + delta * (n_b / (n + n_b))
+            m2 = m2 + m2_b + np.square(delta) * (n * n_b / (n + n_b))
+        n += n_b
+    assert n > 0
+
+    dtype = arr.dtype if np.issubdtype(arr.dtype, np.floating) else np.float64
+    stat = {
+        'min': arr_min,
+        'max': arr_max,
+        'mean': mean.astype(dtype),
+        'std': np.sqrt(m2 / n).astype(dtype)
+    }
+    return stat
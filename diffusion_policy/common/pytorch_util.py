@@ -1,5 +1,8 @@
 from typing import Dict, Callable, List
 import collections
+import inspect
+import warnings
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -80,3 +83,126 @@ def optimizer_to(optimizer, device):
             if isinstance(v, torch.Tensor):
                 state[k] = v.to(device=device)
     return optimizer
+
+def create_adamw(params, fused=False, foreach=None, **kwargs):
+    """
+    AdamW with the fused (single kernel) or foreach (multi-tensor) 
+    implementation when the installed torch supports it.
+    fused requires all params on cuda at construction.
+    """
+    optim_params = inspect.signature(torch.optim.AdamW).parameters
+    if fused:
+        if 'fused' in optim_params:
+            kwargs['fused'] = True
+            foreach = None
+        else:
+            print('AdamW(fused=True) is not supported by this torch version, using foreach.')
+            foreach = True
+    if (foreach is not None) and ('foreach' in optim_params):
+        kwargs['foreach'] = foreach
+    return torch.optim.AdamW(params, **kwargs)
+
+def create_dataloader(dataset, batched_sampling=False, 
+        batch_size=1, shuffle=False, drop_last=False, **kwargs):
+    """
+    DataLoader from a cfg.dataloader dict. With batched_sampling the 
+    dataset receives whole lists of indices (dataset.get_batch) instead 
+    of being called and collated once per sample.
+    """
+    if batched_sampling and hasattr(dataset, 'get_batch'):
+        if shuffle:
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+        batch_sampler = torch.utils.data.BatchSampler(
+            sampler, batch_size=batch_size, drop_last=drop_last)
+        # batch_size=None disables auto-batching, each "sample" is a batch
+        return torch.utils.data.DataLoader(dataset, 
+            sampler=batch_sampler, batch_size=None, **kwargs)
+    return torch.utils.data.DataLoader(dataset, batch_size=batch_size, 
+        shuffle=shuffle, drop_last=drop_last, **kwargs)
+
+def numpy_to_device(x: np.ndarray, device, non_blocking=True) -> torch.Tensor:
+    """
+    Copy x to device without an intermediate host copy. x may be a
+    read-only view (e.g. double buffered AsyncVectorEnv observations),
+    the copy is asynchronous if x is in pinned memory. Other arrays
+    (strided views, fancy indexed copies) go through pageable memory,
+    see PinnedStagingBuffer for those.
+    """
+    with warnings.catch_warnings():
+        # from_numpy warns about read-only arrays, the tensor is only read
+        warnings.simplefilter('ignore', UserWarning)
+        tensor = torch.from_numpy(x)
+    return tensor.to(device=device, non_blocking=non_blocking)
+
+class PinnedStagingBuffer:
+    """
+    Reusable pinned host buffers, one per key, for obs that are not views
+    of pinned memory: strided subsample views, rows of a subset of envs.
+    numpy_to_device of those goes through a pageable temporary, here they
+    are gathered into the pinned buffer and copied to the device by DMA.
+    """
+    def __init__(self):
+        self.buffers = dict()
+        self.events = dict()
+
+    def _get_buffer(self, key, shape, dtype) -> torch.Tensor:
+        buf = self.buffers.get(key, None)
+        if (buf is None) or (tuple(buf.shape[1:]) != tuple(shape[1:])) \
+                or (buf.dtype != dtype) or (buf.shape[0] < shape[0]):
+            # rows are allocated once for the largest batch
+            n = shape[0] if buf is None else max(shape[0], buf.shape[0])
+            buf = torch.empty((n,) + tuple(shape[1:]), dtype=dtype, pin_memory=True)
+            self.buffers[key] = buf
+        event = self.events.get(key, None)
+        if event is not None:
+            # previous copy out of this buffer must be done
+            event.synchronize()
+        return buf[:shape[0]]
+
+    def to_device(self, np_dict: Dict[str, np.ndarray], device,
+            indices=None) -> Dict[str, torch.Tensor]:
+        """
+        np_dict: key -> B,* arrays, indices: optional rows to gather
+        """
+        device = torch.device(device)
+        if device.type != 'cuda':
+            if indices is not None:
+                np_dict = dict_apply(np_dict, lambda x: x[indices])
+            return dict_apply(np_dict, lambda x: numpy_to_device(x, device))
+
+        result = dict()
+        for key, x in np_dict.items():
+            shape = x.shape if indices is None else (len(indices),) + x.shape[1:]
+            dtype = torch.from_numpy(np.empty(0, dtype=x.dtype)).dtype
+            buf = self._get_buffer(key, shape, dtype)
+            if indices is None:
+                np.copyto(buf.numpy(), x)
+            else:
+                np.take(x, indices, axis=0, out=buf.numpy())
+            result[key] = buf.to(device=device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self.events[key] = event
+        return result
+
+def image_obs_to_chw(obs_dict: Dict[str, torch.Tensor], 
+        rgb_shapes: Dict[str, tuple]) -> Dict[str, torch.Tensor]:
+    """
+    Convert uint8 ...,H,W,C images (env wrappers with obs_dtype='uint8')
+    to float32 ...,C,H,W in [0,1] on device, like the float32 wrappers
+    return. rgb_shapes: key -> C,H,W from shape_meta, other keys are
+    left untouched.
+    """
+    result = dict(obs_dict)
+    for key, shape in rgb_shapes.items():
+        x = obs_dict.get(key, None)
+        if (not isinstance(x, torch.Tensor)) or (x.dtype != torch.uint8):
+            continue
+        c, h, w = shape
+        if (tuple(x.shape[-3:]) == (h, w, c)) and ((h, w, c) != (c, h, w)):
+            x = torch.movedim(x, -1, -3)
+        result[key] = x.to(dtype=torch.float32, 
+            memory_format=torch.contiguous_format).div_(255.)
+    return result
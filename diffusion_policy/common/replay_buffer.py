@@ -1,7 +1,10 @@
 from typing import Union, Dict, Optional
 import os
 import math
+import json
+import shutil
 import numbers
+import concurrent.futures
 import zarr
 import numcodecs
 import numpy as np
@@ -285,6 +288,109 @@ class ReplayBuffer:
         return self.save_to_store(store, chunks=chunks, 
             compressors=compressors, if_exists=if_exists, **kwargs)
 
+    # ============= memory-mapped numpy ===============
+    @classmethod
+    def create_from_mmap(cls, mmap_dir, mmap_mode='r'):
+        """
+        Open a store written by save_to_mmap. Data arrays are np.memmap 
+        (numpy backend), processes opening the same files share the 
+        page cache instead of holding their own decoded copies.
+        """
+        mmap_dir = os.path.expanduser(mmap_dir)
+        with open(os.path.join(mmap_dir, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+        root = {
+            'meta': dict(),
+            'data': dict()
+        }
+        for key in manifest['meta'].keys():
+            root['meta'][key] = np.load(
+                os.path.join(mmap_dir, 'meta', key + '.npy'))
+        for key in manifest['data'].keys():
+            root['data'][key] = np.load(
+                os.path.join(mmap_dir, 'data', key + '.npy'), 
+                mmap_mode=mmap_mode)
+        return cls(root=root)
+
+    @staticmethod
+    def verify_mmap(mmap_dir, fingerprint=None) -> bool:
+        """
+        True if mmap_dir holds a complete store written by save_to_mmap
+        from a source with the same fingerprint.
+        """
+        mmap_dir = os.path.expanduser(mmap_dir)
+        manifest_path = os.path.join(mmap_dir, 'manifest.json')
+        if not os.path.isfile(manifest_path):
+            return False
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+            if manifest.get('fingerprint', None) != fingerprint:
+                return False
+            for group in ['meta', 'data']:
+                for key, attr in manifest[group].items():
+                    arr = np.load(os.path.join(mmap_dir, group, key + '.npy'), 
+                        mmap_mode='r')
+                    if (list(arr.shape) != attr['shape']) \
+                            or (arr.dtype.str != attr['dtype']):
+                        return False
+        except (OSError, ValueError, KeyError) as e:
+            print(f'Invalid memory-mapped ReplayBuffer {mmap_dir}: {e}')
+            return False
+        return True
+
+    def save_to_mmap(self, mmap_dir, fingerprint=None, 
+            chunk_length=256, max_workers=None):
+        """
+        Decode every array once into a raw .npy file under mmap_dir 
+        (local disk or /dev/shm), open with create_from_mmap.
+        Written into a temporary directory that is renamed when complete.
+        """
+        mmap_dir = os.path.abspath(os.path.expanduser(mmap_dir))
+        tmp_dir = mmap_dir + '.tmp'
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        for group in ['meta', 'data']:
+            os.makedirs(os.path.join(tmp_dir, group))
+
+        manifest = {
+            'fingerprint': fingerprint,
+            'meta': dict(),
+            'data': dict()
+        }
+        try:
+            for key, value in self.root['meta'].items():
+                arr = np.asarray(value[...])
+                np.save(os.path.join(tmp_dir, 'meta', key + '.npy'), arr)
+                manifest['meta'][key] = {'shape': list(arr.shape), 'dtype': arr.dtype.str}
+
+            def copy_slice(src, dst, start):
+                dst[start:start+chunk_length] = src[start:start+chunk_length]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for key, value in self.root['data'].items():
+                    arr = np.lib.format.open_memmap(
+                        os.path.join(tmp_dir, 'data', key + '.npy'), mode='w+', 
+                        dtype=value.dtype, shape=value.shape)
+                    # slices are disjoint, decode in parallel
+                    futures = [executor.submit(copy_slice, value, arr, start) 
+                        for start in range(0, value.shape[0], chunk_length)]
+                    for f in concurrent.futures.as_completed(futures):
+                        f.result()
+                    arr.flush()
+                    manifest['data'][key] = {'shape': list(arr.shape), 'dtype': arr.dtype.str}
+                    del arr
+
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2)
+            if os.path.exists(mmap_dir):
+                shutil.rmtree(mmap_dir)
+            os.rename(tmp_dir, mmap_dir)
+        except BaseException as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise e
+        return mmap_dir
+
     @staticmethod
     def resolve_compressor(compressor='default'):
         if compressor == 'default':
@@ -0,0 +1,51 @@
+from typing import Optional, Dict
+import os
+import json
+import zipfile
+import hashlib
+import numpy as np
+
+
+class ResetStateCache:
+    """
+    Env states right after a seeded reset, stored as
+    <cache_dir>/<namespace>/<seed>.npz so that all worker processes and
+    later eval runs restore them instead of running the full reset.
+    Files are written to a tmp file and renamed, concurrent writers of
+    the same seed are harmless.
+    """
+    def __init__(self, cache_dir: str, namespace: str):
+        self.cache_dir = os.path.join(os.path.expanduser(cache_dir), namespace)
+
+    @staticmethod
+    def make_namespace(name: str, config=None) -> str:
+        """
+        name plus a digest of config (e.g. env_meta), so that states of
+        differently configured envs don't mix.
+        """
+        if config is None:
+            return name
+        config_str = json.dumps(config, sort_keys=True, default=str)
+        return name + '_' + hashlib.md5(config_str.encode('utf-8')).hexdigest()[:8]
+
+    def _get_path(self, seed) -> str:
+        return os.path.join(self.cache_dir, f'{seed}.npz')
+
+    def get(self, seed) -> Optional[Dict[str, np.ndarray]]:
+        path = self._get_path(seed)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return dict((key, data[key]) for key in data.files)
+        except (OSError, ValueError, zipfile.BadZipFile):
+            # unreadable file is a miss, it is overwritten by put
+            return None
+
+    def put(self, seed, arrays: Dict[str, np.ndarray]):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._get_path(seed)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
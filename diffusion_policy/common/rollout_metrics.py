@@ -0,0 +1,74 @@
+from typing import Optional, List, Dict
+import concurrent.futures
+import numpy as np
+import torch
+from hsic import batch_hsic
+from mlp_correlation import batch_mlp_corr
+
+
+def compute_action_metrics(
+        actions: List[np.ndarray],
+        device='cuda',
+        hsic_num_features: Optional[int]=None,
+        mlp_corr: bool=True) -> Dict[str, float]:
+    """
+    actions: (n_envs, n_steps, Da) executed action trajectories, or a 
+        list of (n_steps_i, Da) trajectories of different lengths
+    """
+    lengths = np.array([len(x) for x in actions])
+    # per trajectory hsic, batched over trajectories of equal length
+    hsic_values = list()
+    for n_steps in np.unique(lengths):
+        batch = np.stack([x for x, n in zip(actions, lengths) if n == n_steps])
+        hsic_values.append(batch_hsic(torch.from_numpy(batch).to(device),
+            num_features=hsic_num_features))
+    res = torch.cat(hsic_values)
+    log_dict = {"hsic_pred_actions_full_traj_online_fixed": res.mean().item()}
+    if mlp_corr:
+        log_dict["mlp_corr_pred_actions_full_traj_online_fixed"] = batch_mlp_corr(actions)
+    return log_dict
+
+
+class RolloutMetrics:
+    """
+    Computes action trajectory metrics of finished rollout chunks in a
+    single background worker, so env stepping and rendering of the next
+    chunk don't wait on them. Results are returned in submission order
+    by collect.
+    """
+    def __init__(self,
+            device='cuda',
+            hsic_num_features: Optional[int]=None,
+            mlp_corr: bool=True,
+            use_thread: bool=True):
+        self.kwargs = dict(
+            device=device,
+            hsic_num_features=hsic_num_features,
+            mlp_corr=mlp_corr)
+        self.executor = None
+        if use_thread:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.results = list()
+
+    def submit(self, actions: List[np.ndarray]):
+        """
+        actions: executed action trajectories of the chunk, see 
+            compute_action_metrics
+        """
+        actions = [np.ascontiguousarray(x) for x in actions]
+        if self.executor is None:
+            self.results.append(compute_action_metrics(actions, **self.kwargs))
+        else:
+            self.results.append(self.executor.submit(
+                compute_action_metrics, actions, **self.kwargs))
+
+    def collect(self) -> List[Dict[str, float]]:
+        results = [x.result() if isinstance(x, concurrent.futures.Future) else x
+            for x in self.results]
+        self.results = list()
+        return results
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
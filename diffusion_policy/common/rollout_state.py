@@ -0,0 +1,89 @@
+from typing import Optional
+import numpy as np
+import torch
+
+
+class RolloutState:
+    """
+    Device-resident per-env state for rollouts.
+    Keeps the last n_past_steps executed actions of every env in a ring
+    buffer on the policy device (no numpy round trip for sample selection)
+    and stages env actions through a pinned host buffer.
+    All envs step together, so the write position is shared and only the
+    fill count is tracked per env slot.
+    """
+    def __init__(self,
+            n_envs: int,
+            n_past_steps: int,
+            action_dim: int,
+            device: torch.device,
+            dtype: torch.dtype=torch.float32):
+        self.n_envs = n_envs
+        self.n_past_steps = n_past_steps
+        self.device = torch.device(device)
+        self.action_buffer = torch.zeros(
+            (n_envs, max(n_past_steps, 1), action_dim),
+            device=self.device, dtype=dtype)
+        self.head = 0
+        self.n_filled = np.zeros(n_envs, dtype=np.int64)
+        self.host_action = None
+
+    def reset(self, slots=None):
+        """
+        Forget the action history of slots (all if None).
+        """
+        if slots is None:
+            self.head = 0
+            self.n_filled[:] = 0
+        else:
+            self.n_filled[slots] = 0
+
+    def filled_mask(self) -> np.ndarray:
+        """
+        (n_envs,) bool, slots with a full action history
+        """
+        return (self.n_past_steps > 0) & (self.n_filled >= self.n_past_steps)
+
+    def is_full(self) -> bool:
+        return bool(np.all(self.filled_mask()))
+
+    def append_actions(self, action: torch.Tensor):
+        """
+        action: (n_envs, n_steps, Da) executed actions on device
+        """
+        if self.n_past_steps == 0:
+            return
+        n = self.n_past_steps
+        action = action[:, -n:]
+        n_new = action.shape[1]
+        idxs = (self.head + torch.arange(n_new, device=self.device)) % n
+        self.action_buffer[:, idxs] = action.to(self.action_buffer.dtype)
+        self.head = (self.head + n_new) % n
+        self.n_filled = np.minimum(self.n_filled + n_new, n)
+
+    def get_past_actions(self) -> Optional[torch.Tensor]:
+        """
+        (n_envs, n_past_steps, Da) oldest first, None without history
+        """
+        if self.n_past_steps == 0:
+            return None
+        n = self.n_past_steps
+        idxs = (self.head + torch.arange(n, device=self.device)) % n
+        return self.action_buffer[:, idxs]
+
+    def to_host(self, action: torch.Tensor) -> np.ndarray:
+        """
+        Single non-blocking device to host copy through a pinned buffer.
+        """
+        action = action.detach()
+        if self.device.type != 'cuda':
+            return action.to('cpu').numpy().copy()
+        if (self.host_action is None) \
+                or (self.host_action.shape != action.shape) \
+                or (self.host_action.dtype != action.dtype):
+            self.host_action = torch.empty(
+                action.shape, dtype=action.dtype, pin_memory=True)
+        self.host_action.copy_(action, non_blocking=True)
+        torch.cuda.current_stream(self.device).synchronize()
+        # the pinned buffer is reused by the next call
+        return self.host_action.numpy().copy()
@@ -47,6 +47,44 @@ def create_indices(
     return indices
 
 
+@numba.jit(nopython=True)
+def create_frame_indices(indices: np.ndarray, frame_idxs: np.ndarray) -> np.ndarray:
+    """
+    Absolute replay buffer row of each sequence position in frame_idxs,
+    for every sample in indices (output of create_indices).
+    Padded positions map to the first/last valid row, same as
+    SequenceSampler.sample_sequence padding.
+    """
+    n_frames = len(frame_idxs)
+    rows = np.zeros((len(indices), n_frames), dtype=np.int64)
+    for i in range(len(indices)):
+        buffer_start_idx = indices[i,0]
+        sample_start_idx = indices[i,2]
+        sample_end_idx = indices[i,3]
+        for j in range(n_frames):
+            pos = min(max(frame_idxs[j], sample_start_idx), sample_end_idx-1)
+            rows[i,j] = buffer_start_idx + pos - sample_start_idx
+    return rows
+
+
+def read_rows(arr, rows: np.ndarray, out: Optional[np.ndarray]=None) -> np.ndarray:
+    """
+    Gather rows (possibly repeated) along the first axis of a
+    numpy or zarr array, reading each distinct row only once.
+    out: optional preallocated (len(rows),) + arr.shape[1:] buffer
+    """
+    if isinstance(arr, np.ndarray):
+        if out is None:
+            return arr[rows]
+        return np.take(arr, rows, axis=0, out=out)
+    uniq_rows, inverse = np.unique(rows, return_inverse=True)
+    result = arr.get_orthogonal_selection(uniq_rows)[inverse]
+    if out is None:
+        return result
+    out[:] = result
+    return out
+
+
 def get_val_mask(n_episodes, val_ratio, seed=0):
     val_mask = np.zeros(n_episodes, dtype=bool)
     if val_ratio <= 0:
@@ -83,10 +121,15 @@ class SequenceSampler:
         keys=None,
         key_first_k=dict(),
         episode_mask: Optional[np.ndarray]=None,
+        key_frame_idxs=dict(),
         ):
         """
         key_first_k: dict str: int
             Only take first k data from these keys (to improve perf)
+        key_frame_idxs: dict str: sequence of int
+            Only read these positions of the sequence for these keys
+            (e.g. strided history frames), output is (len(frame_idxs),...).
+            Takes precedence over key_first_k.
         """
 
         super().__init__()
@@ -108,22 +151,68 @@ class SequenceSampler:
         else:
             indices = np.zeros((0,4), dtype=np.int64)
 
+        # per key replay buffer rows (n_samples, n_frames), shared between
+        # keys with the same frame pattern
+        key_frame_idxs = dict((key, np.array(value, dtype=np.int64)) 
+            for key, value in key_frame_idxs.items())
+        key_frame_rows = dict()
+        pattern_rows = dict()
+        for key, frame_idxs in key_frame_idxs.items():
+            assert np.all((frame_idxs >= 0) & (frame_idxs < sequence_length))
+            pattern = tuple(frame_idxs.tolist())
+            if pattern not in pattern_rows:
+                pattern_rows[pattern] = create_frame_indices(
+                    indices.astype(np.int64), frame_idxs)
+            key_frame_rows[key] = pattern_rows[pattern]
+
         # (buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx)
         self.indices = indices 
         self.keys = list(keys) # prevent OmegaConf list performance problem
         self.sequence_length = sequence_length
         self.replay_buffer = replay_buffer
         self.key_first_k = key_first_k
+        self.key_frame_idxs = key_frame_idxs
+        self.key_frame_rows = key_frame_rows
     
     def __len__(self):
         return len(self.indices)
+
+    def select(self, sample_idxs):
+        """
+        Restrict the sampler to a fixed subset of its samples 
+        (e.g. a cached validation subset).
+        """
+        sample_idxs = np.asarray(sample_idxs, dtype=np.int64)
+        self.indices = self.indices[sample_idxs]
+        pattern_rows = dict()
+        for key, rows in self.key_frame_rows.items():
+            if id(rows) not in pattern_rows:
+                pattern_rows[id(rows)] = rows[sample_idxs]
+            self.key_frame_rows[key] = pattern_rows[id(rows)]
         
+    def get_frame_rows(self, idxs, key):
+        """
+        Replay buffer rows read for key, (n_frames,) for a single 
+        sample index or (len(idxs), n_frames).
+        """
+        if key in self.key_frame_rows:
+            return self.key_frame_rows[key][idxs]
+        idxs = np.asarray(idxs, dtype=np.int64)
+        rows = create_frame_indices(
+            self.indices[idxs.reshape(-1)].astype(np.int64), 
+            np.arange(self.sequence_length, dtype=np.int64))
+        return rows.reshape(idxs.shape + (self.sequence_length,))
+
     def sample_sequence(self, idx):
         buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx \
             = self.indices[idx]
         result = dict()
         for key in self.keys:
             input_arr = self.replay_buffer[key]
+            if key in self.key_frame_rows:
+                # performance optimization, only load the used frames
+                result[key] = read_rows(input_arr, self.key_frame_rows[key][idx])
+                continue
             # performance optimization, avoid small allocation if possible
             if key not in self.key_first_k:
                 sample = input_arr[buffer_start_idx:buffer_end_idx]
@@ -151,3 +240,39 @@ class SequenceSampler:
                 data[sample_start_idx:sample_end_idx] = sample
             result[key] = data
         return result
+
+    def sample_sequence_batch(self, idxs):
+        """
+        Vectorized sample_sequence for a list of sample indices, 
+        returns (B,T,...) arrays, rows of all samples are gathered 
+        with one read per key.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        B = len(idxs)
+        seq_rows = None
+        result = dict()
+        for key in self.keys:
+            input_arr = self.replay_buffer[key]
+            if key in self.key_frame_rows:
+                rows = self.key_frame_rows[key][idxs]
+            else:
+                if seq_rows is None:
+                    seq_rows = create_frame_indices(self.indices[idxs].astype(np.int64), 
+                        np.arange(self.sequence_length, dtype=np.int64))
+                rows = seq_rows
+                if key in self.key_first_k:
+                    # only load first k steps, the rest is never used
+                    rows = rows[:,:self.key_first_k[key]]
+            n_frames = rows.shape[1]
+            data = np.empty((B * n_frames,) + input_arr.shape[1:], 
+                dtype=input_arr.dtype)
+            read_rows(input_arr, rows.reshape(-1), out=data)
+            data = data.reshape((B, n_frames) + input_arr.shape[1:])
+            if (key not in self.key_frame_rows) and (n_frames < self.sequence_length):
+                # fill value with Nan to catch bugs, same as sample_sequence
+                full = np.full((B, self.sequence_length) + input_arr.shape[1:],
+                    fill_value=np.nan, dtype=input_arr.dtype)
+                full[:,:n_frames] = data
+                data = full
+            result[key] = data
+        return result
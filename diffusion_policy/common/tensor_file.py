@@ -0,0 +1,91 @@
+"""
+Minimal reader/writer for the safetensors file layout:
+8 byte little-endian header size, json header
+{name: {dtype, shape, data_offsets}}, raw tensor bytes.
+Readers only seek to the tensors they need.
+"""
+from typing import Dict, Optional
+import json
+import struct
+import numpy as np
+import torch
+
+_DTYPE_TO_STR = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL'
+}
+_STR_TO_DTYPE = dict((v, k) for k, v in _DTYPE_TO_STR.items())
+
+
+def _to_bytes(x: torch.Tensor) -> bytes:
+    x = x.detach().to('cpu').contiguous()
+    if x.dtype == torch.bfloat16:
+        # numpy has no bfloat16
+        x = x.view(torch.int16)
+    return x.numpy().tobytes()
+
+
+def save_tensor_file(tensors: Dict[str, torch.Tensor], path: str,
+        metadata: Optional[Dict[str, str]]=None):
+    header = dict()
+    if metadata is not None:
+        header['__metadata__'] = metadata
+    offset = 0
+    names = [k for k, v in tensors.items() if isinstance(v, torch.Tensor)]
+    for name in names:
+        x = tensors[name]
+        nbytes = x.numel() * x.element_size()
+        header[name] = {
+            'dtype': _DTYPE_TO_STR[x.dtype],
+            'shape': list(x.shape),
+            'data_offsets': [offset, offset + nbytes]
+        }
+        offset += nbytes
+    header_bytes = json.dumps(header).encode('utf-8')
+    # data is 8 byte aligned
+    header_bytes += b' ' * (-len(header_bytes) % 8)
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name in names:
+            f.write(_to_bytes(tensors[name]))
+
+
+def load_tensor_file(path: str, prefix: Optional[str]=None,
+        strip_prefix: bool=False, device='cpu') -> Dict[str, torch.Tensor]:
+    """
+    Read tensors whose name starts with prefix (all if None).
+    strip_prefix: return names without prefix, e.g. for load_state_dict
+    """
+    result = dict()
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+        data_start = 8 + header_size
+        for name, info in header.items():
+            if name == '__metadata__':
+                continue
+            if (prefix is not None) and (not name.startswith(prefix)):
+                continue
+            start, end = info['data_offsets']
+            f.seek(data_start + start)
+            buf = bytearray(f.read(end - start))
+            dtype = _STR_TO_DTYPE[info['dtype']]
+            np_dtype = torch.empty(0, dtype=dtype if dtype != torch.bfloat16
+                else torch.int16).numpy().dtype
+            x = torch.from_numpy(np.frombuffer(buf, dtype=np_dtype).copy())
+            if dtype == torch.bfloat16:
+                x = x.view(torch.bfloat16)
+            x = x.reshape(info['shape']).to(device)
+            if strip_prefix and (prefix is not None):
+                name = name[len(prefix):]
+            result[name] = x
+    return result
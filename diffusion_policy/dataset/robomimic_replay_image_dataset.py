@@ -1,13 +1,14 @@
 from typing import Dict, List
+import numbers
 import torch
 import numpy as np
 import h5py
 from tqdm import tqdm
 import zarr
 import os
-import shutil
 import copy
 import json
+import pickle
 import hashlib
 from filelock import FileLock
 from threadpoolctl import threadpool_limits
@@ -18,9 +19,10 @@ from diffusion_policy.common.pytorch_util import dict_apply
 from diffusion_policy.dataset.base_dataset import BaseImageDataset, LinearNormalizer
 from diffusion_policy.model.common.normalizer import LinearNormalizer, SingleFieldLinearNormalizer
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
-from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs, Jpeg2k
+from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs, Jpeg2k, Blosc
 from diffusion_policy.common.replay_buffer import ReplayBuffer
 from diffusion_policy.common.sampler import SequenceSampler, get_val_mask
+from diffusion_policy.model.vision.color_jitter import BatchColorJitter
 import torchvision.transforms as T
 from diffusion_policy.common.normalize_util import (
     robomimic_abs_action_only_normalizer_from_stat,
@@ -28,7 +30,7 @@ from diffusion_policy.common.normalize_util import (
     get_range_normalizer_from_stat,
     get_image_range_normalizer,
     get_identity_normalizer_from_stat,
-    array_to_stats
+    array_to_stats_streaming
 )
 from math import ceil, floor
 from mlp_correlation import batch_mlp_corr
@@ -52,8 +54,33 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             subsampling_method="uniform",
             use_cache=False,
             seed=42,
-            val_ratio=0.0
+            val_ratio=0.0,
+            gpu_image_aug=False,
+            cache_backend='zarr',
+            mmap_dir=None,
+            image_chunk_length=1,
+            image_compressor=None,
+            val_max_samples=None,
+            return_frame_idx=False
         ):
+        """
+        gpu_image_aug: return raw uint8 T,C,H,W images without color jitter,
+            conversion and augmentation are done batched on GPU by the 
+            workspace (see BatchColorJitter).
+        cache_backend: zarr keeps the Jpeg2k compressed cache in memory,
+            mmap decodes it once into raw .npy files in mmap_dir 
+            (default <dataset_path>.mmap, e.g. put it on /dev/shm) that are
+            shared by all DataLoader workers. Requires use_cache.
+        image_chunk_length, image_compressor: layout of rgb keys when 
+            converting the hdf5 (an existing zarr cache is used as is), 
+            e.g. 16 and 'lz4' for long histories, see _convert_robomimic_to_replay.
+        val_max_samples: validate on a fixed random subset of at most this
+            many windows (seeded, same subset every epoch).
+        return_frame_idx: also return 'frame_idx', the replay buffer rows 
+            of the obs frames (To,), used as key of the policy's frozen 
+            encoder feature cache. Images are not color jittered then,
+            cached features are of the original frames.
+        """
         from_convention = None
         if rot_rep_orig == "euler_angles":
             from_convention = 'XYZ'
@@ -62,19 +89,39 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             from_rep=rot_rep_orig, to_rep=rotation_rep, from_convention=from_convention)
 
         self.use_embed_if_present = use_embed_if_present
+        self.gpu_image_aug = gpu_image_aug
         self.subsample_frames = subsample_frames
         self.subsampling_method = subsampling_method
         self.image_transforms = transform = T.Compose([
             T.ColorJitter(brightness=0.2, contrast=[0.8,1.2], saturation=[0.8,1.2], hue=0.05),  # Adjust brightness, contrast, saturation, hue
         ])
+        # same jitter, batched, for get_batch
+        self.batch_image_aug = BatchColorJitter()
 
+        assert cache_backend in ('zarr', 'mmap')
+        assert use_cache or (cache_backend == 'zarr')
         replay_buffer = None
+        # zip cache opened read-only in place, see _refresh_replay_buffer
+        lazy_zarr_path = None
+        # also identifies the replay buffer rows, see FrameFeatureCache
+        cache_fingerprint = _get_cache_fingerprint(
+            dataset_path=dataset_path, shape_meta=shape_meta, 
+            abs_action=abs_action, rot_rep_orig=rot_rep_orig, 
+            rotation_rep=rotation_rep)
         if use_cache:
             cache_zarr_path = dataset_path + '.zarr.zip'
             cache_lock_path = cache_zarr_path + '.lock'
+            if cache_backend == 'mmap':
+                if mmap_dir is None:
+                    mmap_dir = dataset_path + '.mmap'
+                mmap_fingerprint = cache_fingerprint
             print('Acquiring lock on cache.')
             with FileLock(cache_lock_path):
-                if not os.path.exists(cache_zarr_path):
+                if (cache_backend == 'mmap') and ReplayBuffer.verify_mmap(
+                        mmap_dir, fingerprint=mmap_fingerprint):
+                    print(f'Loading memory-mapped ReplayBuffer from {mmap_dir}.')
+                    replay_buffer = ReplayBuffer.create_from_mmap(mmap_dir)
+                elif not os.path.exists(cache_zarr_path):
                     # cache does not exists
                     try:
                         print('Cache does not exist. Creating!')
@@ -84,28 +131,37 @@ class RobomimicReplayImageDataset(BaseImageDataset):
                             shape_meta=shape_meta, 
                             dataset_path=dataset_path, 
                             abs_action=abs_action, 
-                            rotation_transformer=rotation_transformer)
+                            rotation_transformer=rotation_transformer,
+                            image_chunk_length=image_chunk_length,
+                            image_compressor=image_compressor)
                         print('Saving cache to disk.')
                         with zarr.ZipStore(cache_zarr_path) as zip_store:
                             replay_buffer.save_to_store(
                                 store=zip_store
                             )
                     except Exception as e:
-                        shutil.rmtree(cache_zarr_path)
+                        if os.path.exists(cache_zarr_path):
+                            os.remove(cache_zarr_path)
                         raise e
                 else:
-                    print('Loading cached ReplayBuffer from Disk.')
-                    with zarr.ZipStore(cache_zarr_path, mode='r') as zip_store:
-                        replay_buffer = ReplayBuffer.copy_from_store(
-                            src_store=zip_store, store=zarr.MemoryStore())
-                    print('Loaded!')
+                    print('Opening cached ReplayBuffer from Disk.')
+                    replay_buffer = _open_zip_replay_buffer(cache_zarr_path)
+                    lazy_zarr_path = cache_zarr_path
+
+                if (cache_backend == 'mmap') and (replay_buffer.backend == 'zarr'):
+                    print(f'Decoding ReplayBuffer to {mmap_dir}.')
+                    replay_buffer.save_to_mmap(mmap_dir, fingerprint=mmap_fingerprint)
+                    replay_buffer = ReplayBuffer.create_from_mmap(mmap_dir)
+                    lazy_zarr_path = None
         else:
             replay_buffer = _convert_robomimic_to_replay(
                 store=zarr.MemoryStore(), 
                 shape_meta=shape_meta, 
                 dataset_path=dataset_path, 
                 abs_action=abs_action, 
-                rotation_transformer=rotation_transformer)
+                rotation_transformer=rotation_transformer,
+                image_chunk_length=image_chunk_length,
+                image_compressor=image_compressor)
 
         rgb_keys = list()
         lowdim_keys = list()
@@ -120,12 +176,16 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         # for key in rgb_keys:
         #     replay_buffer[key].compressor.numthreads=1
 
-        key_first_k = dict()
+        key_frame_idxs = dict()
         if n_obs_steps is not None:
-            # only take first k obs from images
-            for key in rgb_keys + lowdim_keys:
-                key_first_k[key] = n_obs_steps*subsample_frames
-            key_first_k["embedding"] = n_obs_steps*subsample_frames
+            # only read the subsampled history frames of obs
+            # and the subsampled past + future actions
+            obs_frame_idxs = _get_obs_frame_idxs(
+                n_obs_steps, subsample_frames, subsampling_method)
+            for key in rgb_keys + lowdim_keys + ["embedding"]:
+                key_frame_idxs[key] = obs_frame_idxs
+            key_frame_idxs["action"] = _get_action_frame_idxs(
+                horizon, n_obs_steps, subsample_frames)
             
 
         val_mask = get_val_mask(
@@ -134,8 +194,10 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             seed=seed)
         train_mask = ~val_mask
 
-        keys = list(replay_buffer.keys())
-        if self.use_embed_if_present and "embedding" in keys:
+        # only read keys used by __getitem__
+        keys = [key for key in rgb_keys + lowdim_keys + ["action"] 
+            if key in replay_buffer]
+        if self.use_embed_if_present and "embedding" in replay_buffer:
             keys = ["embedding", "action"]
 
         sampler = SequenceSampler(
@@ -145,7 +207,7 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             pad_after=pad_after,
             keys=keys,
             episode_mask=train_mask,
-            key_first_k=key_first_k)
+            key_frame_idxs=key_frame_idxs)
         
         print("subsample frames dataset", subsample_frames)
         self.replay_buffer = replay_buffer
@@ -160,33 +222,98 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         self.pad_before = pad_before
         self.pad_after = pad_after
         self.use_legacy_normalizer = use_legacy_normalizer
-
-
-        actions = np.array(self.replay_buffer["action"])[None]
-        corr = batch_mlp_corr(actions)
-        print(actions.shape, {"expert_actions_corr": corr})
+        self.val_max_samples = val_max_samples
+        self.seed = seed
+        self.return_frame_idx = return_frame_idx
+        self.cache_fingerprint = cache_fingerprint
+        self.lazy_zarr_path = lazy_zarr_path
+        self._replay_buffer_pid = os.getpid()
+        # normalizer stats are cached next to the dataset cache
+        self.stats_cache_path = None
+        self.cache_fingerprint = cache_fingerprint
+        if use_cache:
+            self.stats_cache_path = dataset_path + '.stats.pkl'
+        self._expert_action_corr = None
+
+    def _refresh_replay_buffer(self):
+        # zip file handles can't be shared with forked DataLoader workers,
+        # each process reopens the cache read-only
+        if (self.lazy_zarr_path is not None) \
+                and (self._replay_buffer_pid != os.getpid()):
+            self.replay_buffer = _open_zip_replay_buffer(self.lazy_zarr_path)
+            self.sampler.replay_buffer = self.replay_buffer
+            self._replay_buffer_pid = os.getpid()
+
+    def get_expert_action_corr(self):
+        """
+        MLP next-action predictability of the demonstrations 
+        (see mlp_correlation.batch_mlp_corr), trains an MLP on GPU,
+        computed on first call.
+        """
+        if self._expert_action_corr is None:
+            actions = np.array(self.replay_buffer["action"])[None]
+            self._expert_action_corr = batch_mlp_corr(actions)
+        return self._expert_action_corr
 
     def get_validation_dataset(self):
         val_set = copy.copy(self)
-        keys = list(self.replay_buffer.keys())
-        if self.use_embed_if_present and "embedding" in keys:
-            keys = ["embedding", "action"]
+        # same read plan as the training sampler
         val_set.sampler = SequenceSampler(
             replay_buffer=self.replay_buffer, 
-            sequence_length=(self.horizon-self.n_obs_steps) + self.n_obs_steps*self.subsample_frames,
+            sequence_length=self.sampler.sequence_length,
             pad_before=self.pad_before, 
             pad_after=self.pad_after,
-            keys=keys,
-            episode_mask=~self.train_mask
+            keys=self.sampler.keys,
+            key_first_k=self.sampler.key_first_k,
+            episode_mask=~self.train_mask,
+            key_frame_idxs=self.sampler.key_frame_idxs
             )
+        if (self.val_max_samples is not None) \
+                and (len(val_set.sampler) > self.val_max_samples):
+            rng = np.random.default_rng(seed=self.seed)
+            sample_idxs = np.sort(rng.choice(len(val_set.sampler), 
+                size=self.val_max_samples, replace=False))
+            val_set.sampler.select(sample_idxs)
         val_set.train_mask = ~self.train_mask
         return val_set
 
+    def get_stats(self) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        min/max/mean/std of action and lowdim obs, computed in one 
+        streaming pass and reused from stats_cache_path if the
+        cache fingerprint matches.
+        """
+        keys = ['action'] + self.lowdim_keys
+        all_stats = dict()
+        if (self.stats_cache_path is not None) \
+                and os.path.isfile(self.stats_cache_path):
+            with open(self.stats_cache_path, 'rb') as f:
+                payload = pickle.load(f)
+            if payload.get('fingerprint') == self.cache_fingerprint:
+                all_stats = payload['stats']
+        missing_keys = [key for key in keys if key not in all_stats]
+        if len(missing_keys) == 0:
+            return dict((key, all_stats[key]) for key in keys)
+
+        for key in missing_keys:
+            all_stats[key] = array_to_stats_streaming(self.replay_buffer[key])
+        if self.stats_cache_path is not None:
+            payload = {
+                'fingerprint': self.cache_fingerprint,
+                'stats': all_stats
+            }
+            tmp_path = self.stats_cache_path + f'.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(payload, f)
+            os.replace(tmp_path, self.stats_cache_path)
+        return dict((key, all_stats[key]) for key in keys)
+
     def get_normalizer(self, **kwargs) -> LinearNormalizer:
         normalizer = LinearNormalizer()
+        stats = self.get_stats()
 
         # action
-        stat = array_to_stats(self.replay_buffer['action'])
+        stat = stats['action']
         if self.abs_action:
             if stat['mean'].shape[-1] > 10:
                 # dual arm
@@ -203,7 +330,7 @@ class RobomimicReplayImageDataset(BaseImageDataset):
 
         # obs
         for key in self.lowdim_keys:
-            stat = array_to_stats(self.replay_buffer[key])
+            stat = stats[key]
 
             if key.endswith('pos') or key.endswith("position") or key == "past_act" or key == ('EE_EULER') or key == "EE_POS" or key == "GRIPPER":
                 this_normalizer = get_range_normalizer_from_stat(stat)
@@ -226,7 +353,11 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         return len(self.sampler)
 
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
+        if not isinstance(idx, numbers.Integral):
+            # list of indices from a BatchSampler (DataLoader batch_size=None)
+            return self.get_batch(idx)
         threadpool_limits(1)
+        self._refresh_replay_buffer()
         data = self.sampler.sample_sequence(idx)
         # to save RAM, only return first n_obs_steps of OBS
         # since the rest will be discarded anyway.
@@ -241,56 +372,144 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             rgb_keys = []
             lowdim_keys = ["embedding"]
 
+        # history frames are already subsampled by the sampler
+        # see _get_obs_frame_idxs and _get_action_frame_idxs
         for key in rgb_keys:
             # move channel last to channel first
             # T,H,W,C
             # convert uint8 image to float32))
-            subsampled = data[key]
-            past_data = subsampled[:self.n_obs_steps*self.subsample_frames]
-            if self.subsampling_method == "uniform":
-                past_data = past_data[self.subsample_frames-1::self.subsample_frames]
-            elif self.subsampling_method == "mixed":
-                sparse = past_data[self.subsample_frames-1::self.subsample_frames][-floor(self.n_obs_steps/2):]
-                dense = past_data[-self.subsample_frames:][-ceil(self.n_obs_steps/2):]
-                past_data = np.concatenate([sparse, dense])
-            else:
-                raise NotImplementedError
-
-            # past_data = past_data[self.subsample_frames-1::self.subsample_frames]
-            comb_data = past_data
+            comb_data = data[key]
+            if self.gpu_image_aug:
+                obs_dict[key] = np.moveaxis(comb_data[T_slice],-1,1)
+                del data[key]
+                continue
+            if self.return_frame_idx:
+                obs_dict[key] = np.moveaxis(comb_data[T_slice],-1,1
+                    ).astype(np.float32) / 255.
+                del data[key]
+                continue
             obs_dict[key] = (self.image_transforms(torch.from_numpy(np.moveaxis(comb_data[T_slice],-1,1
                 )).type(torch.uint8)).type(torch.float32) / 255.).numpy()
             # T,C,H,W
             del data[key]
         for key in lowdim_keys:
-            subsampled = data[key]
-            past_data = subsampled[:self.n_obs_steps*self.subsample_frames]
-            if self.subsampling_method == "uniform":
-                past_data = past_data[self.subsample_frames-1::self.subsample_frames]
-            elif self.subsampling_method == "mixed":
-                sparse = past_data[self.subsample_frames-1::self.subsample_frames][-floor(self.n_obs_steps/2):]
-                dense = past_data[-self.subsample_frames:][-ceil(self.n_obs_steps/2):]
-                past_data = np.concatenate([sparse, dense])
-            else:
-                raise NotImplementedError
-
-            comb_data = past_data
+            comb_data = data[key]
             obs_dict[key] = comb_data[T_slice].astype(np.float32)
             del data[key]
 
-        subsampled = data["action"]
-        future_data = subsampled[-(self.horizon - self.n_obs_steps):]
-        past_data = subsampled[:-(self.horizon - self.n_obs_steps)]
-        past_data = past_data[self.subsample_frames-1::self.subsample_frames]
-        comb_data = np.concatenate([past_data, future_data])
-        data["action"] = comb_data
         torch_data = {
             'obs': dict_apply(obs_dict, torch.from_numpy),
             'action': torch.from_numpy(data['action'].astype(np.float32))
         }
+        if self.return_frame_idx:
+            torch_data['frame_idx'] = torch.from_numpy(
+                self._get_obs_frame_rows(idx)[T_slice])
+        return torch_data
+
+    def _get_obs_frame_rows(self, idxs):
+        # all obs keys share one frame pattern
+        key = (self.rgb_keys + self.lowdim_keys)[0]
+        return self.sampler.get_frame_rows(idxs, key)
+
+
+    def get_batch(self, idxs) -> Dict[str, torch.Tensor]:
+        """
+        Batched __getitem__, all windows are gathered by one vectorized 
+        read per key (see SequenceSampler.sample_sequence_batch).
+        Images are B,T,C,H,W, raw uint8 if gpu_image_aug else float32,
+        jittered unless return_frame_idx.
+        """
+        threadpool_limits(1)
+        self._refresh_replay_buffer()
+        data = self.sampler.sample_sequence_batch(idxs)
+        T_slice = slice(self.n_obs_steps)
+        obs_dict = dict()
+        rgb_keys = self.rgb_keys
+        lowdim_keys = self.lowdim_keys
+
+        if self.use_embed_if_present:
+            rgb_keys = []
+            lowdim_keys = ["embedding"]
+
+        for key in rgb_keys:
+            # B,T,H,W,C -> B,T,C,H,W
+            x = torch.from_numpy(data[key][:,T_slice]).permute(0,1,4,2,3).contiguous()
+            if not self.gpu_image_aug:
+                x = x.type(torch.float32) / 255.
+                if not self.return_frame_idx:
+                    x = self.batch_image_aug(x)
+            obs_dict[key] = x
+            del data[key]
+        for key in lowdim_keys:
+            obs_dict[key] = torch.from_numpy(data[key][:,T_slice].astype(np.float32))
+            del data[key]
+
+        torch_data = {
+            'obs': obs_dict,
+            'action': torch.from_numpy(data['action'].astype(np.float32))
+        }
+        if self.return_frame_idx:
+            torch_data['frame_idx'] = torch.from_numpy(
+                self._get_obs_frame_rows(idxs)[:,T_slice])
         return torch_data
 
 
+def _get_obs_frame_idxs(n_obs_steps, subsample_frames, subsampling_method):
+    """
+    Positions of the obs frames used by the policy within the
+    n_obs_steps*subsample_frames history window.
+    """
+    past_data = np.arange(n_obs_steps*subsample_frames)
+    if subsampling_method == "uniform":
+        past_data = past_data[subsample_frames-1::subsample_frames]
+    elif subsampling_method == "mixed":
+        sparse = past_data[subsample_frames-1::subsample_frames][-floor(n_obs_steps/2):]
+        dense = past_data[-subsample_frames:][-ceil(n_obs_steps/2):]
+        past_data = np.concatenate([sparse, dense])
+    else:
+        raise NotImplementedError
+    return past_data
+
+
+def _get_action_frame_idxs(horizon, n_obs_steps, subsample_frames):
+    """
+    Positions of the actions used for training within a sequence of
+    (horizon-n_obs_steps) + n_obs_steps*subsample_frames steps:
+    subsampled past actions followed by all future actions.
+    """
+    subsampled = np.arange((horizon-n_obs_steps) + n_obs_steps*subsample_frames)
+    future_data = subsampled[-(horizon - n_obs_steps):]
+    past_data = subsampled[:-(horizon - n_obs_steps)]
+    past_data = past_data[subsample_frames-1::subsample_frames]
+    return np.concatenate([past_data, future_data])
+
+
+def _open_zip_replay_buffer(zarr_path):
+    """
+    Read-only ReplayBuffer backed by a .zarr.zip cache, chunks are 
+    read from disk on access instead of copying the store to memory.
+    """
+    zip_store = zarr.ZipStore(zarr_path, mode='r')
+    return ReplayBuffer(root=zarr.open_group(store=zip_store, mode='r'))
+
+
+def _get_cache_fingerprint(dataset_path, shape_meta, **kwargs):
+    """
+    Identifies the source of a derived cache: hdf5 file stat plus the 
+    conversion parameters.
+    """
+    stat = os.stat(dataset_path)
+    info = {
+        'dataset_path': os.path.abspath(dataset_path),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'shape_meta': OmegaConf.to_container(shape_meta, resolve=True) 
+            if OmegaConf.is_config(shape_meta) else shape_meta,
+    }
+    info.update(kwargs)
+    return hashlib.md5(json.dumps(info, sort_keys=True, default=str).encode()).hexdigest()
+
+
 def _convert_actions(raw_actions, abs_action, rotation_transformer):
     actions = raw_actions
     if abs_action:
@@ -314,8 +533,29 @@ def _convert_actions(raw_actions, abs_action, rotation_transformer):
     return actions
 
 
+def _get_image_compressor(image_compressor=None):
+    """
+    None/jpeg2k: per-frame Jpeg2k (original layout), 
+    lz4/zstd: lossless Blosc, meant for multi-frame chunks.
+    Codec instances are returned as is.
+    """
+    if (image_compressor is None) or (image_compressor == 'jpeg2k'):
+        return Jpeg2k(level=50)
+    elif image_compressor in ('lz4', 'zstd'):
+        return Blosc(level=5, compressor=image_compressor)
+    elif isinstance(image_compressor, str):
+        raise RuntimeError(f"Unsupported image compressor: {image_compressor}")
+    return image_compressor
+
+
 def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, rotation_transformer, 
-        n_workers=None, max_inflight_tasks=None):
+        n_workers=None, max_inflight_tasks=None, 
+        image_chunk_length=1, image_compressor=None):
+    """
+    image_chunk_length: frames per zarr chunk of rgb keys, >1 lets a long
+        history window be read with one or two chunk decodes
+    image_compressor: see _get_image_compressor
+    """
     if n_workers is None:
         n_workers = multiprocessing.cpu_count()
     if max_inflight_tasks is None:
@@ -389,11 +629,23 @@ def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, ro
                 dtype=this_data.dtype
             )
         
-        def img_copy(zarr_arr, zarr_idx, hdf5_arr, hdf5_idx):
+        episode_starts_arr = np.array(episode_starts, dtype=np.int64)
+        episode_ends_arr = np.array(episode_ends, dtype=np.int64)
+        def img_copy(zarr_arr, start, end, hdf5_arrs):
+            # copy global steps [start, end), may span episodes
             try:
-                zarr_arr[zarr_idx] = hdf5_arr[hdf5_idx]
+                frames = list()
+                # episodes overlapping [start, end)
+                first_episode = np.searchsorted(episode_ends_arr, start, side='right')
+                last_episode = np.searchsorted(episode_starts_arr, end)
+                for episode_idx in range(first_episode, last_episode):
+                    ep_start = episode_starts[episode_idx]
+                    ep_end = episode_ends[episode_idx]
+                    frames.append(hdf5_arrs[episode_idx][
+                        max(start, ep_start) - ep_start:min(end, ep_end) - ep_start])
+                zarr_arr[start:end] = np.concatenate(frames, axis=0)
                 # make sure we can successfully decode
-                _ = zarr_arr[zarr_idx]
+                _ = zarr_arr[start:end]
                 return True
             except Exception as e:
                 return False
@@ -401,41 +653,38 @@ def _convert_robomimic_to_replay(store, shape_meta, dataset_path, abs_action, ro
         with tqdm(total=n_steps*len(rgb_keys), desc="Loading image data", mininterval=1.0) as pbar:
             # one chunk per thread, therefore no synchronization needed
             with concurrent.futures.ThreadPoolExecutor(max_workers=n_workers) as executor:
-                futures = set()
+                futures = dict()
                 for key in rgb_keys:
                     data_key = 'obs/' + key
                     shape = tuple(shape_meta['obs'][key]['shape'])
                     c,h,w = shape
-                    this_compressor = Jpeg2k(level=50)
+                    this_compressor = _get_image_compressor(image_compressor)
                     img_arr = data_group.require_dataset(
                         name=key,
                         shape=(n_steps,h,w,c),
-                        chunks=(1,h,w,c),
+                        chunks=(image_chunk_length,h,w,c),
                         compressor=this_compressor,
                         dtype=np.uint8
                     )
-                    for episode_idx in range(len(demos)):
-                        demo = demos[f'demo_{episode_idx}']
-                        hdf5_arr = demo['obs'][key]#[:,0]
-                        for hdf5_idx in range(hdf5_arr.shape[0]):
-                            if len(futures) >= max_inflight_tasks:
-                                # limit number of inflight tasks
-                                completed, futures = concurrent.futures.wait(futures, 
-                                    return_when=concurrent.futures.FIRST_COMPLETED)
-                                for f in completed:
-                                    if not f.result():
-                                        raise RuntimeError('Failed to encode image!')
-                                pbar.update(len(completed))
-
-                            zarr_idx = episode_starts[episode_idx] + hdf5_idx
-                            futures.add(
-                                executor.submit(img_copy, 
-                                    img_arr, zarr_idx, hdf5_arr, hdf5_idx))
-                completed, futures = concurrent.futures.wait(futures)
+                    hdf5_arrs = [demos[f'demo_{i}']['obs'][key] for i in range(len(demos))]
+                    for start in range(0, n_steps, image_chunk_length):
+                        if len(futures) >= max_inflight_tasks:
+                            # limit number of inflight tasks
+                            completed, _ = concurrent.futures.wait(futures, 
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+                            for f in completed:
+                                if not f.result():
+                                    raise RuntimeError('Failed to encode image!')
+                                pbar.update(futures.pop(f))
+
+                        end = min(start + image_chunk_length, n_steps)
+                        futures[executor.submit(img_copy, 
+                            img_arr, start, end, hdf5_arrs)] = end - start
+                completed, _ = concurrent.futures.wait(futures)
                 for f in completed:
                     if not f.result():
                         raise RuntimeError('Failed to encode image!')
-                pbar.update(len(completed))
+                    pbar.update(futures.pop(f))
 
     replay_buffer = ReplayBuffer(root)
 
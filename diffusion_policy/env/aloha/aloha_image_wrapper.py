@@ -2,10 +2,11 @@ from typing import List, Optional
 from matplotlib.pyplot import fill
 import numpy as np
 import gym
+import dm_env
 from gym import spaces
 from omegaconf import OmegaConf
-import copy
 from diffusion_policy.env.aloha.env_utils import sample_box_pose, sample_box_no_rand_pose, sample_insertion_pose, sample_box_pose_large, sample_insertion_pose_large, sample_box_rand_test_pose, sample_box_rand_train_pose
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 
 class AlohaImageWrapper(gym.Env):
     def __init__(self, 
@@ -13,9 +14,21 @@ class AlohaImageWrapper(gym.Env):
         shape_meta: dict,
         init_state: Optional[np.ndarray]=None,
         render_obs_key='top',
+        obs_dtype='float32',
+        reset_state_cache: Optional[ResetStateCache]=None,
         ):
-
+        """
+        obs_dtype: float32 returns C,H,W images in [0,1], uint8 returns
+            the rendered H,W,C images.
+        reset_state_cache: physics state of seeded resets, shared across
+            processes and runs. Only physics state, ctrl and the plain
+            (number/array) task attributes are restored, task state that
+            initialize_episode keeps elsewhere is not, hence opt-in.
+        """
+        assert obs_dtype in ('float32', 'uint8')
         self.env = env
+        self.obs_dtype = obs_dtype
+        self.reset_state_cache = reset_state_cache
         self.render_obs_key = render_obs_key
         self.init_state = init_state
         self.seed_state_map = dict()
@@ -61,6 +74,14 @@ class AlohaImageWrapper(gym.Env):
                 shape=shape,
                 dtype=np.float32
             )
+            if key.endswith(('image', 'top', 'wrist')) and (obs_dtype == 'uint8'):
+                c, h, w = shape
+                this_space = spaces.Box(
+                    low=0,
+                    high=255,
+                    shape=(h, w, c),
+                    dtype=np.uint8
+                )
             observation_space[key] = this_space
         self.observation_space = observation_space
 
@@ -69,22 +90,55 @@ class AlohaImageWrapper(gym.Env):
         if raw_obs is None:
             raw_obs = self.env.get_observation()
         
-        obs_dict = copy.deepcopy(raw_obs.observation)
-
-        for img_key in obs_dict["images"].keys():
-            new_image = (obs_dict["images"][img_key] / 255).transpose((2,0,1))
-            obs_dict[img_key] = new_image
-
-        del obs_dict["images"]
-
-        self.render_cache = obs_dict[self.render_obs_key]
+        # only copy what is returned, not the whole observation
+        raw_dict = raw_obs.observation
+        images = raw_dict["images"]
+        self.render_cache = images[self.render_obs_key].copy()
 
         obs = dict()
         for key in self.observation_space.keys():
-            obs[key] = obs_dict[key]
+            if key in images:
+                if self.obs_dtype == 'uint8':
+                    obs[key] = images[key].copy()
+                else:
+                    obs[key] = (images[key] / 255).transpose((2,0,1))
+            else:
+                obs[key] = np.array(raw_dict[key])
 
         return obs
 
+    def get_reset_state(self):
+        physics = self.env.physics
+        state = {
+            'physics': physics.get_state().copy(),
+            'ctrl': physics.data.ctrl.copy()
+        }
+        for key, value in vars(self.env.task).items():
+            if key.startswith('_'):
+                continue
+            if isinstance(value, (bool, int, float, np.ndarray)):
+                state['task/' + key] = np.array(value)
+        return state
+
+    def reset_to_state(self, state):
+        """
+        Same as dm_control's Environment.reset, with initialize_episode
+        replaced by restoring state.
+        """
+        env = self.env
+        env._reset_next_step = False
+        env._step_count = 0
+        with env.physics.reset_context():
+            env.physics.set_state(state['physics'])
+            np.copyto(env.physics.data.ctrl, state['ctrl'])
+        for key, value in state.items():
+            if key.startswith('task/'):
+                if value.ndim == 0:
+                    value = value.item()
+                setattr(env.task, key[len('task/'):], value)
+        observation = env.task.get_observation(env.physics)
+        return dm_env.restart(observation)
+
     def seed(self, seed=None):
         np.random.seed(seed=seed)
         self._seed = seed
@@ -101,7 +155,7 @@ class AlohaImageWrapper(gym.Env):
             # always reset to the same state
             # to be compatible with gym
             raw_obs = self.env.reset_to({'states': self.init_state})
-        elif self._seed is not None:
+        elif (self._seed is not None) and (self.reset_state_cache is None):
             # reset to a specific seed
             seed = self._seed
             if seed in self.seed_state_map:
@@ -115,6 +169,29 @@ class AlohaImageWrapper(gym.Env):
                 state = raw_obs.observation["env_state"]
                 self.seed_state_map[seed] = state
             self._seed = None
+        elif self._seed is not None:
+            # reset to a specific seed, restored from reset_state_cache
+            seed = self._seed
+            state = self.seed_state_map.get(seed)
+            if state is None:
+                state = self.reset_state_cache.get(seed)
+            if state is not None:
+                if not self.has_reset_before:
+                    # the env must be fully reset at least once to ensure correct rendering
+                    self.env.reset()
+                    self.has_reset_before = True
+                # env.reset is expensive, use cache
+                raw_obs = self.reset_to_state(state)
+                self.seed_state_map[seed] = state
+            else:
+                # box poses are sampled from numpy global random state
+                np.random.seed(seed=seed)
+                raw_obs = self.env.reset()
+                self.has_reset_before = True
+                state = self.get_reset_state()
+                self.seed_state_map[seed] = state
+                self.reset_state_cache.put(seed, state)
+            self._seed = None
         else:
             # random reset
             raw_obs = self.env.reset()
@@ -138,9 +215,8 @@ class AlohaImageWrapper(gym.Env):
     def render(self, mode='rgb_array'):
         if self.render_cache is None:
             raise RuntimeError('Must run reset or step before render.')
-        img = np.moveaxis(self.render_cache, 0, -1)
-        img = (img * 255).astype(np.uint8)
-        return img
+        # uint8 H,W,C
+        return self.render_cache
 
 
 def test():
@@ -11,7 +11,14 @@ class PushTImageEnv(PushTEnv):
             block_cog=None, 
             damping=None,
             render_size=96,
-            perturb=0.0):
+            perturb=0.0,
+            obs_dtype='float32'):
+        """
+        obs_dtype: float32 returns a C,H,W image in [0,1], uint8 returns 
+            the rendered H,W,C image.
+        """
+        assert obs_dtype in ('float32', 'uint8')
+        self.obs_dtype = obs_dtype
         super().__init__(
             legacy=legacy, 
             block_cog=block_cog,
@@ -20,13 +27,21 @@ class PushTImageEnv(PushTEnv):
             render_action=False,
             perturb=perturb)
         ws = self.window_size
-        self.observation_space = spaces.Dict({
-            'image': spaces.Box(
+        image_space = spaces.Box(
+            low=0,
+            high=1,
+            shape=(3,render_size,render_size),
+            dtype=np.float32
+        )
+        if obs_dtype == 'uint8':
+            image_space = spaces.Box(
                 low=0,
-                high=1,
-                shape=(3,render_size,render_size),
-                dtype=np.float32
-            ),
+                high=255,
+                shape=(render_size,render_size,3),
+                dtype=np.uint8
+            )
+        self.observation_space = spaces.Dict({
+            'image': image_space,
             'agent_pos': spaces.Box(
                 low=0,
                 high=ws,
@@ -40,7 +55,11 @@ class PushTImageEnv(PushTEnv):
         img = super()._render_frame(mode='rgb_array')
 
         agent_pos = np.array(self.agent.position)
-        img_obs = np.moveaxis(img.astype(np.float32) / 255, -1, 0)
+        if self.obs_dtype == 'uint8':
+            # img is drawn on below
+            img_obs = img.copy()
+        else:
+            img_obs = np.moveaxis(img.astype(np.float32) / 255, -1, 0)
         obs = {
             'image': img_obs,
             'agent_pos': agent_pos
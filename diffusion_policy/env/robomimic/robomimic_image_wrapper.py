@@ -5,6 +5,7 @@ import gym
 from gym import spaces
 from omegaconf import OmegaConf
 from robomimic.envs.env_robosuite import EnvRobosuite
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 
 class RobomimicImageWrapper(gym.Env):
     def __init__(self, 
@@ -12,9 +13,19 @@ class RobomimicImageWrapper(gym.Env):
         shape_meta: dict,
         init_state: Optional[np.ndarray]=None,
         render_obs_key='agentview_image',
+        obs_dtype='float32',
+        reset_state_cache: Optional[ResetStateCache]=None,
         ):
-
+        """
+        obs_dtype: float32 returns C,H,W images in [0,1], uint8 returns
+            H,W,C images in [0,255] (4x less to stack, send and copy to 
+            the GPU, the policy converts them on device).
+        reset_state_cache: persistent states of seeded resets, shared 
+            across processes and runs (seed_state_map is per process)
+        """
+        assert obs_dtype in ('float32', 'uint8')
         self.env = env
+        self.obs_dtype = obs_dtype
         self.render_obs_key = render_obs_key
         self.init_state = init_state
         self.seed_state_map = dict()
@@ -22,6 +33,7 @@ class RobomimicImageWrapper(gym.Env):
         self.shape_meta = shape_meta
         self.render_cache = None
         self.has_reset_before = False
+        self.reset_state_cache = reset_state_cache
         
         # setup spaces
         action_shape = shape_meta['action']['shape']
@@ -57,6 +69,14 @@ class RobomimicImageWrapper(gym.Env):
                 shape=shape,
                 dtype=np.float32
             )
+            if key.endswith('image') and (obs_dtype == 'uint8'):
+                c, h, w = shape
+                this_space = spaces.Box(
+                    low=0,
+                    high=255,
+                    shape=(h, w, c),
+                    dtype=np.uint8
+                )
             observation_space[key] = this_space
         self.observation_space = observation_space
         self.past_action = np.zeros(7)
@@ -72,6 +92,10 @@ class RobomimicImageWrapper(gym.Env):
         for key in self.observation_space.keys():
             if "past_act" == key:
                 obs[key] = self.past_action
+            elif key.endswith('image') and (self.obs_dtype == 'uint8'):
+                # robomimic already scaled to [0,1] C,H,W, exact inverse
+                obs[key] = np.round(np.moveaxis(raw_obs[key], 0, -1) * 255
+                    ).astype(np.uint8)
             else:
                 obs[key] = raw_obs[key]
         return obs
@@ -94,15 +118,27 @@ class RobomimicImageWrapper(gym.Env):
         elif self._seed is not None:
             # reset to a specific seed
             seed = self._seed
+            if (seed not in self.seed_state_map) \
+                    and (self.reset_state_cache is not None):
+                cached = self.reset_state_cache.get(seed)
+                if cached is not None:
+                    self.seed_state_map[seed] = cached['states']
             if seed in self.seed_state_map:
+                if not self.has_reset_before:
+                    # the env must be fully reset at least once to ensure correct rendering
+                    self.env.reset()
+                    self.has_reset_before = True
                 # env.reset is expensive, use cache
                 raw_obs = self.env.reset_to({'states': self.seed_state_map[seed]})
             else:
                 # robosuite's initializes all use numpy global random state
                 np.random.seed(seed=seed)
                 raw_obs = self.env.reset()
+                self.has_reset_before = True
                 state = self.env.get_state()['states']
                 self.seed_state_map[seed] = state
+                if self.reset_state_cache is not None:
+                    self.reset_state_cache.put(seed, {'states': state})
             self._seed = None
         else:
             # random reset
@@ -8,21 +8,42 @@ import tqdm
 import h5py
 import math
 import dill
+import hashlib
 import wandb.sdk.data_types.video as wv
+from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
 from diffusion_policy.gym_util.sync_vector_env import SyncVectorEnv
 from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, PinnedStagingBuffer
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.env.aloha.aloha_image_wrapper import AlohaImageWrapper
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.obs_utils as ObsUtils
 from diffusion_policy.env.aloha.sim_env import make_sim_env
+from diffusion_policy.env.aloha.constants import XML_DIR
 
 
+def get_aloha_sim_digest():
+    """
+    md5 of the sim assets (xml, meshes) and of the env code that sets
+    up an episode, cached reset states are invalid when any changes.
+    """
+    assets_dir = pathlib.Path(XML_DIR)
+    aloha_dir = assets_dir.parent
+    paths = sorted(p for p in assets_dir.iterdir() if p.is_file()) + [
+        aloha_dir / 'sim_env.py',
+        aloha_dir / 'env_utils.py',
+        aloha_dir / 'constants.py']
+    md5 = hashlib.md5()
+    for path in paths:
+        md5.update(path.name.encode('utf-8'))
+        md5.update(path.read_bytes())
+    return md5.hexdigest()
+
 
 class AlohaImageRunner(BaseImageRunner):
     """
@@ -51,9 +72,29 @@ class AlohaImageRunner(BaseImageRunner):
             abs_action=False,
             tqdm_interval_sec=5.0,
             n_envs=None,
-            perturbations=None
+            perturbations=None,
+            scheduling='chunked',
+            obs_dtype='float32',
+            vector_env='async',
+            egl_device_ids=None,
+            reset_state_cache_dir=None
         ):
+        """
+        scheduling: chunked runs n_envs inits in lockstep until all are done,
+            continuous starts the next pending init in an env slot as soon
+            as its episode is done (see run_continuous)
+        obs_dtype: image observations of the env wrappers, float32 C,H,W in 
+            [0,1] or uint8 H,W,C (converted by the policy on device)
+        vector_env: async runs each env in a spawned worker process,
+            sync steps all envs in this process
+        egl_device_ids: EGL devices assigned round robin to the async 
+            workers (MUJOCO_EGL_DEVICE_ID), None keeps the default device
+        reset_state_cache_dir: directory of the reset states of seeded
+            inits, shared across workers and eval runs (see ResetStateCache)
+        """
         super().__init__(output_dir)
+        assert scheduling in ('chunked', 'continuous')
+        assert vector_env in ('async', 'sync')
 
         if n_envs is None:
             n_envs = n_train + n_test
@@ -78,10 +119,18 @@ class AlohaImageRunner(BaseImageRunner):
         #     env_meta['env_kwargs']['controller_configs']['control_delta'] = False
         #     rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        reset_state_cache = None
+        if reset_state_cache_dir is not None:
+            reset_state_cache = ResetStateCache(reset_state_cache_dir,
+                ResetStateCache.make_namespace('aloha_' + task_name, {
+                    'task_name': task_name,
+                    'sim_digest': get_aloha_sim_digest()
+                }))
 
+        # env_fn is pickled into spawned workers, don't capture self
         def env_fn():
             aloha_env = make_sim_env(
-                task_name=self.task_name, 
+                task_name=task_name, 
             )
             return MultiStepWrapper(
                 VideoRecordingWrapper(
@@ -89,7 +138,9 @@ class AlohaImageRunner(BaseImageRunner):
                         env=aloha_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype,
+                        reset_state_cache=reset_state_cache
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -107,21 +158,17 @@ class AlohaImageRunner(BaseImageRunner):
                 max_episode_steps=max_steps
             )
         
-        # For each process the OpenGL context can only be initialized once
-        # Since AsyncVectorEnv uses fork to create worker process,
-        # a separate env_fn that does not create OpenGL context (enable_render=False)
-        # is needed to initialize spaces.
+        # Spaces only depend on shape_meta, the dummy env doesn't build
+        # the physics or a rendering context in the parent process.
         def dummy_env_fn():
-            aloha_env = make_sim_env(
-                    task_name=self.task_name, 
-                )
             return MultiStepWrapper(
                 VideoRecordingWrapper(
                     AlohaImageWrapper(
-                        env=aloha_env,
+                        env=None,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -201,8 +248,22 @@ class AlohaImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        # env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn, shared_memory=False)
-        env = SyncVectorEnv(env_fns)
+        if vector_env == 'async':
+            worker_env_vars = None
+            if egl_device_ids is not None:
+                egl_device_ids = list(egl_device_ids)
+                # dm_control creates the EGL display on import, the
+                # variables have to be set before the worker imports it
+                worker_env_vars = lambda idx: {
+                    'MUJOCO_GL': 'egl',
+                    'PYOPENGL_PLATFORM': 'egl',
+                    'MUJOCO_EGL_DEVICE_ID': egl_device_ids[idx % len(egl_device_ids)]
+                }
+            env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn,
+                context='spawn', double_buffer=True, pin_memory=True,
+                worker_env_vars=worker_env_vars)
+        else:
+            env = SyncVectorEnv(env_fns)
 
 
         self.env_meta = env_meta
@@ -220,12 +281,61 @@ class AlohaImageRunner(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        # strided/subset obs windows are gathered into pinned memory
+        self.obs_staging = PinnedStagingBuffer()
+        self.scheduling = scheduling
 
     def run(self, policy: BaseImagePolicy):
-        device = policy.device
-        dtype = policy.dtype
         env = self.env
         
+        n_inits = len(self.env_init_fn_dills)
+        if self.scheduling == 'continuous':
+            all_video_paths, all_rewards = self.run_continuous(policy)
+        else:
+            all_video_paths, all_rewards = self.run_chunked(policy)
+        # clear out video buffer
+        _ = env.reset()
+        
+        # log
+        max_rewards = collections.defaultdict(list)
+        log_data = dict()
+        # results reported in the paper are generated using the commented out line below
+        # which will only report and average metrics from first n_envs initial condition and seeds
+        # fortunately this won't invalidate our conclusion since
+        # 1. This bug only affects the variance of metrics, not their mean
+        # 2. All baseline methods are evaluated using the same code
+        # to completely reproduce reported numbers, uncomment this line:
+        # for i in range(len(self.env_fns)):
+        # and comment out this line
+        for i in range(n_inits):
+            seed = self.env_seeds[i]
+            prefix = self.env_prefixs[i]
+            max_reward = np.max(all_rewards[i])
+            max_rewards[prefix].append(max_reward)
+            log_data[prefix+f'sim_max_reward_{seed}'] = max_reward
+
+            # visualize sim
+            video_path = all_video_paths[i]
+            if video_path is not None:
+                sim_video = wandb.Video(video_path)
+                log_data[prefix+f'sim_video_{seed}'] = sim_video
+        
+        # log aggregate metrics
+        for prefix, value in max_rewards.items():
+            name = prefix+'mean_score'
+            value = np.mean(value)
+            log_data[name] = value
+
+        return log_data
+
+    def run_chunked(self, policy: BaseImagePolicy):
+        """
+        Inits are run in chunks of n_envs, each chunk steps until all its
+        envs are done.
+        """
+        device = policy.device
+        env = self.env
+
         # plan for rollout
         n_envs = len(self.env_fns)
         n_inits = len(self.env_init_fn_dills)
@@ -274,9 +384,7 @@ class AlohaImageRunner(BaseImageRunner):
                         :,-(self.n_obs_steps-1):].astype(np.float32)
                 
                 # device transfer
-                obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device="cuda"))
+                obs_dict = self.obs_staging.to_device(np_obs_dict, device)
 
                 # run policy
                 with torch.no_grad():
@@ -304,38 +412,78 @@ class AlohaImageRunner(BaseImageRunner):
             # collect data for this round
             all_video_paths[this_global_slice] = env.render()[this_local_slice]
             all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-        
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix+f'sim_max_reward_{seed}'] = max_reward
-
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix+f'sim_video_{seed}'] = sim_video
-        
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix+'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
-
-        return log_data
+        return all_video_paths, all_rewards
+
+    def run_continuous(self, policy: BaseImagePolicy):
+        """
+        Each env slot takes the next pending init as soon as its episode 
+        is done, the policy is called on the running slots only.
+        """
+        assert not self.past_action, "past_action requires chunked scheduling"
+        device = policy.device
+        env = self.env
+        n_envs = len(self.env_fns)
+        n_inits = len(self.env_init_fn_dills)
 
+        all_video_paths = [None] * n_inits
+        all_rewards = [None] * n_inits
+        # init index run by each slot, -1 if idle
+        slot_inits = np.full(n_envs, -1, dtype=np.int64)
+        next_init = 0
+        obs = None
+
+        def start_inits(slots):
+            nonlocal next_init, obs
+            slots = list(slots[:n_inits - next_init])
+            if len(slots) == 0:
+                return
+            inits = list(range(next_init, next_init + len(slots)))
+            env.call_each('run_dill_function', 
+                args_list=[(self.env_init_fn_dills[i],) for i in inits],
+                indices=slots)
+            obs = env.reset_each(slots)
+            slot_inits[slots] = inits
+            next_init += len(slots)
+
+        policy.reset()
+        start_inits(np.arange(n_envs))
+
+        env_name = self.env_meta['env_name']
+        pbar = tqdm.tqdm(total=n_inits, desc=f"Eval {env_name}Image continuous", 
+            leave=False, mininterval=self.tqdm_interval_sec)
+        while np.any(slot_inits >= 0):
+            active = np.nonzero(slot_inits >= 0)[0]
+            np_obs_dict = dict((key, value[:,self.subsample_frames-1::self.subsample_frames])
+                for key, value in obs.items())
+
+            # device transfer, only rows of running slots
+            obs_dict = self.obs_staging.to_device(np_obs_dict, device, 
+                indices=active)
+
+            # run policy
+            with torch.no_grad():
+                action_dict = policy.predict_action(obs_dict)
+            action = action_dict['action'].detach().to('cpu').numpy()
+            if not np.all(np.isfinite(action)):
+                print(action)
+                raise RuntimeError("Nan or Inf action")
+
+            # step env
+            obs, reward, done, info = env.step_each(action, list(active))
+
+            # collect finished episodes and refill their slots
+            finished = list(active[done])
+            if len(finished) == 0:
+                continue
+            video_paths = env.call_each('render', indices=finished)
+            rewards = env.call_each('get_attr', 
+                args_list=[('reward',)] * len(finished), indices=finished)
+            for slot, video_path, episode_rewards in zip(finished, video_paths, rewards):
+                init_idx = slot_inits[slot]
+                all_video_paths[init_idx] = video_path
+                all_rewards[init_idx] = episode_rewards
+                slot_inits[slot] = -1
+            pbar.update(len(finished))
+            start_inits(np.array(finished))
+        pbar.close()
+        return all_video_paths, all_rewards
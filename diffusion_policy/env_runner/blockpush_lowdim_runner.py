@@ -15,7 +15,7 @@ from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrap
 from gym.wrappers import FlattenObservation
 
 from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
 from diffusion_policy.env_runner.base_lowdim_runner import BaseLowdimRunner
 
 class BlockPushLowdimRunner(BaseLowdimRunner):
@@ -129,7 +129,8 @@ class BlockPushLowdimRunner(BaseLowdimRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns)
+        env = AsyncVectorEnv(env_fns,
+            double_buffer=True, pin_memory=True)
         # env = SyncVectorEnv(env_fns)
 
         self.env = env
@@ -189,19 +190,19 @@ class BlockPushLowdimRunner(BaseLowdimRunner):
             done = False
             while not done:
                 # create obs dict
-                if not self.obs_eef_target:
-                    obs[...,8:10] = 0
                 np_obs_dict = {
                     'obs': obs.astype(np.float32)
                 }
+                if not self.obs_eef_target:
+                    # obs is a read-only view of the env buffer
+                    np_obs_dict['obs'][...,8:10] = 0
                 if self.past_action and (past_action is not None):
                     # TODO: not tested
                     np_obs_dict['past_action'] = past_action[
                         :,-(self.n_obs_steps-1):].astype(np.float32)
                 # device transfer
                 obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                    lambda x: numpy_to_device(x, device))
 
                 # run policy
                 with torch.no_grad():
@@ -17,7 +17,7 @@ from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
 
 from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
 from diffusion_policy.env_runner.base_lowdim_runner import BaseLowdimRunner
 
 module_logger = logging.getLogger(__name__)
@@ -176,7 +176,8 @@ class KitchenLowdimRunner(BaseLowdimRunner):
             )
             return env
         
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn,
+            double_buffer=True, pin_memory=True)
         # env = SyncVectorEnv(env_fns)
 
         self.env = env
@@ -244,8 +245,7 @@ class KitchenLowdimRunner(BaseLowdimRunner):
                         :,-(self.n_obs_steps-1):].astype(np.float32)
                 # device transfer
                 obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                    lambda x: numpy_to_device(x, device))
 
                 # run policy
                 with torch.no_grad():
@@ -19,7 +19,7 @@ from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 
 # TODO: backwards-facing or just in general? could frame as delayed response
@@ -32,7 +32,7 @@ def motion_blur(x,severity):
     return np.stack(blur_clip, axis=1)
 
 def occlude(x, severity, period, start):
-    clip = np.asarray(x)
+    clip = np.array(x)
     for i in range(clip.shape[1]):
         # guarantee at least some good frames at start
         if (start + i + period - 3) % (period) < severity:
@@ -52,7 +52,7 @@ def frame_corruption(x,severity):
         hue=0.2          # Adjust hue by ±20%
     )
 
-    clip = np.asarray(x)
+    clip = np.array(x)
     for i in range(clip.shape[1]):
         selector = np.random.randint(severity)
         if selector == 0:
@@ -95,8 +95,15 @@ class PushTImageRunner(BaseImageRunner):
             n_envs=None,
             use_past_actions=False, # TODO: fix up
             perturbations: Optional[dict[str, float]]=None,
+            obs_dtype='float32',
         ):
+        """
+        obs_dtype: image observations of the env wrappers, float32 C,H,W in 
+            [0,1] or uint8 H,W,C (converted by the policy on device)
+        """
         super().__init__(output_dir)
+        assert (not perturbations) or (obs_dtype == 'float32'), \
+            "image perturbations expect float32 C,H,W observations"
         if n_envs is None:
             n_envs = n_train + n_test
 
@@ -126,6 +133,7 @@ class PushTImageRunner(BaseImageRunner):
                         legacy=legacy_test,
                         render_size=render_size,
                         perturb=block_move,
+                        obs_dtype=obs_dtype,
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -199,7 +207,8 @@ class PushTImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns)
+        env = AsyncVectorEnv(env_fns,
+            double_buffer=True, pin_memory=True)
 
         # test env
         # env.reset(seed=env_seeds)
@@ -316,8 +325,7 @@ class PushTImageRunner(BaseImageRunner):
                 batch_saved += 1
                 # device transfer
                 obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                    lambda x: numpy_to_device(x, device))
                 
                 # TODO: add a key for past rolled out actions
                 if len(act_hist) == obs_len - 1 and self.use_past_actions:
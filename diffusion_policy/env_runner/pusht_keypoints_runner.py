@@ -14,7 +14,7 @@ from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
 
 from diffusion_policy.policy.base_lowdim_policy import BaseLowdimPolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
 from diffusion_policy.env_runner.base_lowdim_runner import BaseLowdimRunner
 
 class PushTKeypointsRunner(BaseLowdimRunner):
@@ -133,7 +133,8 @@ class PushTKeypointsRunner(BaseLowdimRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns)
+        env = AsyncVectorEnv(env_fns,
+            double_buffer=True, pin_memory=True)
 
         # test env
         # env.reset(seed=env_seeds)
@@ -211,8 +212,7 @@ class PushTKeypointsRunner(BaseLowdimRunner):
                 
                 # device transfer
                 obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                    lambda x: numpy_to_device(x, device))
 
                 # run policy
                 with torch.no_grad():
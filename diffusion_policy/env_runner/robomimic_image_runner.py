@@ -17,14 +17,14 @@ from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrap
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.env_utils as EnvUtils
 import robomimic.utils.obs_utils as ObsUtils
-from hsic import batch_hsic
-from mlp_correlation import batch_mlp_corr
+from diffusion_policy.common.rollout_metrics import RolloutMetrics
 
 def create_env(env_meta, shape_meta, enable_render=True):
     modality_mapping = collections.defaultdict(list)
@@ -69,7 +69,21 @@ class RobomimicImageRunner(BaseImageRunner):
             n_samples=1,
             perturbations=None,
             save_dir=None,
+            hsic_num_features=None,
+            async_metrics=True,
+            obs_dtype='float32',
+            reset_state_cache_dir=None
         ):
+        """
+        hsic_num_features: compute the action HSIC with random Fourier 
+            features instead of the exact O(N^2) kernel
+        async_metrics: compute action metrics in a background worker,
+            they are logged after all chunks
+        obs_dtype: image observations of the env wrappers, float32 C,H,W in 
+            [0,1] or uint8 H,W,C (converted by the policy on device)
+        reset_state_cache_dir: directory of the reset states of seeded
+            inits, shared across workers and eval runs (see ResetStateCache)
+        """
         super().__init__(output_dir)
 
         if n_envs is None:
@@ -82,6 +96,8 @@ class RobomimicImageRunner(BaseImageRunner):
 
         self.save_dir = save_dir
         self.n_samples = n_samples
+        self.hsic_num_features = hsic_num_features
+        self.async_metrics = async_metrics
         # read from dataset
         env_meta = FileUtils.get_env_metadata_from_dataset(
             dataset_path)
@@ -93,6 +109,11 @@ class RobomimicImageRunner(BaseImageRunner):
             env_meta['env_kwargs']['controller_configs']['control_delta'] = False
             rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        reset_state_cache = None
+        if reset_state_cache_dir is not None:
+            reset_state_cache = ResetStateCache(reset_state_cache_dir,
+                ResetStateCache.make_namespace(env_meta['env_name'], env_meta))
+
         def env_fn():
             robomimic_env = create_env(
                 env_meta=env_meta, 
@@ -108,7 +129,9 @@ class RobomimicImageRunner(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype,
+                        reset_state_cache=reset_state_cache
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -142,7 +165,8 @@ class RobomimicImageRunner(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -222,7 +246,8 @@ class RobomimicImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn,
+            double_buffer=True, pin_memory=True)
         # env = SyncVectorEnv(env_fns)
 
         self.env_meta = env_meta
@@ -252,6 +277,12 @@ class RobomimicImageRunner(BaseImageRunner):
         n_inits = len(self.env_init_fn_dills)
         n_chunks = math.ceil(n_inits / n_envs)
 
+        # action hsic / mlp correlation of finished chunks
+        rollout_metrics = RolloutMetrics(
+            device=device,
+            hsic_num_features=self.hsic_num_features,
+            use_thread=self.async_metrics)
+
         # allocate data
         all_video_paths = [None] * n_inits
         all_rewards = [None] * n_inits
@@ -296,8 +327,7 @@ class RobomimicImageRunner(BaseImageRunner):
                 
                 # device transfer
                 obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device="cuda"))
+                    lambda x: numpy_to_device(x, "cuda"))
 
                 # run policy with sampling
                 sample_eff = 1 if (len(act_hist) < self.n_obs_steps - 1) else self.n_samples
@@ -377,19 +407,23 @@ class RobomimicImageRunner(BaseImageRunner):
             B, D1, D2, C = all_actions.shape  # Get dimensions dynamically
             all_actions = all_actions.reshape(B, D1 * D2, C)  # 
 
-            res = batch_hsic(torch.from_numpy(all_actions).cuda())
-
-            res = batch_hsic(torch.from_numpy(all_actions).cuda())
             print("all actions shape", all_actions.shape)
-            log_dict = {"hsic_pred_actions_full_traj_online_fixed":res.mean(), "mlp_corr_pred_actions_full_traj_online_fixed": batch_mlp_corr(all_actions)}
-            wandb.log(log_dict)
 
             pbar.close()
             # collect data for this round
             all_video_paths[this_global_slice] = env.render()[this_local_slice]
             all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
+
+            # metrics over the actions each init executed (one reward per 
+            # env step), not the actions predicted after it was done
+            rollout_metrics.submit([actions[:len(rewards)] for actions, rewards 
+                in zip(all_actions, all_rewards[this_global_slice])])
         # clear out video buffer
         _ = env.reset()
+
+        for log_dict in rollout_metrics.collect():
+            wandb.log(log_dict)
+        rollout_metrics.close()
         
         # log
         max_rewards = collections.defaultdict(list)
@@ -1,3 +1,4 @@
+from typing import Optional
 import os
 import wandb
 import numpy as np
@@ -8,6 +9,7 @@ import tqdm
 import h5py
 import math
 import dill
+import pickle
 import wandb.sdk.data_types.video as wv
 from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
 from diffusion_policy.gym_util.sync_vector_env import SyncVectorEnv
@@ -16,16 +18,17 @@ from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrap
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device, PinnedStagingBuffer
+from diffusion_policy.common.rollout_state import RolloutState
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.env_utils as EnvUtils
 import robomimic.utils.obs_utils as ObsUtils
 from math import ceil, floor
-from hsic import batch_hsic
 import wandb
-from mlp_correlation import batch_mlp_corr
+from diffusion_policy.common.rollout_metrics import RolloutMetrics
 
 def create_env(env_meta, shape_meta, enable_render=True):
     modality_mapping = collections.defaultdict(list)
@@ -45,9 +48,13 @@ def create_env(env_meta, shape_meta, enable_render=True):
 class MultimodalSquareWrapper(RobomimicImageWrapper):
     def __init__(self, 
         env: RobomimicImageWrapper,
+        reset_state_cache: Optional[ResetStateCache]=None,
         ):
-
+        """
+        reset_state_cache: sim state and target peg of seeded resets
+        """
         self.env = env
+        self.reset_state_cache = reset_state_cache
         # self.init_state = init_state
         self.seed_state_map = dict()
         self._seed = None
@@ -66,6 +73,7 @@ class MultimodalSquareWrapper(RobomimicImageWrapper):
     def reset(self):
         # state = self.env.get_state()['states'] 
 
+        # always drawn, keeps the global random stream of seeded resets
         nut_pos = np.random.uniform([-0.2, -0.2], [0, 0.2], size=(2))
 
         reset_state = np.array([ 0.        , -0.02921895,  0.17810908,  0.02728627, -2.63967499, \
@@ -79,19 +87,33 @@ class MultimodalSquareWrapper(RobomimicImageWrapper):
                     0.        ,  0.        ,  0.        ,  0.        ,  0.        ])  
 
         self.rew = 0
-        reset_state[10:12] = nut_pos
-        self.env.env.reset_to({"states": reset_state})
-        nut_pos = self.env.env.env.sim.data.body_xpos[self.env.env.env.obj_body_id['SquareNut']]
-        
-        peg_pos1 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg1_body_id])
-        
-        peg_pos2 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg2_body_id])
+        cached = None
+        seed = self._seed
+        self._seed = None
+        if (seed is not None) and (self.reset_state_cache is not None):
+            cached = self.reset_state_cache.get(seed)
+        if cached is not None:
+            self.env.env.reset_to({"states": cached['states']})
+            self.target_peg_id = int(cached['target_peg_id'])
+        else:
+            reset_state[10:12] = nut_pos
+            self.env.env.reset_to({"states": reset_state})
+            nut_pos = self.env.env.env.sim.data.body_xpos[self.env.env.env.obj_body_id['SquareNut']]
+            
+            peg_pos1 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg1_body_id])
+            
+            peg_pos2 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg2_body_id])
 
 
-        if np.linalg.norm(nut_pos - peg_pos1) < np.linalg.norm(nut_pos - peg_pos2):
-            self.target_peg_id = 1
-        else:
-            self.target_peg_id = 0
+            if np.linalg.norm(nut_pos - peg_pos1) < np.linalg.norm(nut_pos - peg_pos2):
+                self.target_peg_id = 1
+            else:
+                self.target_peg_id = 0
+            if (seed is not None) and (self.reset_state_cache is not None):
+                self.reset_state_cache.put(seed, {
+                    'states': self.env.env.get_state()['states'],
+                    'target_peg_id': np.array(self.target_peg_id)
+                })
 
         # return obs
         obs = self.get_observation()
@@ -154,7 +176,34 @@ class RobomimicImageRunner(BaseImageRunner):
             n_samples=1,
             perturbations=None,
             save_dir=None,
+            stream_obs_features=False,
+            obs_history=False,
+            hsic_num_features=None,
+            async_metrics=True,
+            scheduling='chunked',
+            obs_dtype='float32',
+            reset_state_cache_dir=None
         ):
+        """
+        stream_obs_features: only send the frames observed since the last
+            policy call and let the policy reuse the obs_encoder features of 
+            the rest of the window (see DiffusionTransformerHybridImagePolicy.set_obs_feature_buffer).
+        obs_history: workers only write new frames into a shared ring buffer
+            instead of shipping the stacked history (see AsyncVectorEnv),
+            only the frames used by the policy are gathered from it.
+        hsic_num_features: compute the action HSIC with random Fourier 
+            features instead of the exact O(N^2) kernel
+        async_metrics: compute action metrics in a background worker,
+            they are logged after all chunks
+        scheduling: chunked runs n_envs inits in lockstep until all are done,
+            continuous starts the next pending init in an env slot as soon
+            as its episode is done (see run_continuous)
+        obs_dtype: image observations of the env wrappers, float32 C,H,W in 
+            [0,1] or uint8 H,W,C (converted by the policy on device)
+        reset_state_cache_dir: directory of the reset states of seeded
+            inits, shared across workers and eval runs (see ResetStateCache)
+        """
+        assert scheduling in ('chunked', 'continuous')
         super().__init__(output_dir)
 
         if n_envs is None:
@@ -180,6 +229,14 @@ class RobomimicImageRunner(BaseImageRunner):
             env_meta['env_kwargs']['controller_configs']['control_delta'] = False
             rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        reset_state_cache = None
+        if reset_state_cache_dir is not None:
+            # MultimodalSquareWrapper states differ from seeded env.reset
+            # ones, don't share them with RobomimicImageRunner
+            reset_state_cache = ResetStateCache(reset_state_cache_dir,
+                ResetStateCache.make_namespace(
+                    'multimodal_square_' + env_meta['env_name'], env_meta))
+
         def env_fn():
             robomimic_env = create_env(
                 env_meta=env_meta, 
@@ -196,8 +253,10 @@ class RobomimicImageRunner(BaseImageRunner):
                             env=robomimic_env,
                             shape_meta=shape_meta,
                             init_state=None,
-                            render_obs_key=render_obs_key
-                        )
+                            render_obs_key=render_obs_key,
+                            obs_dtype=obs_dtype
+                        ),
+                        reset_state_cache=reset_state_cache
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -231,7 +290,8 @@ class RobomimicImageRunner(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -311,7 +371,9 @@ class RobomimicImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn, 
+            obs_history=obs_history, double_buffer=not obs_history, 
+            pin_memory=True)
         # env = SyncVectorEnv(env_fns)
 
 
@@ -330,16 +392,173 @@ class RobomimicImageRunner(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        # strided/subset obs windows are gathered into pinned memory
+        self.obs_staging = PinnedStagingBuffer()
+        self.stream_obs_features = stream_obs_features
+        self.obs_history = obs_history
+        self.hsic_num_features = hsic_num_features
+        self.async_metrics = async_metrics
+        self.scheduling = scheduling
+
+    def subsample_obs(self, x):
+        """
+        x: B,n_obs_steps*subsample_frames,* raw obs window
+        return: B,n_obs_steps,* frames seen by the policy
+        """
+        if self.subsampling_method == "uniform":
+            return x[:,self.subsample_frames-1::self.subsample_frames]
+        elif self.subsampling_method == "mixed":
+            sparse = x[:,self.subsample_frames-1::self.subsample_frames][:, -floor(self.n_obs_steps/2):]
+            dense = x[:,-self.subsample_frames:][:, - ceil(self.n_obs_steps/2):]
+            return np.concatenate([sparse, dense], axis=1)
+        else:
+            raise NotImplementedError
+
+    def get_policy_obs(self, obs):
+        """
+        obs: returned by env reset/step
+        return: frames seen by the policy, obs_history envs only 
+            gather those (see run)
+        """
+        if self.obs_history:
+            return dict(obs)
+        return dict((key, self.subsample_obs(value))
+            for key, value in obs.items())
+
+    def get_streaming_obs(self, obs, device, env_done=None, prev_env_done=None):
+        """
+        obs: returned by env reset/step (full windows after reset)
+        env_done, prev_env_done: per env done flags after/before the 
+            last env.step, None right after reset
+        return: list of (obs_dict, env_idxs) for 
+            policy.encode_obs_streaming, the frames each env appended 
+            since the last policy call
+        """
+        if env_done is None:
+            return [(dict_apply(dict(obs), lambda x: numpy_to_device(x, device)), None)]
+
+        n_frames = self.n_obs_steps * self.subsample_frames
+        n_new_frames = min(self.n_action_steps, n_frames)
+        result = list()
+        newly_done = np.nonzero(env_done & ~prev_env_done)[0]
+        if len(newly_done) > 0:
+            # done mid-chunk, these envs appended fewer frames than
+            # n_action_steps. Re-encode their full (final) window.
+            if self.obs_history:
+                full_obs = self.env.get_obs_history(indices=newly_done)
+            else:
+                full_obs = dict((key, value[newly_done]) 
+                    for key, value in obs.items())
+            result.append((
+                dict_apply(full_obs, lambda x: numpy_to_device(x, device)),
+                torch.from_numpy(newly_done).to(device)))
+        running = np.nonzero(~env_done)[0]
+        if len(running) > 0:
+            # running envs appended n_action_steps frames
+            new_obs = dict((key, value[:,-n_new_frames:]) 
+                for key, value in obs.items())
+            if len(running) == len(env_done):
+                result.append((self.obs_staging.to_device(new_obs, device), None))
+            else:
+                result.append((
+                    self.obs_staging.to_device(new_obs, device, indices=running),
+                    torch.from_numpy(running).to(device)))
+        # envs done before the last step appended no frames
+        return result
 
     def run(self, policy: BaseImagePolicy):
         device = policy.device
         dtype = policy.dtype
         env = self.env
         normalizer = policy.normalizer
+
+        n_frames = self.n_obs_steps * self.subsample_frames
+        frame_idxs = self.subsample_obs(np.arange(n_frames)[None])[0]
+        if self.stream_obs_features:
+            policy.set_obs_feature_buffer(n_frames=n_frames, frame_idxs=frame_idxs)
+        if self.obs_history:
+            if self.stream_obs_features:
+                # frames added by a step, full windows are gathered on reset
+                env.set_obs_frame_idxs(np.arange(n_frames)[-self.n_action_steps:])
+            else:
+                env.set_obs_frame_idxs(frame_idxs)
         
         # plan for rollout
         n_envs = len(self.env_fns)
         n_inits = len(self.env_init_fn_dills)
+
+        # executed actions used to select among samples, kept on device
+        rollout_state = RolloutState(
+            n_envs=n_envs, 
+            n_past_steps=self.n_obs_steps - 1, 
+            action_dim=policy.action_dim, 
+            device=device, dtype=dtype)
+        # action hsic / mlp correlation of finished chunks
+        rollout_metrics = RolloutMetrics(
+            device=device,
+            hsic_num_features=self.hsic_num_features,
+            use_thread=self.async_metrics)
+
+        if self.scheduling == 'continuous':
+            all_video_paths, all_rewards = self.run_continuous(
+                policy, rollout_state, rollout_metrics)
+        else:
+            all_video_paths, all_rewards = self.run_chunked(
+                policy, rollout_state, rollout_metrics)
+        # clear out video buffer
+        _ = env.reset()
+
+        for log_dict in rollout_metrics.collect():
+            wandb.log(log_dict)
+            print(log_dict)
+        rollout_metrics.close()
+        if self.stream_obs_features:
+            policy.set_obs_feature_buffer(None)
+        if self.obs_history:
+            env.set_obs_frame_idxs(None)
+        
+        # log
+        max_rewards = collections.defaultdict(list)
+        log_data = dict()
+        # results reported in the paper are generated using the commented out line below
+        # which will only report and average metrics from first n_envs initial condition and seeds
+        # fortunately this won't invalidate our conclusion since
+        # 1. This bug only affects the variance of metrics, not their mean
+        # 2. All baseline methods are evaluated using the same code
+        # to completely reproduce reported numbers, uncomment this line:
+        # for i in range(len(self.env_fns)):
+        # and comment out this line
+        for i in range(n_inits):
+            seed = self.env_seeds[i]
+            prefix = self.env_prefixs[i]
+            max_reward = np.max(all_rewards[i])
+            max_rewards[prefix].append(max_reward)
+            log_data[prefix+f'sim_max_reward_{seed}'] = max_reward
+
+            # visualize sim
+            video_path = all_video_paths[i]
+            if video_path is not None:
+                sim_video = wandb.Video(video_path)
+                log_data[prefix+f'sim_video_{seed}'] = sim_video
+        
+        # log aggregate metrics
+        for prefix, value in max_rewards.items():
+            name = prefix+'mean_score'
+            value = np.mean(value)
+            log_data[name] = value
+
+        return log_data
+
+    def run_chunked(self, policy: BaseImagePolicy, 
+            rollout_state: RolloutState, rollout_metrics: RolloutMetrics):
+        """
+        Inits are run in chunks of n_envs, each chunk steps until all its
+        envs are done.
+        """
+        device = policy.device
+        env = self.env
+        n_envs = len(self.env_fns)
+        n_inits = len(self.env_init_fn_dills)
         n_chunks = math.ceil(n_inits / n_envs)
 
         # allocate data
@@ -365,6 +584,8 @@ class RobomimicImageRunner(BaseImageRunner):
 
             # start rollout
             obs = env.reset()
+            if self.stream_obs_features and self.obs_history:
+                obs = env.get_obs_history()
             past_action = None
             policy.reset()
 
@@ -373,73 +594,50 @@ class RobomimicImageRunner(BaseImageRunner):
                 leave=False, mininterval=self.tqdm_interval_sec)
             
             done = False
+            env_done = None
+            prev_env_done = None
             all_actions = []
-            act_hist = collections.deque(maxlen=self.n_obs_steps - 1)
+            rollout_state.reset()
             while not done:
                 # create obs dict
-                np_obs_dict = dict(obs)
-
-                for key in np_obs_dict.keys():
-                    if self.subsampling_method == "uniform":
-                        np_obs_dict[key] = np_obs_dict[key][:,self.subsample_frames-1::self.subsample_frames]
-                    elif self.subsampling_method == "mixed":
-                        sparse = np_obs_dict[key][:,self.subsample_frames-1::self.subsample_frames][:, -floor(self.n_obs_steps/2):]
-                        dense = np_obs_dict[key][:,-self.subsample_frames:][:, - ceil(self.n_obs_steps/2):]
-                        np_obs_dict[key] = np.concatenate([sparse, dense], axis=1)
-                    else:
-                        raise NotImplementedError
+                stream_obs = None
+                if self.stream_obs_features:
+                    # policy only encodes frames it hasn't seen yet
+                    stream_obs = self.get_streaming_obs(obs, device, 
+                        env_done=env_done, prev_env_done=prev_env_done)
+                    np_obs_dict = dict()
+                else:
+                    np_obs_dict = self.get_policy_obs(obs)
                 if self.past_action and (past_action is not None):
                     # TODO: not tested
                     np_obs_dict['past_action'] = past_action[
                         :,-(self.n_obs_steps-1):].astype(np.float32)
                 
                 # device transfer
-                obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                obs_dict = self.obs_staging.to_device(np_obs_dict, device)
 
                 # run policy with sampling
-                sample_eff = 1 if (len(act_hist) < self.n_obs_steps - 1) else self.n_samples
+                past_action_tensor = None
+                sample_eff = 1
+                if rollout_state.is_full():
+                    # select the sample most consistent with executed actions
+                    past_action_tensor = rollout_state.get_past_actions()
+                    sample_eff = self.n_samples
 
-                obs_dict = dict_apply(obs_dict, lambda x: x.repeat((sample_eff,) + (1,) * (x.ndim - 1)))
                 with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict)
-
-                action_dict = dict_apply(action_dict,
-                        lambda x: x.view((sample_eff, x.shape[0] // sample_eff) + x.shape[1:]))
+                    if self.stream_obs_features:
+                        for this_obs_dict, env_idxs in stream_obs:
+                            cond = policy.encode_obs_streaming(
+                                this_obs_dict, env_idxs=env_idxs)
+                        action_dict = policy.predict_action(dict(), cond=cond, 
+                            num_samples=sample_eff, past_action=past_action_tensor)
+                    else:
+                        action_dict = policy.predict_action(obs_dict, 
+                            num_samples=sample_eff, past_action=past_action_tensor)
 
                 # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                    lambda x: x.detach().to('cpu').numpy())
-
-                sampled_actions = torch.tensor(np_action_dict['action_pred']).to(device)
-                selected_actions = None
-
-                if self.n_obs_steps > 1 and len(act_hist) == self.n_obs_steps - 1:
-                    with torch.no_grad():
-                        # Stack past actions (shape: [batch_size, n_obs_steps])
-                        past_action_tensor = torch.Tensor(np.concatenate(act_hist, axis=1)).to(device)
-                        past_action_tensor = normalizer['action'].normalize(past_action_tensor)
-
-                        # Extract the predicted past actions from sampled actions (shape: [n_samples, batch_size, n_obs_steps-1])
-                        sampled_past_preds = sampled_actions[:, :, :self.n_obs_steps - 1]
-                        past_action_preds = normalizer['action'].normalize(sampled_past_preds)
-
-                        # Compute MSEs for all samples and batches (shape: [n_samples, batch_size])
-                        mses = torch.nn.functional.mse_loss(
-                            past_action_preds, past_action_tensor.unsqueeze(0).expand(past_action_preds.shape), reduction="none"
-                        )  # Keep by sample and batch
-
-                        mses = mses.mean(dim=list(range(2, mses.ndim)))  # Mean over the time dimension (shape: [n_samples, batch_size])
-
-                        # Find the indices of the actions with minimum MSE per batch (shape: [batch_size])
-                        min_mses, min_mse_indices = torch.min(mses, dim=0)
-                        selected_actions = sampled_actions[min_mse_indices, torch.arange(sampled_actions.shape[1])]
-                
-                if selected_actions is not None:
-                    action = selected_actions.detach().cpu().numpy()[:, self.n_obs_steps - 1:self.n_obs_steps + self.n_action_steps - 1]
-                else:
-                    action = np_action_dict['action'][0]
+                rollout_state.append_actions(action_dict['action'])
+                action = rollout_state.to_host(action_dict['action'])
                 if not np.all(np.isfinite(action)):
                     print(action)
                     raise RuntimeError("Nan or Inf action")
@@ -448,15 +646,15 @@ class RobomimicImageRunner(BaseImageRunner):
                 
                 # step env
                 env_action = action
-                # deal with chunked actions
-                for i in range(env_action.shape[1]):
-                    act_hist.append(env_action[:, i:i+1])
-
                 if self.abs_action:
                     env_action = self.undo_transform_action(action)
 
                 obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
+                prev_env_done = env_done
+                if prev_env_done is None:
+                    prev_env_done = np.zeros(n_envs, dtype=bool)
+                env_done = np.asarray(done, dtype=bool)
+                done = np.all(env_done)
                 past_action = action
 
                 # update pbar
@@ -472,50 +670,141 @@ class RobomimicImageRunner(BaseImageRunner):
             B, D1, D2, C = all_actions.shape  # Get dimensions dynamically
             all_actions = all_actions.reshape(B, D1 * D2, C)  # 
 
-            res = batch_hsic(torch.from_numpy(all_actions).cuda())
             print("all actions shape", all_actions.shape)
-            log_dict = {"hsic_pred_actions_full_traj_online_fixed":res.mean(), "mlp_corr_pred_actions_full_traj_online_fixed": batch_mlp_corr(all_actions)}
-            wandb.log(log_dict)
-            print(log_dict)
             pbar.close()
 
             # collect data for this round
             all_video_paths[this_global_slice] = env.render()[this_local_slice]
             all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-        
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix+f'sim_max_reward_{seed}'] = max_reward
 
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix+f'sim_video_{seed}'] = sim_video
-        
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix+'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
+            # metrics over the actions each init executed (one reward per 
+            # env step), not the actions predicted after it was done
+            rollout_metrics.submit([actions[:len(rewards)] for actions, rewards 
+                in zip(all_actions, all_rewards[this_global_slice])])
+        return all_video_paths, all_rewards
+
+    def run_continuous(self, policy: BaseImagePolicy, 
+            rollout_state: RolloutState, rollout_metrics: RolloutMetrics):
+        """
+        Each env slot takes the next pending init as soon as its episode 
+        is done, the policy is called on the running slots only.
+        Action metrics are computed per group of n_envs consecutive inits
+        like chunks, over the actions each init executed.
+        """
+        assert not self.stream_obs_features, "stream_obs_features requires chunked scheduling"
+        assert not self.past_action, "past_action requires chunked scheduling"
+        device = policy.device
+        env = self.env
+        n_envs = len(self.env_fns)
+        n_inits = len(self.env_init_fn_dills)
+        n_groups = math.ceil(n_inits / n_envs)
 
-        return log_data
+        all_video_paths = [None] * n_inits
+        all_rewards = [None] * n_inits
+        init_actions = [list() for _ in range(n_inits)]
+        group_n_pending = [min(n_envs, n_inits - g * n_envs) for g in range(n_groups)]
+        # init index run by each slot, -1 if idle
+        slot_inits = np.full(n_envs, -1, dtype=np.int64)
+        next_init = 0
+        obs = None
+
+        def start_inits(slots):
+            nonlocal next_init, obs
+            slots = list(slots[:n_inits - next_init])
+            if len(slots) == 0:
+                return
+            inits = list(range(next_init, next_init + len(slots)))
+            env.call_each('run_dill_function', 
+                args_list=[(self.env_init_fn_dills[i],) for i in inits],
+                indices=slots)
+            obs = env.reset_each(slots)
+            slot_inits[slots] = inits
+            rollout_state.reset(slots)
+            next_init += len(slots)
+
+        def finish_group(group):
+            inits = range(group * n_envs, min(n_inits, (group + 1) * n_envs))
+            # n_calls_i, n_action_steps, Da per init
+            actions = [np.stack(init_actions[i]) for i in inits]
+            if self.save_dir:
+                # list of the predicted action chunks of each init
+                file_path = os.path.join(self.save_dir, f"init_{group}_actions.pkl")
+                with open(file_path, "wb") as f:
+                    pickle.dump(actions, f)
+            # one reward per executed env step
+            rollout_metrics.submit([x.reshape(-1, x.shape[-1])[:len(all_rewards[i])]
+                for x, i in zip(actions, inits)])
+            for i in inits:
+                init_actions[i] = None
+
+        policy.reset()
+        rollout_state.reset()
+        start_inits(np.arange(n_envs))
+
+        env_name = self.env_meta['env_name']
+        pbar = tqdm.tqdm(total=n_inits, desc=f"Eval {env_name}Image continuous", 
+            leave=False, mininterval=self.tqdm_interval_sec)
+        while np.any(slot_inits >= 0):
+            active = np.nonzero(slot_inits >= 0)[0]
+            active_idxs = torch.from_numpy(active).to(device)
+            np_obs_dict = self.get_policy_obs(obs)
+            obs_dict = self.obs_staging.to_device(np_obs_dict, device, 
+                indices=active)
+
+            # select the sample most consistent with executed actions,
+            # for slots with a full action history
+            past_action_tensor = None
+            past_action_mask = None
+            sample_eff = 1
+            filled = rollout_state.filled_mask()[active]
+            if np.any(filled):
+                past_action_tensor = rollout_state.get_past_actions()[active_idxs]
+                past_action_mask = torch.from_numpy(filled).to(device)
+                sample_eff = self.n_samples
+
+            with torch.no_grad():
+                action_dict = policy.predict_action(obs_dict, 
+                    num_samples=sample_eff, past_action=past_action_tensor,
+                    past_action_mask=past_action_mask)
+
+            # idle slots get zeros, they are reset before being reused
+            slot_action = torch.zeros((n_envs,) + action_dict['action'].shape[1:],
+                device=device, dtype=action_dict['action'].dtype)
+            slot_action[active_idxs] = action_dict['action']
+            rollout_state.append_actions(slot_action)
+            action = rollout_state.to_host(action_dict['action'])
+            if not np.all(np.isfinite(action)):
+                print(action)
+                raise RuntimeError("Nan or Inf action")
+            for i, slot in enumerate(active):
+                init_actions[slot_inits[slot]].append(action[i])
+
+            # step env
+            env_action = action
+            if self.abs_action:
+                env_action = self.undo_transform_action(action)
+            obs, reward, done, info = env.step_each(env_action, list(active))
+
+            # collect finished episodes and refill their slots
+            finished = list(active[done])
+            if len(finished) == 0:
+                continue
+            video_paths = env.call_each('render', indices=finished)
+            rewards = env.call_each('get_attr', 
+                args_list=[('reward',)] * len(finished), indices=finished)
+            for slot, video_path, episode_rewards in zip(finished, video_paths, rewards):
+                init_idx = slot_inits[slot]
+                all_video_paths[init_idx] = video_path
+                all_rewards[init_idx] = episode_rewards
+                slot_inits[slot] = -1
+                group = init_idx // n_envs
+                group_n_pending[group] -= 1
+                if group_n_pending[group] == 0:
+                    finish_group(group)
+            pbar.update(len(finished))
+            start_inits(np.array(finished))
+        pbar.close()
+        return all_video_paths, all_rewards
 
     def undo_transform_action(self, action):
         raw_shape = action.shape
@@ -1,3 +1,4 @@
+from typing import Optional
 import os
 import wandb
 import numpy as np
@@ -16,9 +17,10 @@ from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrap
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, PinnedStagingBuffer
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
+from diffusion_policy.common.reset_state_cache import ResetStateCache
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.env_utils as EnvUtils
 import robomimic.utils.obs_utils as ObsUtils
@@ -42,9 +44,13 @@ def create_env(env_meta, shape_meta, enable_render=True):
 class MultimodalSquareWrapper(RobomimicImageWrapper):
     def __init__(self, 
         env: RobomimicImageWrapper,
+        reset_state_cache: Optional[ResetStateCache]=None,
         ):
-
+        """
+        reset_state_cache: sim state and target peg of seeded resets
+        """
         self.env = env
+        self.reset_state_cache = reset_state_cache
         # self.init_state = init_state
         self.seed_state_map = dict()
         self._seed = None
@@ -63,6 +69,7 @@ class MultimodalSquareWrapper(RobomimicImageWrapper):
     def reset(self):
         # state = self.env.get_state()['states'] 
 
+        # always drawn, keeps the global random stream of seeded resets
         nut_pos = np.random.uniform([-0.2, -0.2], [0, 0.2], size=(2))
 
         reset_state = np.array([ 0.        , -0.02921895,  0.17810908,  0.02728627, -2.63967499, \
@@ -75,22 +82,34 @@ class MultimodalSquareWrapper(RobomimicImageWrapper):
                     0.        ,  0.        ,  0.        ,  0.        ,  0.        , \
                     0.        ,  0.        ,  0.        ,  0.        ,  0.        ])  
 
-
-        reset_state[10:12] = nut_pos
-        self.env.env.reset_to({"states": reset_state})
-        nut_pos = self.env.env.env.sim.data.body_xpos[self.env.env.env.obj_body_id['SquareNut']]
-        
-        peg_pos1 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg1_body_id])
-        
-        peg_pos2 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg2_body_id])
-
-
-        if np.linalg.norm(nut_pos - peg_pos1) < np.linalg.norm(nut_pos - peg_pos2):
-            self.target_peg_id = 1
+        cached = None
+        seed = self._seed
+        self._seed = None
+        if (seed is not None) and (self.reset_state_cache is not None):
+            cached = self.reset_state_cache.get(seed)
+        if cached is not None:
+            self.env.env.reset_to({"states": cached['states']})
+            self.target_peg_id = int(cached['target_peg_id'])
         else:
-            self.target_peg_id = 0
+            reset_state[10:12] = nut_pos
+            self.env.env.reset_to({"states": reset_state})
+            nut_pos = self.env.env.env.sim.data.body_xpos[self.env.env.env.obj_body_id['SquareNut']]
+            
+            peg_pos1 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg1_body_id])
+            
+            peg_pos2 = np.array(self.env.env.env.sim.data.body_xpos[self.env.env.env.peg2_body_id])
 
 
+            if np.linalg.norm(nut_pos - peg_pos1) < np.linalg.norm(nut_pos - peg_pos2):
+                self.target_peg_id = 1
+            else:
+                self.target_peg_id = 0
+            if (seed is not None) and (self.reset_state_cache is not None):
+                self.reset_state_cache.put(seed, {
+                    'states': self.env.env.get_state()['states'],
+                    'target_peg_id': np.array(self.target_peg_id)
+                })
+
         # return obs
         obs = self.get_observation()
         return obs
@@ -136,8 +155,16 @@ class RobomimicImageRunner(BaseImageRunner):
             abs_action=False,
             tqdm_interval_sec=5.0,
             n_envs=None,
-            perturbations=None
+            perturbations=None,
+            obs_dtype='float32',
+            reset_state_cache_dir=None
         ):
+        """
+        obs_dtype: image observations of the env wrappers, float32 C,H,W in 
+            [0,1] or uint8 H,W,C (converted by the policy on device)
+        reset_state_cache_dir: directory of the reset states of seeded
+            inits, shared across workers and eval runs (see ResetStateCache)
+        """
         super().__init__(output_dir)
 
         if n_envs is None:
@@ -160,6 +187,14 @@ class RobomimicImageRunner(BaseImageRunner):
             env_meta['env_kwargs']['controller_configs']['control_delta'] = False
             rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        reset_state_cache = None
+        if reset_state_cache_dir is not None:
+            # MultimodalSquareWrapper states differ from seeded env.reset
+            # ones, don't share them with RobomimicImageRunner
+            reset_state_cache = ResetStateCache(reset_state_cache_dir,
+                ResetStateCache.make_namespace(
+                    'multimodal_square_' + env_meta['env_name'], env_meta))
+
         def env_fn():
             robomimic_env = create_env(
                 env_meta=env_meta, 
@@ -176,8 +211,10 @@ class RobomimicImageRunner(BaseImageRunner):
                             env=robomimic_env,
                             shape_meta=shape_meta,
                             init_state=None,
-                            render_obs_key=render_obs_key
-                        )
+                            render_obs_key=render_obs_key,
+                            obs_dtype=obs_dtype
+                        ),
+                        reset_state_cache=reset_state_cache
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -211,7 +248,8 @@ class RobomimicImageRunner(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        obs_dtype=obs_dtype
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -291,7 +329,8 @@ class RobomimicImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn,
+            double_buffer=True, pin_memory=True)
         # env = SyncVectorEnv(env_fns)
 
 
@@ -310,6 +349,8 @@ class RobomimicImageRunner(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        # strided/subset obs windows are gathered into pinned memory
+        self.obs_staging = PinnedStagingBuffer()
 
     def run(self, policy: BaseImagePolicy):
         device = policy.device
@@ -364,9 +405,7 @@ class RobomimicImageRunner(BaseImageRunner):
                         :,-(self.n_obs_steps-1):].astype(np.float32)
                 
                 # device transfer
-                obs_dict = dict_apply(np_obs_dict, 
-                    lambda x: torch.from_numpy(x).to(
-                        device=device))
+                obs_dict = self.obs_staging.to_device(np_obs_dict, device)
 
                 # run policy
                 with torch.no_grad():
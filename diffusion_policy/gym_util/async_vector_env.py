@@ -2,11 +2,16 @@
 Back ported methods: call, set_attr from v0.26
 Disabled auto-reset after done
 Added render method.
+Added reset_each, step_each and call_each(indices=...) for a subset of envs.
+Added double buffered shared memory observations (double_buffer, pin_memory).
+Added per-worker environment variables (worker_env_vars).
 """
 
 
 import numpy as np
 import multiprocessing as mp
+import contextlib
+import os
 import time
 import sys
 from enum import Enum
@@ -20,6 +25,8 @@ from gym.error import (
     ClosedEnvironmentError,
     CustomSpaceError,
 )
+from collections import OrderedDict
+from gym.spaces import Box, Dict
 from gym.vector.utils import (
     create_shared_memory,
     create_empty_array,
@@ -75,6 +82,31 @@ class AsyncVectorEnv(VectorEnv):
         degree of flexibility and a high chance to shoot yourself in the foot; thus,
         if you are writing your own worker, it is recommended to start from the code
         for `_worker` (or `_worker_shared_memory`) method below, and add changes
+    obs_history : bool (default: `False`)
+        Requires `shared_memory=True` and `MultiStepWrapper` envs. The shared
+        observation buffer is used as a per-env ring buffer over the obs
+        history: workers only write the frames appended by each reset/step
+        (see `MultiStepWrapper.get_new_obs`) and the parent gathers the
+        ordered window from the ring, so the per-step IPC cost does not 
+        depend on `n_obs_steps`. `set_obs_frame_idxs` restricts the 
+        frames gathered by `reset`/`step` to those the caller uses,
+        `get_obs_history` gathers other frames on demand.
+    double_buffer : bool (default: `False`)
+        Requires `shared_memory=True`. Workers write into two shared 
+        observation buffers in turn and `reset`/`step` return a read-only 
+        view of the buffer just written instead of a copy (`copy` is 
+        ignored). The returned observations stay valid until the second 
+        following `reset`/`step`, i.e. while the next step is running.
+    pin_memory : bool (default: `False`)
+        Requires `shared_memory=True`. Page-lock the large shared 
+        observation arrays with cudaHostRegister, so that
+        `torch.from_numpy(obs).to(device, non_blocking=True)` is a direct
+        DMA. No-op without CUDA.
+    worker_env_vars : callable, optional
+        `worker_env_vars(index)` returns a dict of environment variables
+        set while starting worker `index`, e.g. to assign EGL devices.
+        Use `context="spawn"` for variables read at import time, since
+        forked workers inherit the modules imported by the parent.
     """
 
     def __init__(
@@ -88,11 +120,24 @@ class AsyncVectorEnv(VectorEnv):
         context=None,
         daemon=True,
         worker=None,
+        obs_history=False,
+        double_buffer=False,
+        pin_memory=False,
+        worker_env_vars=None,
     ):
         ctx = mp.get_context(context)
         self.env_fns = env_fns
         self.shared_memory = shared_memory
         self.copy = copy
+        self.obs_history = obs_history
+        self.double_buffer = double_buffer
+        if obs_history:
+            assert shared_memory, "obs_history requires shared_memory"
+        if double_buffer:
+            assert shared_memory, "double_buffer requires shared_memory"
+            assert not obs_history, "double_buffer and obs_history are exclusive"
+        if pin_memory:
+            assert shared_memory, "pin_memory requires shared_memory"
 
         # Added dummy_env_fn to fix OpenGL error in Mujoco
         # disable any OpenGL rendering in dummy_env_fn, since it
@@ -121,6 +166,18 @@ class AsyncVectorEnv(VectorEnv):
                 self.observations = read_from_shared_memory(
                     _obs_buffer, self.single_observation_space, n=self.num_envs
                 )
+                self._obs_arrays = [self.observations]
+                if self.double_buffer:
+                    _obs_buffer = (_obs_buffer, create_shared_memory(
+                        self.single_observation_space, n=self.num_envs, ctx=ctx
+                    ))
+                    self._obs_arrays.append(read_from_shared_memory(
+                        _obs_buffer[1], self.single_observation_space, n=self.num_envs
+                    ))
+                    # workers write to 1 - _obs_buffer_idx
+                    self._obs_views = [_readonly_view(x) for x in self._obs_arrays]
+                    self._obs_buffer_idx = 0
+                    self.observations = self._obs_views[0]
             except CustomSpaceError:
                 raise ValueError(
                     "Using `shared_memory=True` in `AsyncVectorEnv` "
@@ -136,9 +193,23 @@ class AsyncVectorEnv(VectorEnv):
                 self.single_observation_space, n=self.num_envs, fn=np.zeros
             )
 
+        worker_shared_memory = _obs_buffer
+        if self.obs_history:
+            # index of the oldest frame in each env's ring
+            _obs_heads = ctx.Array('q', self.num_envs, lock=False)
+            self._obs_ring = self.observations
+            self._obs_heads = np.frombuffer(_obs_heads, dtype=np.int64)
+            self._obs_history_len = _get_history_len(self.single_observation_space)
+            self._obs_frame_idxs = None
+            worker_shared_memory = (_obs_buffer, _obs_heads, self.num_envs)
+
         self.parent_pipes, self.processes = [], []
         self.error_queue = ctx.Queue()
         target = _worker_shared_memory if self.shared_memory else _worker
+        if self.obs_history:
+            target = _worker_obs_history
+        if self.double_buffer:
+            target = _worker_double_buffer
         target = worker or target
         with clear_mpi_env_vars():
             for idx, env_fn in enumerate(self.env_fns):
@@ -151,7 +222,7 @@ class AsyncVectorEnv(VectorEnv):
                         CloudpickleWrapper(env_fn),
                         child_pipe,
                         parent_pipe,
-                        _obs_buffer,
+                        worker_shared_memory,
                         self.error_queue,
                     ),
                 )
@@ -160,9 +231,19 @@ class AsyncVectorEnv(VectorEnv):
                 self.processes.append(process)
 
                 process.daemon = daemon
-                process.start()
+                env_vars = dict()
+                if worker_env_vars is not None:
+                    env_vars = worker_env_vars(idx)
+                with _set_env_vars(env_vars):
+                    process.start()
                 child_pipe.close()
 
+        # after fork, so CUDA is not initialized in the workers
+        self._pinned_ptrs = list()
+        if pin_memory:
+            self._pinned_ptrs = _pin_arrays(
+                [x for obs in self._obs_arrays for x in _iterate_arrays(obs)])
+
         self._state = AsyncState.DEFAULT
         self._check_observation_spaces()
 
@@ -195,8 +276,9 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
+        target = self._next_obs_buffer()
         for pipe in self.parent_pipes:
-            pipe.send(("reset", None))
+            pipe.send(("reset", target))
         self._state = AsyncState.WAITING_RESET
 
     def reset_wait(self, timeout=None):
@@ -233,6 +315,14 @@ class AsyncVectorEnv(VectorEnv):
             self.observations = concatenate(
                 results, self.observations, self.single_observation_space
             )
+        if self.obs_history:
+            # gathered window is already a fresh array
+            self.observations = self._gather_obs_history(
+                frame_idxs=self._obs_frame_idxs)
+            return self.observations
+        if self.double_buffer:
+            self._swap_obs_buffer()
+            return self.observations
 
         return deepcopy(self.observations) if self.copy else self.observations
 
@@ -251,8 +341,9 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
+        target = self._next_obs_buffer()
         for pipe, action in zip(self.parent_pipes, actions):
-            pipe.send(("step", action))
+            pipe.send(("step", action if target is None else (action, target)))
         self._state = AsyncState.WAITING_STEP
 
     def step_wait(self, timeout=None):
@@ -296,9 +387,19 @@ class AsyncVectorEnv(VectorEnv):
             self.observations = concatenate(
                 observations_list, self.observations, self.single_observation_space
             )
+        if self.obs_history:
+            # gathered window is already a fresh array
+            self.observations = self._gather_obs_history(
+                frame_idxs=self._obs_frame_idxs)
+            observations = self.observations
+        elif self.double_buffer:
+            self._swap_obs_buffer()
+            observations = self.observations
+        else:
+            observations = deepcopy(self.observations) if self.copy else self.observations
 
         return (
-            deepcopy(self.observations) if self.copy else self.observations,
+            observations,
             np.array(rewards),
             np.array(dones, dtype=np.bool_),
             infos,
@@ -345,14 +446,18 @@ class AsyncVectorEnv(VectorEnv):
                 pipe.close()
         for process in self.processes:
             process.join()
+        _unpin_arrays(self._pinned_ptrs)
+        self._pinned_ptrs = list()
 
-    def _poll(self, timeout=None):
+    def _poll(self, timeout=None, pipes=None):
         self._assert_is_running()
         if timeout is None:
             return True
+        if pipes is None:
+            pipes = self.parent_pipes
         end_time = time.perf_counter() + timeout
         delta = None
-        for pipe in self.parent_pipes:
+        for pipe in pipes:
             delta = max(end_time - time.perf_counter(), 0)
             if pipe is None:
                 return False
@@ -385,7 +490,7 @@ class AsyncVectorEnv(VectorEnv):
         if all(successes):
             return
 
-        num_errors = self.num_envs - sum(successes)
+        num_errors = len(successes) - sum(successes)
         assert num_errors > 0
         for _ in range(num_errors):
             index, exctype, value = self.error_queue.get()
@@ -475,8 +580,16 @@ class AsyncVectorEnv(VectorEnv):
     def call_each(self, name: str, 
             args_list: list=None, 
             kwargs_list: list=None, 
-            timeout = None):
-        n_envs = len(self.parent_pipes)
+            timeout = None,
+            indices: list=None):
+        """
+        indices: only call these envs, args_list and kwargs_list 
+            are per index then.
+        """
+        if indices is None:
+            indices = list(range(len(self.parent_pipes)))
+        pipes = [self.parent_pipes[i] for i in indices]
+        n_envs = len(indices)
         if args_list is None:
             args_list = [[]] * n_envs
         assert len(args_list) == n_envs
@@ -494,7 +607,7 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for i, pipe in enumerate(self.parent_pipes):
+        for i, pipe in enumerate(pipes):
             pipe.send(("_call", (name, args_list[i], kwargs_list[i])))
         self._state = AsyncState.WAITING_CALL
 
@@ -506,18 +619,91 @@ class AsyncVectorEnv(VectorEnv):
                 AsyncState.WAITING_CALL.value,
             )
 
-        if not self._poll(timeout):
+        if not self._poll(timeout, pipes=pipes):
             self._state = AsyncState.DEFAULT
             raise mp.TimeoutError(
                 f"The call to `call_wait` has timed out after {timeout} second(s)."
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
 
         return results
 
+    def reset_each(self, indices: list):
+        """
+        Reset only the envs in indices, the others keep their episode.
+        Returns observations of all envs.
+        """
+        self._assert_is_running()
+        if self._state != AsyncState.DEFAULT:
+            raise AlreadyPendingCallError(
+                "Calling `reset_each` while waiting "
+                f"for a pending call to `{self._state.value}` to complete.",
+                self._state.value,
+            )
+        pipes = [self.parent_pipes[i] for i in indices]
+        target = self._next_obs_buffer()
+        self._carry_obs(indices)
+        for pipe in pipes:
+            pipe.send(("reset", target))
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
+        self._raise_if_errors(successes)
+
+        if not self.shared_memory:
+            for i, observation in zip(indices, results):
+                _write_to_array(self.observations, i, observation)
+        if self.obs_history:
+            self.observations = self._gather_obs_history(
+                frame_idxs=self._obs_frame_idxs)
+            return self.observations
+        if self.double_buffer:
+            self._swap_obs_buffer()
+            return self.observations
+        return deepcopy(self.observations) if self.copy else self.observations
+
+    def step_each(self, actions, indices: list):
+        """
+        Step only the envs in indices with actions (len(indices), ...).
+        Returns observations of all envs and rewards, dones, infos 
+        of the stepped envs.
+        """
+        self._assert_is_running()
+        if self._state != AsyncState.DEFAULT:
+            raise AlreadyPendingCallError(
+                "Calling `step_each` while waiting "
+                f"for a pending call to `{self._state.value}` to complete.",
+                self._state.value,
+            )
+        pipes = [self.parent_pipes[i] for i in indices]
+        target = self._next_obs_buffer()
+        self._carry_obs(indices)
+        for pipe, action in zip(pipes, actions):
+            pipe.send(("step", action if target is None else (action, target)))
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
+        self._raise_if_errors(successes)
+        observations_list, rewards, dones, infos = zip(*results)
+
+        if not self.shared_memory:
+            for i, observation in zip(indices, observations_list):
+                _write_to_array(self.observations, i, observation)
+        if self.obs_history:
+            self.observations = self._gather_obs_history(
+                frame_idxs=self._obs_frame_idxs)
+            observations = self.observations
+        elif self.double_buffer:
+            self._swap_obs_buffer()
+            observations = self.observations
+        else:
+            observations = deepcopy(self.observations) if self.copy else self.observations
+        return (
+            observations,
+            np.array(rewards),
+            np.array(dones, dtype=np.bool_),
+            infos,
+        )
+
 
     def set_attr(self, name: str, values):
         """Sets an attribute of the sub-environments.
@@ -557,6 +743,194 @@ class AsyncVectorEnv(VectorEnv):
     def render(self, *args, **kwargs):
         return self.call('render', *args, **kwargs)
 
+    def _next_obs_buffer(self):
+        """
+        Index of the shared buffer workers write the next observations to,
+        None if not double buffered.
+        """
+        if not self.double_buffer:
+            return None
+        return 1 - self._obs_buffer_idx
+
+    def _swap_obs_buffer(self):
+        self._obs_buffer_idx = 1 - self._obs_buffer_idx
+        self.observations = self._obs_views[self._obs_buffer_idx]
+
+    def _carry_obs(self, indices):
+        """
+        Copy the current observations of the envs not in indices into the 
+        next buffer, since only the envs in indices will write to it.
+        """
+        if not self.double_buffer:
+            return
+        others = np.setdiff1d(np.arange(self.num_envs), indices)
+        if len(others) == 0:
+            return
+        _copy_rows(self._obs_arrays[self._next_obs_buffer()], 
+            self._obs_arrays[self._obs_buffer_idx], others)
+
+    def set_obs_frame_idxs(self, frame_idxs=None):
+        """
+        Positions in the obs window (0 is the oldest frame) returned by 
+        `reset`/`step`/`reset_each`/`step_each` with `obs_history`. 
+        `None` returns the whole window.
+        """
+        assert self.obs_history, "set_obs_frame_idxs requires obs_history"
+        if frame_idxs is not None:
+            frame_idxs = np.asarray(frame_idxs, dtype=np.int64)
+            assert frame_idxs.ndim == 1
+            assert np.all((frame_idxs >= 0) & (frame_idxs < self._obs_history_len))
+        self._obs_frame_idxs = frame_idxs
+
+    def get_obs_history(self, indices=None, frame_idxs=None):
+        """
+        Gather the obs window frames `frame_idxs` (default: all) of the 
+        envs `indices` (default: all) from the obs ring buffers.
+        """
+        assert self.obs_history, "get_obs_history requires obs_history"
+        self._assert_is_running()
+        if self._state != AsyncState.DEFAULT:
+            raise AlreadyPendingCallError(
+                "Calling `get_obs_history` while waiting "
+                "for a pending call to `{0}` to complete.".format(self._state.value),
+                self._state.value,
+            )
+        return self._gather_obs_history(indices=indices, frame_idxs=frame_idxs)
+
+    def _gather_obs_history(self, indices=None, frame_idxs=None):
+        """
+        Reorder the obs ring buffers into (num_envs, n_frames, ...) 
+        windows, oldest frame first. Only the frames at window positions 
+        frame_idxs are copied out of the ring.
+        """
+        n = self._obs_history_len
+        if frame_idxs is None:
+            frame_idxs = np.arange(n)
+        if indices is None:
+            indices = np.arange(self.num_envs)
+        env_idxs = np.asarray(indices)[:,None]
+        time_idxs = (self._obs_heads[env_idxs] + frame_idxs) % n
+        if isinstance(self._obs_ring, dict):
+            return OrderedDict([(key, value[env_idxs, time_idxs])
+                for key, value in self._obs_ring.items()])
+        return self._obs_ring[env_idxs, time_idxs]
+
+
+def _write_to_array(observations, index, observation):
+    """
+    Write a single env observation into the batched (non-shared) arrays.
+    """
+    if isinstance(observations, dict):
+        for key, value in observations.items():
+            _write_to_array(value, index, observation[key])
+    else:
+        observations[index] = observation
+
+
+@contextlib.contextmanager
+def _set_env_vars(env_vars):
+    """
+    Temporarily set environment variables, e.g. for a process start.
+    """
+    old_vars = dict((k, os.environ.get(k)) for k in env_vars.keys())
+    try:
+        for k, v in env_vars.items():
+            os.environ[k] = str(v)
+        yield
+    finally:
+        for k, v in old_vars.items():
+            if v is None:
+                del os.environ[k]
+            else:
+                os.environ[k] = v
+
+
+def _iterate_arrays(observations):
+    if isinstance(observations, dict):
+        for value in observations.values():
+            yield from _iterate_arrays(value)
+    elif isinstance(observations, tuple):
+        for value in observations:
+            yield from _iterate_arrays(value)
+    else:
+        yield observations
+
+
+def _readonly_view(observations):
+    if isinstance(observations, dict):
+        return OrderedDict([(key, _readonly_view(value))
+            for key, value in observations.items()])
+    elif isinstance(observations, tuple):
+        return tuple(_readonly_view(value) for value in observations)
+    view = observations.view()
+    view.flags.writeable = False
+    return view
+
+
+def _copy_rows(dst, src, rows):
+    for dst_array, src_array in zip(_iterate_arrays(dst), _iterate_arrays(src)):
+        dst_array[rows] = src_array[rows]
+
+
+def _pin_arrays(arrays, min_bytes=1<<20):
+    """
+    Page-lock arrays of at least min_bytes in place (small arrays may 
+    share pages, and don't gain from it). Returns the registered pointers.
+    """
+    import torch
+    if not torch.cuda.is_available():
+        return list()
+    cudart = torch.cuda.cudart()
+    ptrs = list()
+    for array in arrays:
+        if array.nbytes < min_bytes:
+            continue
+        ptr = array.ctypes.data
+        err = cudart.cudaHostRegister(ptr, array.nbytes, 0)
+        if err != cudart.cudaError.success:
+            logger.warn("cudaHostRegister failed for a shared observation "
+                "array of {0} bytes, it stays pageable.".format(array.nbytes))
+            continue
+        ptrs.append(ptr)
+    return ptrs
+
+
+def _unpin_arrays(ptrs):
+    if len(ptrs) == 0:
+        return
+    import torch
+    cudart = torch.cuda.cudart()
+    for ptr in ptrs:
+        cudart.cudaHostUnregister(ptr)
+
+
+def _get_history_len(space):
+    if isinstance(space, Dict):
+        lens = set(_get_history_len(x) for x in space.spaces.values())
+        assert len(lens) == 1, "obs_history requires equal n_obs_steps for all keys"
+        return lens.pop()
+    elif isinstance(space, Box):
+        return space.shape[0]
+    raise RuntimeError(f'Unsupported space type {type(space)}')
+
+
+def _write_obs_history(index, new_obs, obs_ring, obs_heads):
+    """
+    Write the newest frames (k,...) into env index's ring buffer.
+    """
+    if new_obs is None:
+        return
+    if isinstance(obs_ring, dict):
+        pairs = [(obs_ring[key], new_obs[key]) for key in obs_ring.keys()]
+    else:
+        pairs = [(obs_ring, new_obs)]
+    n = pairs[0][0].shape[1]
+    k = len(pairs[0][1])
+    pos = (obs_heads[index] + np.arange(k)) % n
+    for ring, value in pairs:
+        ring[index, pos] = value
+    obs_heads[index] = (obs_heads[index] + k) % n
+
 
 
 def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
@@ -612,27 +986,28 @@ def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
         env.close()
 
 
-def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
-    assert shared_memory is not None
-    env = env_fn()
+def _shared_memory_command_loop(index, env, pipe, error_queue, 
+        write_obs, get_action=None):
+    """
+    Command loop of the shared memory workers. Observations of reset and
+    step are written by write_obs(observation, data, is_reset) instead 
+    of being sent through the pipe. get_action: action from the data of
+    step, default data is the action.
+    """
     observation_space = env.observation_space
-    parent_pipe.close()
     try:
         while True:
             command, data = pipe.recv()
             if command == "reset":
                 observation = env.reset()
-                write_to_shared_memory(
-                    index, observation, shared_memory, observation_space
-                )
+                write_obs(observation, data, True)
                 pipe.send((None, True))
             elif command == "step":
-                observation, reward, done, info = env.step(data)
+                action = data if get_action is None else get_action(data)
+                observation, reward, done, info = env.step(action)
                 # if done:
                 #     observation = env.reset()
-                write_to_shared_memory(
-                    index, observation, shared_memory, observation_space
-                )
+                write_obs(observation, data, False)
                 pipe.send(((None, reward, done, info), True))
             elif command == "seed":
                 env.seed(data)
@@ -668,4 +1043,48 @@ def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error
         error_queue.put((index,) + sys.exc_info()[:2])
         pipe.send((None, False))
     finally:
-        env.close()
\ No newline at end of file
+        env.close()
+
+def _worker_shared_memory(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
+    assert shared_memory is not None
+    env = env_fn()
+    observation_space = env.observation_space
+    parent_pipe.close()
+
+    def write_obs(observation, data, is_reset):
+        write_to_shared_memory(
+            index, observation, shared_memory, observation_space
+        )
+    _shared_memory_command_loop(index, env, pipe, error_queue, write_obs)
+
+def _worker_double_buffer(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
+    assert shared_memory is not None
+    # data of reset is the buffer to write to, data of step (action, buffer)
+    env = env_fn()
+    observation_space = env.observation_space
+    parent_pipe.close()
+
+    def write_obs(observation, data, is_reset):
+        buffer_idx = data if is_reset else data[1]
+        write_to_shared_memory(
+            index, observation, shared_memory[buffer_idx], observation_space
+        )
+    _shared_memory_command_loop(index, env, pipe, error_queue, write_obs,
+        get_action=lambda data: data[0])
+
+def _worker_obs_history(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
+    assert shared_memory is not None
+    obs_buffer, obs_heads, num_envs = shared_memory
+    env = env_fn()
+    observation_space = env.observation_space
+    # only the newest frames are shipped, see MultiStepWrapper.get_new_obs
+    env.stack_obs = False
+    obs_ring = read_from_shared_memory(obs_buffer, observation_space, n=num_envs)
+    obs_heads = np.frombuffer(obs_heads, dtype=np.int64)
+    parent_pipe.close()
+
+    def write_obs(observation, data, is_reset):
+        if is_reset:
+            obs_heads[index] = 0
+        _write_obs_history(index, env.get_new_obs(), obs_ring, obs_heads)
+    _shared_memory_command_loop(index, env, pipe, error_queue, write_obs)
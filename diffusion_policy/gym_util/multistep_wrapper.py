@@ -70,8 +70,14 @@ class MultiStepWrapper(gym.Wrapper):
             n_obs_steps, 
             n_action_steps, 
             max_episode_steps=None,
-            reward_agg_method='max'
+            reward_agg_method='max',
+            stack_obs=True
         ):
+        """
+        stack_obs: if False, reset/step return None instead of stacking the 
+            obs history, use get_new_obs to fetch only the newest frames
+            (used by AsyncVectorEnv obs_history mode).
+        """
         super().__init__(env)
         self._action_space = repeated_space(env.action_space, n_action_steps)
         self._observation_space = repeated_space(env.observation_space, n_obs_steps)
@@ -80,8 +86,11 @@ class MultiStepWrapper(gym.Wrapper):
         self.n_action_steps = n_action_steps
         self.reward_agg_method = reward_agg_method
         self.n_obs_steps = n_obs_steps
+        self.stack_obs = stack_obs
 
         self.obs = deque(maxlen=n_obs_steps+1)
+        # number of obs appended by the last reset/step
+        self.n_new_obs = 0
         self.reward = list()
         self.done = list()
         self.info = defaultdict(lambda : deque(maxlen=n_obs_steps+1))
@@ -97,14 +106,19 @@ class MultiStepWrapper(gym.Wrapper):
         self.reward = list()
         self.done = list()
         self.info = defaultdict(lambda : deque(maxlen=self.n_obs_steps+1))
+        # the padded window is entirely new
+        self.n_new_obs = self.n_obs_steps
 
-        obs = self._get_obs(self.n_obs_steps)
+        obs = None
+        if self.stack_obs:
+            obs = self._get_obs(self.n_obs_steps)
         return obs
 
     def step(self, action):
         """
         actions: (n_action_steps,) + action_shape
         """
+        self.n_new_obs = 0
         for act in action:
             if len(self.done) > 0 and self.done[-1]:
                 # termination
@@ -112,6 +126,7 @@ class MultiStepWrapper(gym.Wrapper):
             observation, reward, done, info = super().step(act)
 
             self.obs.append(observation)
+            self.n_new_obs += 1
             self.reward.append(reward)
             if (self.max_episode_steps is not None) \
                 and (len(self.reward) >= self.max_episode_steps):
@@ -120,7 +135,9 @@ class MultiStepWrapper(gym.Wrapper):
             self.done.append(done)
             self._add_info(info)
 
-        observation = self._get_obs(self.n_obs_steps)
+        observation = None
+        if self.stack_obs:
+            observation = self._get_obs(self.n_obs_steps)
         reward = aggregate(self.reward, self.reward_agg_method)
         done = aggregate(self.done, 'max')
         info = dict_take_last_n(self.info, self.n_obs_steps)
@@ -144,6 +161,16 @@ class MultiStepWrapper(gym.Wrapper):
         else:
             raise RuntimeError('Unsupported space type')
 
+    def get_new_obs(self):
+        """
+        Output (n_new_obs,) + obs_shape, the obs appended by the last
+        reset/step (oldest first), None if nothing was appended.
+        """
+        n_new = min(self.n_new_obs, self.n_obs_steps)
+        if n_new == 0:
+            return None
+        return self._get_obs(n_new)
+
     def _add_info(self, info):
         for key, value in info.items():
             self.info[key].append(value)
@@ -4,6 +4,7 @@ from copy import deepcopy
 from gym import logger
 from gym.vector.vector_env import VectorEnv
 from gym.vector.utils import concatenate, create_empty_array
+from diffusion_policy.gym_util.async_vector_env import _write_to_array
 
 __all__ = ["SyncVectorEnv"]
 
@@ -133,8 +134,16 @@ class SyncVectorEnv(VectorEnv):
 
     def call_each(self, name: str, 
             args_list: list=None, 
-            kwargs_list: list=None):
-        n_envs = len(self.envs)
+            kwargs_list: list=None,
+            indices: list=None):
+        """
+        indices: only call these envs, args_list and kwargs_list 
+            are per index then.
+        """
+        if indices is None:
+            indices = list(range(len(self.envs)))
+        envs = [self.envs[i] for i in indices]
+        n_envs = len(envs)
         if args_list is None:
             args_list = [[]] * n_envs
         assert len(args_list) == n_envs
@@ -144,7 +153,7 @@ class SyncVectorEnv(VectorEnv):
         assert len(kwargs_list) == n_envs
 
         results = []
-        for i, env in enumerate(self.envs):
+        for i, env in enumerate(envs):
             function = getattr(env, name)
             if callable(function):
                 results.append(function(*args_list[i], **kwargs_list[i]))
@@ -153,6 +162,34 @@ class SyncVectorEnv(VectorEnv):
 
         return tuple(results)
 
+    def reset_each(self, indices: list):
+        """
+        Reset only the envs in indices, the others keep their episode.
+        Returns observations of all envs.
+        """
+        for i in indices:
+            self._dones[i] = False
+            _write_to_array(self.observations, i, self.envs[i].reset())
+        return deepcopy(self.observations) if self.copy else self.observations
+
+    def step_each(self, actions, indices: list):
+        """
+        Step only the envs in indices with actions (len(indices), ...).
+        Returns observations of all envs and rewards, dones, infos 
+        of the stepped envs.
+        """
+        infos = []
+        for i, action in zip(indices, actions):
+            observation, self._rewards[i], self._dones[i], info = self.envs[i].step(action)
+            _write_to_array(self.observations, i, observation)
+            infos.append(info)
+        return (
+            deepcopy(self.observations) if self.copy else self.observations,
+            self._rewards[indices],
+            self._dones[indices],
+            infos,
+        )
+
 
     def render(self, *args, **kwargs):
         return self.call('render', *args, **kwargs)
@@ -14,7 +14,8 @@ class EMAModel:
         inv_gamma=1.0,
         power=2 / 3,
         min_value=0.0,
-        max_value=0.9999
+        max_value=0.9999,
+        update_every=1
     ):
         """
         @crowsonkb's notes on EMA Warmup:
@@ -26,6 +27,8 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Average every N steps with the product of the N per-step
+                decays (the latest weights stand in for the skipped ones). Default: 1.
         """
 
         self.averaged_model = model
@@ -37,9 +40,15 @@ class EMAModel:
         self.power = power
         self.min_value = min_value
         self.max_value = max_value
+        self.update_every = update_every
 
         self.decay = 0.0
         self.optimization_step = 0
+        # decay accumulated since the last update
+        self.pending_decay = 1.0
+        # (ema_params, params) lists per device/dtype, built on first step
+        self.param_groups = None
+        self.copy_pairs = None
 
     def get_decay(self, optimization_step):
         """
@@ -54,35 +63,50 @@ class EMAModel:
         return max(self.min_value, min(value, self.max_value))
 
     @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
-
-        # old_all_dataptrs = set()
-        # for param in new_model.parameters():
-        #     data_ptr = param.data_ptr()
-        #     if data_ptr != 0:
-        #         old_all_dataptrs.add(data_ptr)
-
-        all_dataptrs = set()
-        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
+    def build_param_groups(self, new_model):
+        """
+        Pairs up parameters once. Frozen params are copied here and then
+        skipped, batchnorm params are copied every update, all others
+        are averaged with multi-tensor ops.
+        """
+        groups = dict()
+        copy_pairs = list()
+        for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):
             for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
                 # iterative over immediate parameters only.
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
-                
-                # data_ptr = param.data_ptr()
-                # if data_ptr != 0:
-                #     all_dataptrs.add(data_ptr)
 
-                if isinstance(module, _BatchNorm):
-                    # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                elif not param.requires_grad:
+                if not param.requires_grad:
+                    # frozen, e.g. obs_encoder_freeze
                     ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                elif isinstance(module, _BatchNorm):
+                    # skip batchnorms
+                    copy_pairs.append((ema_param, param))
                 else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
+                    key = (ema_param.device, ema_param.dtype)
+                    ema_params, params = groups.setdefault(key, (list(), list()))
+                    ema_params.append(ema_param)
+                    params.append(param)
+        self.param_groups = list(groups.values())
+        self.copy_pairs = copy_pairs
 
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
+    @torch.no_grad()
+    def step(self, new_model):
+        self.decay = self.get_decay(self.optimization_step)
+        self.pending_decay *= self.decay
         self.optimization_step += 1
+        if (self.optimization_step % self.update_every) != 0:
+            return
+
+        if self.param_groups is None:
+            self.build_param_groups(new_model)
+
+        decay = self.pending_decay
+        for ema_param, param in self.copy_pairs:
+            ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+        for ema_params, params in self.param_groups:
+            params = [p.data.to(dtype=e.dtype) for e, p in zip(ema_params, params)]
+            torch._foreach_mul_(ema_params, decay)
+            torch._foreach_add_(ema_params, params, alpha=1 - decay)
+        self.pending_decay = 1.0
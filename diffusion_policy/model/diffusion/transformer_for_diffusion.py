@@ -267,14 +267,36 @@ class TransformerForDiffusion(ModuleAttrMixin):
         )
         return optimizer
 
+    def get_obs_memory(self, cond: torch.Tensor):
+        """
+        Timestep-independent part of the condition memory, can be computed
+        once and passed to forward as obs_memory for every denoising step.
+        Only separable when the condition encoder is per-token (n_cond_layers == 0),
+        returns None otherwise.
+        cond: (B,To,cond_dim)
+        output: (B,To,n_emb)
+        """
+        if self.encoder_only or (not self.obs_as_cond) \
+                or (not isinstance(self.encoder, nn.Sequential)):
+            return None
+        cond_obs_emb = self.cond_obs_emb(cond)
+        tc = cond_obs_emb.shape[1]
+        # position 0 is the time token
+        position_embeddings = self.cond_pos_emb[:, 1:1+tc, :]
+        x = self.drop(cond_obs_emb + position_embeddings)
+        return self.encoder(x)
+
     def forward(self, 
         sample: torch.Tensor, 
         timestep: Union[torch.Tensor, float, int], 
-        cond: Optional[torch.Tensor]=None, **kwargs):
+        cond: Optional[torch.Tensor]=None, 
+        obs_memory: Optional[torch.Tensor]=None, **kwargs):
         """
         x: (B,T,input_dim)
         timestep: (B,) or int, diffusion step
         cond: (B,T',cond_dim)
+        obs_memory: (B,T',n_emb) optional output of get_obs_memory(cond),
+            cond is ignored when given
         output: (B,T,input_dim)
         """
         # 1. time
@@ -305,6 +327,28 @@ class TransformerForDiffusion(ModuleAttrMixin):
             # (B,T+1,n_emb)
             x = x[:,1:,:]
             # (B,T,n_emb)
+        elif obs_memory is not None:
+            # only the time token depends on the diffusion step
+            x = self.drop(time_emb + self.cond_pos_emb[:, :1, :])
+            x = self.encoder(x)
+            memory = torch.cat([x, obs_memory], dim=1)
+            # (B,T_cond,n_emb)
+
+            # decoder
+            token_embeddings = input_emb
+            t = token_embeddings.shape[1]
+            position_embeddings = self.pos_emb[
+                :, :t, :
+            ]  # each position maps to a (learnable) vector
+            x = self.drop(token_embeddings + position_embeddings)
+            # (B,T,n_emb)
+            x = self.decoder(
+                tgt=x,
+                memory=memory,
+                tgt_mask=self.mask,
+                memory_mask=self.memory_mask
+            )
+            # (B,T,n_emb)
         else:
             # encoder
             cond_embeddings = time_emb
@@ -381,6 +425,14 @@ def test():
     cond = torch.zeros((4,4,10))
     out = transformer(sample, timestep, cond)
 
+    # cached obs memory
+    transformer.eval()
+    cond = torch.randn((4,4,10))
+    obs_memory = transformer.get_obs_memory(cond)
+    out = transformer(sample, timestep, cond)
+    out_cached = transformer(sample, timestep, obs_memory=obs_memory)
+    assert torch.allclose(out, out_cached, atol=1e-5)
+
     # GPT with time embedding and obs cond and encoder
     transformer = TransformerForDiffusion(
         input_dim=16,
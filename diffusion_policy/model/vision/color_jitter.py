@@ -0,0 +1,105 @@
+import torch
+import torch.nn as nn
+
+
+def _get_range(value, center=1., bound=None):
+    if isinstance(value, (int, float)):
+        value = [center - value, center + value]
+        if bound is not None:
+            value[0] = max(value[0], bound)
+    return float(value[0]), float(value[1])
+
+
+def _blend(img1, img2, ratio):
+    return (ratio * img1 + (1. - ratio) * img2).clamp(0., 1.)
+
+
+def _rgb_to_grayscale(img):
+    r, g, b = img.unbind(dim=-3)
+    return (0.2989 * r + 0.587 * g + 0.114 * b).unsqueeze(dim=-3)
+
+
+def _rgb2hsv(img):
+    # same as torchvision.transforms.functional_tensor._rgb2hsv
+    r, g, b = img.unbind(dim=-3)
+    maxc = torch.max(img, dim=-3).values
+    minc = torch.min(img, dim=-3).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = (hr + hg + hb)
+    h = torch.fmod((h / 6.0 + 1.0), 1.0)
+    return torch.stack((h, s, maxc), dim=-3)
+
+
+def _hsv2rgb(img):
+    # same as torchvision.transforms.functional_tensor._hsv2rgb
+    h, s, v = img.unbind(dim=-3)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(dtype=torch.int32)
+    p = torch.clamp((v * (1.0 - s)), 0.0, 1.0)
+    q = torch.clamp((v * (1.0 - s * f)), 0.0, 1.0)
+    t = torch.clamp((v * (1.0 - s * (1.0 - f))), 0.0, 1.0)
+    i = i % 6
+    mask = i.unsqueeze(dim=-3) == torch.arange(6, device=i.device).view(-1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=-3)
+    a2 = torch.stack((t, v, v, q, p, p), dim=-3)
+    a3 = torch.stack((p, p, t, v, v, q), dim=-3)
+    a4 = torch.stack((a1, a2, a3), dim=-4)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=img.dtype), a4)
+
+
+class BatchColorJitter(nn.Module):
+    """
+    Batched torchvision ColorJitter for float images in [0,1].
+    Input (B,C,H,W) or (B,T,C,H,W), jitter factors are sampled per sample
+    and shared across T (like applying T.ColorJitter to each sequence),
+    the order of the 4 ops is sampled once per call.
+    """
+    def __init__(self,
+            brightness=0.2,
+            contrast=(0.8,1.2),
+            saturation=(0.8,1.2),
+            hue=0.05):
+        super().__init__()
+        self.brightness = _get_range(brightness, bound=0.)
+        self.contrast = _get_range(contrast, bound=0.)
+        self.saturation = _get_range(saturation, bound=0.)
+        self.hue = _get_range(hue, center=0.)
+        assert -0.5 <= self.hue[0] <= self.hue[1] <= 0.5
+
+    def _sample(self, value_range, B, device):
+        low, high = value_range
+        return torch.empty((B,1,1,1,1), device=device).uniform_(low, high)
+
+    def forward(self, x):
+        shape = x.shape
+        B = shape[0]
+        x = x.reshape(B, -1, *shape[-3:])
+
+        for fn_id in torch.randperm(4).tolist():
+            if fn_id == 0:
+                factor = self._sample(self.brightness, B, x.device)
+                x = _blend(x, torch.zeros_like(x), factor)
+            elif fn_id == 1:
+                factor = self._sample(self.contrast, B, x.device)
+                mean = torch.mean(_rgb_to_grayscale(x), dim=(-3,-2,-1), keepdim=True)
+                x = _blend(x, mean, factor)
+            elif fn_id == 2:
+                factor = self._sample(self.saturation, B, x.device)
+                x = _blend(x, _rgb_to_grayscale(x), factor)
+            elif fn_id == 3:
+                factor = self._sample(self.hue, B, x.device)
+                hsv = _rgb2hsv(x)
+                h = torch.remainder(hsv[...,0:1,:,:] + factor, 1.0)
+                x = _hsv2rgb(torch.cat([h, hsv[...,1:,:,:]], dim=-3))
+        return x.reshape(shape)
@@ -1,4 +1,6 @@
 from typing import Dict, Tuple, Optional
+import inspect
+import os
 import dill
 import math
 import pathlib
@@ -7,6 +9,8 @@ import torch.nn as nn
 import torch.nn.functional as F
 from einops import rearrange, reduce
 from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler
+from diffusers.schedulers.scheduling_dpmsolver_multistep import DPMSolverMultistepScheduler
 
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
@@ -18,7 +22,8 @@ from robomimic.algo.algo import PolicyAlgo
 import robomimic.utils.obs_utils as ObsUtils
 import robomimic.models.base_nets as rmbn
 import diffusion_policy.model.vision.crop_randomizer as dmvc
-from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules
+from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules, create_adamw, image_obs_to_chw
+from diffusion_policy.common.tensor_file import load_tensor_file
 import wandb
 import numpy as np
 
@@ -122,6 +127,9 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
                 obs_config['low_dim'].append(key)
             else:
                 raise RuntimeError(f"Unsupported obs type: {type}")
+        # uint8 H,W,C env images are converted to float C,H,W before normalization
+        self.rgb_shapes = dict((key, tuple(obs_key_shapes[key])) 
+            for key in obs_config['rgb'])
 
         # get raw robomimic config
         config = get_robomimic_config(
@@ -227,37 +235,186 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
         self.obs_as_cond = obs_as_cond
         self.pred_action_steps_only = pred_action_steps_only
         self.kwargs = kwargs
+        self.crop_shape = crop_shape
 
         if obs_encoder_dir:
             print(f"loading encoder from {obs_encoder_dir}")
             # obs_encoder_path = pathlib.Path(obs_encoder_dir)
-
-            payload = torch.load(open(obs_encoder_dir, "rb"), pickle_module=dill)
-            payload['state_dicts']['obs_encoder'] = {}
-            for key, value in payload['state_dicts']['model'].items():
-                if key.startswith("obs_encoder"):
-                    # split keys
-                    payload['state_dicts']['obs_encoder'][key[len('obs_encoder.'):]] = value
-            self.obs_encoder.load_state_dict(payload['state_dicts']['obs_encoder'], **kwargs)
+            tensor_path = obs_encoder_dir
+            if not tensor_path.endswith('.safetensors'):
+                tensor_path = obs_encoder_dir + '.model.safetensors'
+            if os.path.isfile(tensor_path):
+                # only read the obs_encoder.* tensors, see BaseWorkspace.save_checkpoint
+                obs_encoder_state_dict = load_tensor_file(
+                    tensor_path, prefix='obs_encoder.', strip_prefix=True)
+            else:
+                payload = torch.load(open(obs_encoder_dir, "rb"), pickle_module=dill)
+                obs_encoder_state_dict = {}
+                for key, value in payload['state_dicts']['model'].items():
+                    if key.startswith("obs_encoder"):
+                        # split keys
+                        obs_encoder_state_dict[key[len('obs_encoder.'):]] = value
+            self.obs_encoder.load_state_dict(obs_encoder_state_dict, **kwargs)
+        self.obs_encoder_freeze = obs_encoder_freeze
         if obs_encoder_freeze:
             print("freezing encoder")
             for param in self.obs_encoder.parameters():
                 param.requires_grad = False
+            # kept in eval mode, see train
+            self.obs_encoder.eval()
+        # per-frame features of the frozen encoder, see set_obs_feature_cache
+        self.obs_feature_cache = None
 
 
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        # scheduler used by conditional_sample, see set_inference_scheduler
+        self.inference_scheduler = noise_scheduler
+
+        # streaming obs encoding for rollouts, see set_obs_feature_buffer
+        self.obs_buffer_n_frames = None
+        self.obs_buffer_frame_idxs = None
+        self.obs_feature_buffer = None
+
+    # ========= inference scheduler  ============
+    def set_inference_scheduler(self, scheduler_type='ddpm', num_inference_steps=None):
+        """
+        Switch the scheduler used for sampling, the trained model is reused
+        (training keeps using noise_scheduler).
+        scheduler_type: ddpm, ddim or dpmsolver++
+        num_inference_steps: None keeps the current number of steps
+        """
+        config = self.noise_scheduler.config
+        scheduler_kwargs = dict(
+            num_train_timesteps=config.num_train_timesteps,
+            beta_start=config.beta_start,
+            beta_end=config.beta_end,
+            beta_schedule=config.beta_schedule,
+            prediction_type=config.prediction_type
+        )
+        if config.get('trained_betas', None) is not None:
+            scheduler_kwargs['trained_betas'] = config.trained_betas
+
+        if scheduler_type == 'ddpm':
+            scheduler = self.noise_scheduler
+        elif scheduler_type == 'ddim':
+            scheduler = DDIMScheduler(
+                clip_sample=config.clip_sample,
+                set_alpha_to_one=True,
+                steps_offset=0,
+                **scheduler_kwargs)
+        elif scheduler_type == 'dpmsolver++':
+            scheduler = DPMSolverMultistepScheduler(
+                solver_order=2,
+                algorithm_type='dpmsolver++',
+                **scheduler_kwargs)
+        else:
+            raise RuntimeError(f"Unsupported scheduler type: {scheduler_type}")
+
+        self.inference_scheduler = scheduler
+        if num_inference_steps is not None:
+            self.num_inference_steps = num_inference_steps
+
+    # ========= streaming obs encoding  ============
+    def set_obs_feature_buffer(self, n_frames=None, frame_idxs=None):
+        """
+        Enable (or disable with n_frames=None) streaming obs encoding.
+        The policy keeps the obs_encoder features of the last n_frames
+        raw frames of every env and builds cond from frame_idxs of that
+        window, so each call only has to encode the frames observed
+        since the previous call.
+        Exact as long as obs_encoder is deterministic per frame,
+        i.e. frozen or in eval mode (center / fixed crop).
+        """
+        self.obs_buffer_n_frames = n_frames
+        self.obs_buffer_frame_idxs = None
+        if frame_idxs is not None:
+            self.obs_buffer_frame_idxs = torch.as_tensor(
+                frame_idxs, dtype=torch.long, device=self.device)
+        self.obs_feature_buffer = None
+
+    def reset(self):
+        # drop cached features, the next call has to pass a full window
+        self.obs_feature_buffer = None
+
+    def encode_obs(self, obs_dict: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        obs_dict:
+            str: B,T,*
+        return: B,T,Do
+        """
+        obs_dict = image_obs_to_chw(obs_dict, self.rgb_shapes)
+        nobs = self.normalizer.normalize(obs_dict)
+        value = next(iter(nobs.values()))
+        B, T = value.shape[:2]
+        this_nobs = dict_apply(nobs, lambda x: x.reshape(-1,*x.shape[2:]))
+        nobs_features = self.obs_encoder(this_nobs)
+        return nobs_features.reshape(B, T, -1)
+
+    def encode_obs_streaming(self, obs_dict: Dict[str, torch.Tensor], 
+            env_idxs: Optional[torch.Tensor]=None) -> torch.Tensor:
+        """
+        obs_dict:
+            str: B',T_new,* frames observed since the last call by the
+            envs env_idxs (all envs if None). T_new == n_frames replaces
+            the whole window, required for all envs right after reset.
+        return: cond B,To,Do of all envs
+        """
+        assert self.obs_buffer_n_frames is not None
+        features = self.encode_obs(obs_dict)
+        if self.obs_feature_buffer is None:
+            assert env_idxs is None
+            assert features.shape[1] == self.obs_buffer_n_frames
+            buffer = features
+        else:
+            buffer = self.obs_feature_buffer
+            old_features = buffer if env_idxs is None else buffer[env_idxs]
+            new_features = torch.cat([old_features, features], dim=1)
+            new_features = new_features[:,-self.obs_buffer_n_frames:]
+            if env_idxs is None:
+                buffer = new_features
+            else:
+                buffer[env_idxs] = new_features
+        self.obs_feature_buffer = buffer
+        if self.obs_buffer_frame_idxs is None:
+            return buffer
+        return buffer[:,self.obs_buffer_frame_idxs]
     
     # ========= inference  ============
     def conditional_sample(self, 
             condition_data, condition_mask,
-            cond=None, generator=None, act=None,
+            cond=None, generator=None, act=None, num_samples=1,
             # keyword arguments to scheduler.step
             **kwargs
             ):
+        """
+        condition_data: num_samples*B,T,* (sample-major)
+        cond, act: B,*, shared by all num_samples samples of an input
+        """
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler = self.inference_scheduler
+
+        # not every scheduler takes the same step arguments (e.g. 
+        # DPMSolverMultistepScheduler is deterministic, no generator)
+        step_params = inspect.signature(scheduler.step).parameters
+        step_kwargs = dict((k, v) for k, v in kwargs.items() if k in step_params)
+        if 'generator' in step_params:
+            step_kwargs['generator'] = generator
+
+        # condition encoder memory doesn't depend on the diffusion step,
+        # compute it once per input and share it across samples
+        obs_memory = None
+        if cond is not None:
+            obs_memory = model.get_obs_memory(cond)
+
+        if num_samples > 1:
+            if cond is not None:
+                cond = cond.repeat(num_samples, 1, 1)
+            if obs_memory is not None:
+                obs_memory = obs_memory.repeat(num_samples, 1, 1)
+            if act is not None:
+                act = act.repeat(num_samples, 1, 1)
 
         trajectory = torch.randn(
             size=condition_data.shape, 
@@ -275,13 +432,12 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
                 trajectory[:,:act.shape[1]] = act   
 
             # 2. predict model output
-            model_output = model(trajectory, t, cond)
+            model_output = model(trajectory, t, cond, obs_memory=obs_memory)
 
             # 3. compute previous image: x_t -> x_t-1
             trajectory = scheduler.step(
                 model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
+                **step_kwargs
                 ).prev_sample
         
         # finally make sure conditioning is enforced
@@ -364,22 +520,42 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
         return cond
 
 
-    def predict_action(self, obs_dict: Dict[str, torch.Tensor], act_cond: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor], 
+            act_cond: Optional[torch.Tensor] = None,
+            cond: Optional[torch.Tensor] = None,
+            num_samples: int = 1,
+            past_action: Optional[torch.Tensor] = None,
+            past_action_mask: Optional[torch.Tensor] = None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
+        cond: optional precomputed B,To,Do obs features 
+            (e.g. from encode_obs_streaming), obs_dict is ignored then
+        num_samples: number of action samples drawn per input, observations
+            are encoded once and shared by all samples
+        past_action: optional B,n_past,Da executed actions, the sample whose
+            first n_past predicted actions are closest (normalized MSE) is 
+            returned, otherwise the first sample
+        past_action_mask: optional B bool, inputs whose past_action is valid,
+            the others use the first sample
         result: must include "action" key
         """
         assert 'past_action' not in obs_dict # not implemented yet
-        # normalize input
-        nobs = self.normalizer.normalize(obs_dict)
-        if "embedding" in obs_dict:
-            nobs["embedding"] = obs_dict["embedding"]
-        value = next(iter(nobs.values()))
-        B, To = value.shape[:2]
+        if cond is None:
+            # normalize input
+            obs_dict = image_obs_to_chw(obs_dict, self.rgb_shapes)
+            nobs = self.normalizer.normalize(obs_dict)
+            if "embedding" in obs_dict:
+                nobs["embedding"] = obs_dict["embedding"]
+            value = next(iter(nobs.values()))
+            B = value.shape[0]
+        else:
+            assert self.obs_as_cond
+            B = cond.shape[0]
         T = self.horizon
         Da = self.action_dim
         Do = self.obs_feature_dim
         To = self.n_obs_steps
+        k = num_samples
 
         # build input
         device = self.device
@@ -387,20 +563,21 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
 
 
         # handle different ways of passing observation
-        cond = None
         cond_data = None
         cond_mask = None
         if self.obs_as_cond:
-            if self.use_embed_if_present and "embedding" in obs_dict:
+            if cond is not None:
+                pass
+            elif self.use_embed_if_present and "embedding" in obs_dict:
                 cond = obs_dict["embedding"]
             else:
                 this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
                 nobs_features = self.obs_encoder(this_nobs)
                 # reshape back to B, To, Do
                 cond = nobs_features.reshape(B, To, -1)
-            shape = (B, T, Da)
+            shape = (k*B, T, Da)
             if self.pred_action_steps_only:
-                shape = (B, self.n_action_steps, Da)
+                shape = (k*B, self.n_action_steps, Da)
             cond_data = torch.zeros(size=shape, device=device, dtype=dtype)
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
         else:
@@ -409,10 +586,10 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             nobs_features = self.obs_encoder(this_nobs)
             # reshape back to B, To, Do
             nobs_features = nobs_features.reshape(B, To, -1)
-            shape = (B, T, Da+Do)
+            shape = (k*B, T, Da+Do)
             cond_data = torch.zeros(size=shape, device=device, dtype=dtype)
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
-            cond_data[:,:To,Da:] = nobs_features
+            cond_data[:,:To,Da:] = nobs_features.repeat(k, 1, 1)
             cond_mask[:,:To,Da:] = True
 
         if act_cond is not None:
@@ -424,10 +601,28 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             cond_mask,
             cond=cond,
             act=act_cond,
+            num_samples=k,
             **self.kwargs)
         
+        # k,B,T,Da
+        naction_pred = nsample[...,:Da].reshape(k, B, *nsample.shape[1:-1], Da)
+
+        # select one sample per input
+        sample_idx = torch.zeros(B, dtype=torch.long, device=device)
+        if (k > 1) and (past_action is not None):
+            assert not self.pred_action_steps_only
+            n_past = past_action.shape[1]
+            npast_action = self.normalizer['action'].normalize(past_action)
+            mses = torch.mean(
+                (naction_pred[:,:,:n_past] - npast_action[None]) ** 2, 
+                dim=(2,3))
+            sample_idx = torch.argmin(mses, dim=0)
+            if past_action_mask is not None:
+                sample_idx = torch.where(past_action_mask.to(device), 
+                    sample_idx, torch.zeros_like(sample_idx))
+        naction_pred = naction_pred[sample_idx, torch.arange(B, device=device)]
+
         # unnormalize prediction
-        naction_pred = nsample[...,:Da]
         action_pred = self.normalizer['action'].unnormalize(naction_pred)
 
         # get action
@@ -448,21 +643,70 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
 
+    def train(self, mode: bool=True):
+        super().train(mode)
+        if self.obs_encoder_freeze:
+            # frozen encoder: no dropout, fixed center crop, frozen norm stats
+            self.obs_encoder.eval()
+        return self
+
+    def set_obs_feature_cache(self, obs_feature_cache):
+        """
+        FrameFeatureCache used by compute_loss for batches with 'frame_idx'
+        (replay buffer rows of the obs frames). Requires obs_encoder_freeze.
+        """
+        assert (obs_feature_cache is None) or self.obs_encoder_freeze
+        self.obs_feature_cache = obs_feature_cache
+
+    def encode_nobs(self, this_nobs):
+        """
+        this_nobs: normalized, flattened B*T obs, return B*T,Do
+        """
+        if self.obs_encoder_freeze:
+            with torch.no_grad():
+                return self.obs_encoder(this_nobs)
+        return self.obs_encoder(this_nobs)
+
+    def encode_nobs_cached(self, this_nobs, frame_idx):
+        """
+        this_nobs: B*To flattened obs, frame_idx: (B*To,) replay buffer rows,
+        on host (see the workspace) so that the lookup needs no gpu sync.
+        Only frames missing from obs_feature_cache go through the encoder,
+        storing them syncs (first epoch only).
+        """
+        device = next(iter(this_nobs.values())).device
+        rows = frame_idx.cpu().numpy()
+        features, hit = self.obs_feature_cache.lookup(rows)
+        features = torch.from_numpy(features).to(
+            device=device, dtype=torch.float32, non_blocking=True)
+        miss = np.nonzero(~hit)[0]
+        if len(miss) > 0:
+            miss_idxs = torch.from_numpy(miss).to(device)
+            new_features = self.encode_nobs(
+                dict_apply(this_nobs, lambda x: x[miss_idxs])).float()
+            features[miss_idxs] = new_features
+            self.obs_feature_cache.store(rows[miss], new_features.cpu().numpy())
+        return features
+
     def get_optimizer(
             self, 
             transformer_weight_decay: float, 
             obs_encoder_weight_decay: float,
             learning_rate: float, 
-            betas: Tuple[float, float]
+            betas: Tuple[float, float],
+            fused: bool=False,
+            foreach: Optional[bool]=None
         ) -> torch.optim.Optimizer:
         optim_groups = self.model.get_optim_groups(
             weight_decay=transformer_weight_decay)
-        optim_groups.append({
-            "params": self.obs_encoder.parameters(),
-            "weight_decay": obs_encoder_weight_decay
-        })
-        optimizer = torch.optim.AdamW(
-            optim_groups, lr=learning_rate, betas=betas
+        if not self.obs_encoder_freeze:
+            optim_groups.append({
+                "params": self.obs_encoder.parameters(),
+                "weight_decay": obs_encoder_weight_decay
+            })
+        optimizer = create_adamw(
+            optim_groups, lr=learning_rate, betas=betas,
+            fused=fused, foreach=foreach
         )
         return optimizer
 
@@ -485,7 +729,11 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
             else:
                 this_nobs = dict_apply(nobs, 
                     lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-                nobs_features = self.obs_encoder(this_nobs)
+                if (self.obs_feature_cache is not None) and ('frame_idx' in batch):
+                    nobs_features = self.encode_nobs_cached(
+                        this_nobs, batch['frame_idx'][:,:To].reshape(-1))
+                else:
+                    nobs_features = self.encode_nobs(this_nobs)
                 # reshape back to B, T, Do
                 cond = nobs_features.reshape(batch_size, To, -1)
             if self.pred_action_steps_only:
@@ -495,7 +743,7 @@ class DiffusionTransformerHybridImagePolicy(BaseImagePolicy):
         else:
             # reshape B, T, ... to B*T
             this_nobs = dict_apply(nobs, lambda x: x.reshape(-1, *x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
+            nobs_features = self.encode_nobs(this_nobs)
             # reshape back to B, T, Do
             nobs_features = nobs_features.reshape(batch_size, horizon, -1)
             trajectory = torch.cat([nactions, nobs_features], dim=-1).detach()
@@ -18,7 +18,7 @@ from robomimic.algo.algo import PolicyAlgo
 import robomimic.utils.obs_utils as ObsUtils
 import robomimic.models.base_nets as rmbn
 import diffusion_policy.model.vision.crop_randomizer as dmvc
-from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules
+from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules, image_obs_to_chw
 
 
 class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
@@ -72,6 +72,9 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                 obs_config['low_dim'].append(key)
             else:
                 raise RuntimeError(f"Unsupported obs type: {type}")
+        # uint8 H,W,C env images are converted to float C,H,W before normalization
+        self.rgb_shapes = dict((key, tuple(obs_key_shapes[key])) 
+            for key in obs_config['rgb'])
 
         # get raw robomimic config
         config = get_robomimic_config(
@@ -245,6 +248,7 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         """
         assert 'past_action' not in obs_dict # not implemented yet
         # normalize input
+        obs_dict = image_obs_to_chw(obs_dict, self.rgb_shapes)
         nobs = self.normalizer.normalize(obs_dict)
         if "embedding" in obs_dict:
             nobs["embedding"] = obs_dict["embedding"]
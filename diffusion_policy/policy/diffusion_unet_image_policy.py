@@ -10,7 +10,7 @@ from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
 from diffusion_policy.model.vision.multi_image_obs_encoder import MultiImageObsEncoder
-from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.pytorch_util import dict_apply, image_obs_to_chw
 
 class DiffusionUnetImagePolicy(BaseImagePolicy):
     def __init__(self, 
@@ -73,6 +73,10 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
         self.n_action_steps = n_action_steps
         self.n_obs_steps = n_obs_steps
         self.obs_as_global_cond = obs_as_global_cond
+        # uint8 H,W,C env images are converted to float C,H,W before normalization
+        self.rgb_shapes = dict((key, tuple(attr['shape'])) 
+            for key, attr in shape_meta['obs'].items()
+            if attr.get('type', 'low_dim') == 'rgb')
         self.kwargs = kwargs
 
         if num_inference_steps is None:
@@ -127,6 +131,7 @@ class DiffusionUnetImagePolicy(BaseImagePolicy):
         """
         assert 'past_action' not in obs_dict # not implemented yet
         # normalize input
+        obs_dict = image_obs_to_chw(obs_dict, self.rgb_shapes)
         nobs = self.normalizer.normalize(obs_dict)
         value = next(iter(nobs.values()))
         B, To = value.shape[:2]
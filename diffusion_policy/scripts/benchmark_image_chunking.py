@@ -0,0 +1,99 @@
+"""
+Compare history-window read throughput of rgb storage layouts.
+
+Usage:
+python diffusion_policy/scripts/benchmark_image_chunking.py -i data/robomimic/datasets/square/ph/image_abs.hdf5.zarr.zip -l 1:jpeg2k -l 16:lz4 -l 16:zstd --n_obs_steps 16
+"""
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+
+import os
+import time
+import click
+import numpy as np
+import zarr
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.sampler import SequenceSampler
+from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs
+from diffusion_policy.dataset.robomimic_replay_image_dataset import (
+    _get_image_compressor, _get_obs_frame_idxs)
+
+register_codecs()
+
+@click.command()
+@click.option('--input', '-i', required=True, help='zarr cache, .zarr.zip or directory')
+@click.option('--layout', '-l', multiple=True, default=['1:jpeg2k', '16:lz4', '16:zstd', '64:lz4'],
+    help='chunk_length:compressor')
+@click.option('--keys', '-k', default=None, help='comma separated rgb keys, default all uint8 T,H,W,C arrays')
+@click.option('--n_obs_steps', default=16, type=int)
+@click.option('--subsample_frames', default=1, type=int)
+@click.option('--subsampling_method', default='uniform')
+@click.option('--n_samples', '-n', default=2000, type=int)
+@click.option('--seed', default=0, type=int)
+def main(input, layout, keys, n_obs_steps, subsample_frames, subsampling_method, n_samples, seed):
+    if input.endswith('.zip'):
+        src_store = zarr.ZipStore(os.path.expanduser(input), mode='r')
+    else:
+        src_store = zarr.DirectoryStore(os.path.expanduser(input))
+    src_data = zarr.group(src_store)['data']
+    if keys is None:
+        keys = [k for k, v in src_data.items()
+            if (v.dtype == np.uint8) and (len(v.shape) == 4)]
+    else:
+        keys = keys.split(',')
+    print(f"rgb keys: {keys}")
+
+    sequence_length = n_obs_steps * subsample_frames
+    frame_idxs = _get_obs_frame_idxs(n_obs_steps, subsample_frames, subsampling_method)
+
+    results = list()
+    for this_layout in layout:
+        chunk_length, compressor_name = this_layout.split(':')
+        chunk_length = int(chunk_length)
+        chunks = dict((k, (chunk_length,) + src_data[k].shape[1:]) for k in keys)
+        compressors = dict((k, _get_image_compressor(compressor_name)) for k in keys)
+
+        start = time.perf_counter()
+        replay_buffer = ReplayBuffer.copy_from_store(
+            src_store=src_store, store=zarr.MemoryStore(), keys=keys,
+            chunks=chunks, compressors=compressors)
+        convert_time = time.perf_counter() - start
+        nbytes = sum(replay_buffer.data[k].nbytes_stored for k in keys)
+
+        sampler = SequenceSampler(
+            replay_buffer=replay_buffer,
+            sequence_length=sequence_length,
+            pad_before=sequence_length-1,
+            pad_after=0,
+            keys=keys,
+            key_frame_idxs=dict((k, frame_idxs) for k in keys))
+        rng = np.random.default_rng(seed)
+        idxs = rng.integers(0, len(sampler), size=n_samples)
+        # warm up
+        for i in idxs[:10]:
+            sampler.sample_sequence(i)
+        start = time.perf_counter()
+        for i in idxs:
+            sampler.sample_sequence(i)
+        sample_time = time.perf_counter() - start
+
+        result = {
+            'layout': this_layout,
+            'samples_per_sec': n_samples / sample_time,
+            'stored_mb': nbytes / 1e6,
+            'convert_sec': convert_time
+        }
+        print(result)
+        results.append(result)
+
+    print(f"{'layout':<12} {'samples/s':>10} {'stored MB':>10}")
+    for r in results:
+        print(f"{r['layout']:<12} {r['samples_per_sec']:>10.1f} {r['stored_mb']:>10.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""
+Measure AsyncVectorEnv step latency (step + device transfer of the
+observations) for the observation return modes.
+
+Usage:
+python diffusion_policy/scripts/benchmark_vector_env_step.py --n_envs 28 --n_obs_steps 16 -m copy -m no_copy -m double_buffer -m double_buffer:pin
+"""
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+
+import time
+import json
+import click
+import numpy as np
+import torch
+import gym
+from gym import spaces
+from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+from diffusion_policy.common.pytorch_util import dict_apply, numpy_to_device
+
+
+class DummyImageEnv(gym.Env):
+    """
+    Stacked float32 image observations like MultiStepWrapper over
+    RobomimicImageWrapper, with a negligible step cost.
+    """
+    def __init__(self, n_obs_steps=16, n_cameras=2, shape=(3, 84, 84), action_dim=10):
+        obs_spaces = dict()
+        for i in range(n_cameras):
+            obs_spaces[f'camera{i}_image'] = spaces.Box(
+                low=0, high=1, shape=(n_obs_steps,) + tuple(shape), dtype=np.float32)
+        obs_spaces['robot0_eef_pos'] = spaces.Box(
+            low=-1, high=1, shape=(n_obs_steps, 3), dtype=np.float32)
+        self.observation_space = spaces.Dict(obs_spaces)
+        self.action_space = spaces.Box(
+            low=-1, high=1, shape=(action_dim,), dtype=np.float32)
+        self.obs = dict((key, np.zeros(space.shape, dtype=space.dtype))
+            for key, space in obs_spaces.items())
+        self.n_steps = 0
+
+    def reset(self):
+        self.n_steps = 0
+        return self.obs
+
+    def step(self, action):
+        self.n_steps += 1
+        # newest frame changes, like a stacked history
+        for value in self.obs.values():
+            value[:-1] = value[1:]
+            value[-1] = self.n_steps % 256 / 255
+        return self.obs, 0.0, False, dict()
+
+    def render(self, mode='rgb_array'):
+        return None
+
+
+def get_env_kwargs(mode):
+    if mode == 'copy':
+        return dict()
+    elif mode == 'no_copy':
+        return dict(copy=False)
+    elif mode == 'double_buffer':
+        return dict(double_buffer=True)
+    elif mode == 'double_buffer:pin':
+        return dict(double_buffer=True, pin_memory=True)
+    raise RuntimeError(f'Unsupported mode {mode}')
+
+
+@click.command()
+@click.option('-m', '--mode', multiple=True,
+    default=['copy', 'no_copy', 'double_buffer', 'double_buffer:pin'])
+@click.option('--n_envs', default=28, type=int)
+@click.option('--n_obs_steps', default=16, type=int)
+@click.option('--n_cameras', default=2, type=int)
+@click.option('--image_size', default=84, type=int)
+@click.option('--n_steps', '-n', default=200, type=int)
+@click.option('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+@click.option('--output', '-o', default=None, help='json file for the results')
+def main(mode, n_envs, n_obs_steps, n_cameras, image_size, n_steps, device, output):
+    device = torch.device(device)
+    shape = (3, image_size, image_size)
+    env_fn = lambda: DummyImageEnv(n_obs_steps=n_obs_steps,
+        n_cameras=n_cameras, shape=shape)
+    obs_mb = sum(np.prod(space.shape) * 4
+        for space in env_fn().observation_space.spaces.values()) * n_envs / 1e6
+    print(f"{n_envs} envs, {obs_mb:.1f} MB observations per step")
+
+    results = list()
+    for this_mode in mode:
+        env = AsyncVectorEnv([env_fn] * n_envs, **get_env_kwargs(this_mode))
+        action = np.zeros((n_envs,) + env.single_action_space.shape,
+            dtype=np.float32)
+        env.reset()
+        latencies = list()
+        for i in range(n_steps + 10):
+            start = time.perf_counter()
+            obs, _, _, _ = env.step(action)
+            obs_dict = dict_apply(obs, lambda x: numpy_to_device(x, device))
+            if device.type == 'cuda':
+                # the policy output syncs in the runners
+                torch.cuda.synchronize(device)
+            latencies.append(time.perf_counter() - start)
+        env.close()
+        del obs_dict
+        # drop warm up
+        latencies = np.array(latencies[10:]) * 1000
+        result = {
+            'mode': this_mode,
+            'mean_ms': float(latencies.mean()),
+            'p50_ms': float(np.percentile(latencies, 50)),
+            'p90_ms': float(np.percentile(latencies, 90))
+        }
+        print(result)
+        results.append(result)
+
+    print(f"{'mode':<20} {'mean ms':>8} {'p50 ms':>8} {'p90 ms':>8}")
+    for r in results:
+        print(f"{r['mode']:<20} {r['mean_ms']:>8.2f} {r['p50_ms']:>8.2f} {r['p90_ms']:>8.2f}")
+    if output is not None:
+        json.dump(results, open(output, 'w'), indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -8,6 +8,8 @@ from omegaconf import OmegaConf
 import dill
 import torch
 import threading
+import shutil
+from diffusion_policy.common.tensor_file import save_tensor_file as _save_tensor_file
 
 
 class BaseWorkspace:
@@ -19,6 +21,13 @@ class BaseWorkspace:
         self._output_dir = output_dir
         self._saving_thread = None
 
+    def __getstate__(self):
+        # background writer state is not part of a snapshot
+        state = self.__dict__.copy()
+        state['_saving_thread'] = None
+        state['_pinned_buffers'] = None
+        return state
+
     @property
     def output_dir(self):
         output_dir = self._output_dir
@@ -35,7 +44,16 @@ class BaseWorkspace:
     def save_checkpoint(self, path=None, tag='latest', 
             exclude_keys=None,
             include_keys=None,
-            use_thread=True):
+            use_thread=True,
+            save_tensor_file=False):
+        """
+        With use_thread, tensors are snapshotted into reusable pinned cpu 
+        buffers (non-blocking device copies) and serialized by a background
+        thread. The file is written to a temporary path and renamed, so 
+        path never holds a partial checkpoint.
+        save_tensor_file: also write the model weights to 
+            <path>.model.safetensors, see common.tensor_file.
+        """
         if path is None:
             path = pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
         else:
@@ -46,6 +64,11 @@ class BaseWorkspace:
             include_keys = tuple(self.include_keys) + ('_output_dir',)
 
         path.parent.mkdir(parents=False, exist_ok=True)
+        # pinned buffers are reused, previous save has to be done
+        self.wait_checkpoint()
+        if getattr(self, '_pinned_buffers', None) is None:
+            self._pinned_buffers = dict()
+
         payload = {
             'cfg': self.cfg,
             'state_dicts': dict(),
@@ -57,18 +80,67 @@ class BaseWorkspace:
                 # modules, optimizers and samplers etc
                 if key not in exclude_keys:
                     if use_thread:
-                        payload['state_dicts'][key] = _copy_to_cpu(value.state_dict())
+                        payload['state_dicts'][key] = _copy_to_cpu(
+                            value.state_dict(), self._pinned_buffers, (key,))
                     else:
                         payload['state_dicts'][key] = value.state_dict()
             elif key in include_keys:
                 payload['pickles'][key] = dill.dumps(value)
+
+        copy_done = None
+        if use_thread and torch.cuda.is_available():
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+
+        def write():
+            if copy_done is not None:
+                copy_done.synchronize()
+            if save_tensor_file and ('model' in payload['state_dicts']):
+                tensor_path = path.with_name(path.name + '.model.safetensors')
+                tmp_path = tensor_path.with_name(tensor_path.name + '.tmp')
+                _save_tensor_file(payload['state_dicts']['model'], str(tmp_path))
+                os.replace(tmp_path, tensor_path)
+            tmp_path = path.with_name(path.name + '.tmp')
+            with tmp_path.open('wb') as f:
+                torch.save(payload, f, pickle_module=dill)
+            os.replace(tmp_path, path)
+
         if use_thread:
-            self._saving_thread = threading.Thread(
-                target=lambda : torch.save(payload, path.open('wb'), pickle_module=dill))
+            self._saving_thread = threading.Thread(target=write)
             self._saving_thread.start()
         else:
-            torch.save(payload, path.open('wb'), pickle_module=dill)
+            write()
         return str(path.absolute())
+
+    def wait_checkpoint(self):
+        """
+        Block until the background checkpoint write is done.
+        """
+        if self._saving_thread is not None:
+            self._saving_thread.join()
+            self._saving_thread = None
+
+    def link_checkpoint(self, src, dst):
+        """
+        Make dst (e.g. a top-k path) refer to the checkpoint saved at src
+        without serializing it again: hard link, copy as fallback.
+        Later saves to src replace the file, dst keeps this version.
+        """
+        self.wait_checkpoint()
+        src = pathlib.Path(src)
+        dst = pathlib.Path(dst)
+        pairs = [(src, dst)]
+        tensor_src = src.with_name(src.name + '.model.safetensors')
+        if tensor_src.is_file():
+            pairs.append((tensor_src, dst.with_name(dst.name + '.model.safetensors')))
+        for this_src, this_dst in pairs:
+            if this_dst.exists():
+                this_dst.unlink()
+            try:
+                os.link(this_src, this_dst)
+            except OSError:
+                shutil.copyfile(this_src, this_dst)
+        return str(dst.absolute())
     
     def get_checkpoint_path(self, tag='latest'):
         return pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
@@ -131,15 +203,29 @@ class BaseWorkspace:
         return torch.load(open(path, 'rb'), pickle_module=dill)
 
 
-def _copy_to_cpu(x):
+def _copy_to_cpu(x, buffers=None, key=tuple()):
+    """
+    buffers: dict of cpu tensors reused across calls (pinned when cuda is
+        available), device tensors are copied with non_blocking and the
+        caller has to synchronize before reading them.
+    """
     if isinstance(x, torch.Tensor):
-        return x.detach().to('cpu')
+        x = x.detach()
+        if buffers is None:
+            return x.to('cpu')
+        buf = buffers.get(key)
+        if (buf is None) or (buf.shape != x.shape) or (buf.dtype != x.dtype):
+            buf = torch.empty(x.shape, dtype=x.dtype, 
+                pin_memory=torch.cuda.is_available())
+            buffers[key] = buf
+        buf.copy_(x, non_blocking=True)
+        return buf
     elif isinstance(x, dict):
         result = dict()
         for k, v in x.items():
-            result[k] = _copy_to_cpu(v)
+            result[k] = _copy_to_cpu(v, buffers, key + (k,))
         return result
     elif isinstance(x, list):
-        return [_copy_to_cpu(k) for k in x]
+        return [_copy_to_cpu(v, buffers, key + (i,)) for i, v in enumerate(x)]
     else:
         return copy.deepcopy(x)
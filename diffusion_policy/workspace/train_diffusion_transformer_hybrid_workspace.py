@@ -19,20 +19,26 @@ import wandb
 import tqdm
 import numpy as np
 import shutil
+import time
+import contextlib
 from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.policy.diffusion_transformer_hybrid_image_policy import DiffusionTransformerHybridImagePolicy
 from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.common.feature_cache import FrameFeatureCache, get_module_digest
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, create_dataloader
 from diffusion_policy.model.diffusion.ema_model import EMAModel
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
+from diffusion_policy.model.vision.color_jitter import BatchColorJitter
 from hsic import batch_hsic
 OmegaConf.register_new_resolver("eval", eval, replace=True)
 
 class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
     include_keys = ['global_step', 'epoch']
+    # loss scale is re-calibrated within a few steps after resuming
+    exclude_keys = ['grad_scaler']
 
     def __init__(self, cfg: OmegaConf, output_dir=None):
         super().__init__(cfg, output_dir=output_dir)
@@ -51,8 +57,17 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
             self.ema_model = copy.deepcopy(self.model)
 
         # configure training state
+        if cfg.optimizer.get('fused', False):
+            # fused AdamW checks that params are on cuda
+            self.model.to(cfg.training.device)
         self.optimizer = self.model.get_optimizer(**cfg.optimizer)
 
+        # loss scaling for fp16, no-op otherwise
+        mixed_precision = cfg.training.get('mixed_precision', None)
+        assert mixed_precision in (None, 'bf16', 'fp16')
+        self.grad_scaler = torch.cuda.amp.GradScaler(
+            enabled=(mixed_precision == 'fp16'))
+
         # configure training state
         self.global_step = 0
         self.epoch = 0
@@ -72,12 +87,27 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
         dataset = hydra.utils.instantiate(cfg.task.dataset)
         assert isinstance(dataset, BaseImageDataset)
         dataset.__getitem__(0)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        # frozen encoder: memoize per-frame features, keyed by replay buffer row
+        # features are of the original frames, color jitter is disabled
+        use_obs_feature_cache = cfg.training.get('obs_feature_cache', False) \
+            and self.model.obs_encoder_freeze \
+            and hasattr(dataset, 'return_frame_idx')
+        if use_obs_feature_cache:
+            print("obs_feature_cache enabled, training images are not color jittered")
+            dataset.return_frame_idx = True
+            self.model.set_obs_feature_cache(FrameFeatureCache(
+                cache_dir=os.path.join(self.output_dir, 'obs_feature_cache'),
+                n_frames=dataset.replay_buffer.n_steps,
+                feature_dim=self.model.obs_feature_dim,
+                crop_shape=self.model.crop_shape,
+                encoder_digest=get_module_digest(self.model.obs_encoder),
+                dataset_fingerprint=getattr(dataset, 'cache_fingerprint', None)))
+        train_dataloader = create_dataloader(dataset, **cfg.dataloader)
         normalizer = dataset.get_normalizer()
 
         # configure validation dataset
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
+        val_dataloader = create_dataloader(val_dataset, **cfg.val_dataloader)
 
         self.model.set_normalizer(normalizer)
         if cfg.training.use_ema:
@@ -135,6 +165,11 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
             }
         )
 
+        # opt-in dataset diagnostics, trains an MLP over all demo actions
+        if cfg.training.get('expert_action_corr', False) \
+                and hasattr(dataset, 'get_expert_action_corr'):
+            wandb_run.log({'expert_actions_corr': dataset.get_expert_action_corr()})
+
         # configure checkpoint
         topk_manager = TopKCheckpointManager(
             save_dir=os.path.join(self.output_dir, 'checkpoints'),
@@ -148,6 +183,50 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
             self.ema_model.to(device)
         optimizer_to(self.optimizer, device)
         
+        # uint8 images from the dataset are converted and augmented on GPU
+        image_aug = None
+        if getattr(dataset, 'gpu_image_aug', False):
+            image_aug = BatchColorJitter().to(device)
+
+        # autocast for forward and loss, optimizer and ema stay fp32
+        mixed_precision = cfg.training.get('mixed_precision', None)
+        def autocast():
+            if mixed_precision is None:
+                return contextlib.nullcontext()
+            dtype = torch.bfloat16 if mixed_precision == 'bf16' else torch.float16
+            return torch.autocast(device_type=device.type, dtype=dtype)
+        # train loss is accumulated on device and read every log_every steps
+        log_every = cfg.training.get('log_every', 1)
+
+        # raw validation batches kept in pinned host memory between epochs,
+        # only for a bounded validation set
+        cache_val_batches = cfg.training.get('cache_val_batches', False)
+        if cache_val_batches:
+            assert (cfg.training.max_val_steps is not None) \
+                or (cfg.task.dataset.get('val_max_samples', None) is not None), \
+                "cache_val_batches requires max_val_steps or val_max_samples"
+        val_batch_cache = None
+
+        def batch_to_device(batch):
+            # frame_idx stays on host, the feature cache reads it without a gpu sync
+            frame_idx = batch.get('frame_idx', None)
+            batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+            if frame_idx is not None:
+                batch['frame_idx'] = frame_idx
+            return batch
+
+        def process_image_obs(batch, augment):
+            if image_aug is None:
+                return batch
+            for key in dataset.rgb_keys:
+                if key not in batch['obs']:
+                    continue
+                x = batch['obs'][key].to(torch.float32) / 255.
+                if augment:
+                    x = image_aug(x)
+                batch['obs'][key] = x
+            return batch
+
         # save batch for sampling
         train_sampling_batch = None
 
@@ -158,24 +237,32 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
             for local_epoch_idx in range(cfg.training.num_epochs):
                 step_log = dict()
                 # ========= train for this epoch ==========
-                train_losses = list()
+                epoch_loss_sum = torch.zeros((), device=device)
+                log_loss_sum = torch.zeros((), device=device)
+                n_epoch_steps = 0
+                n_log_steps = 0
+                log_start_time = time.perf_counter()
                 with tqdm.tqdm(train_dataloader, desc=f"Training epoch {self.epoch}", 
                         leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
                     for batch_idx, batch in enumerate(tepoch):
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = batch_to_device(batch)
+                        batch = process_image_obs(batch, 
+                            augment=not use_obs_feature_cache)
                         if train_sampling_batch is None:
                             train_sampling_batch = batch
                         
                         # compute loss
-                        raw_loss = self.model.compute_loss(batch, debug)
+                        with autocast():
+                            raw_loss = self.model.compute_loss(batch, debug)
                         debug = False
                         loss = raw_loss / cfg.training.gradient_accumulate_every
-                        loss.backward()
+                        self.grad_scaler.scale(loss).backward()
 
                         # step optimizer
                         if self.global_step % cfg.training.gradient_accumulate_every == 0:
-                            self.optimizer.step()
+                            self.grad_scaler.step(self.optimizer)
+                            self.grad_scaler.update()
                             self.optimizer.zero_grad()
                             lr_scheduler.step()
                         
@@ -184,15 +271,26 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                             ema.step(self.model)
 
                         # logging
-                        raw_loss_cpu = raw_loss.item()
-                        tepoch.set_postfix(loss=raw_loss_cpu, refresh=False)
-                        train_losses.append(raw_loss_cpu)
+                        raw_loss = raw_loss.detach().float()
+                        epoch_loss_sum += raw_loss
+                        log_loss_sum += raw_loss
+                        n_epoch_steps += 1
+                        n_log_steps += 1
                         step_log = {
-                            'train_loss': raw_loss_cpu,
                             'global_step': self.global_step,
                             'epoch': self.epoch,
                             'lr': lr_scheduler.get_last_lr()[0]
                         }
+                        if n_log_steps >= log_every:
+                            # only gpu sync of the training step
+                            train_loss = (log_loss_sum / n_log_steps).item()
+                            now = time.perf_counter()
+                            step_log['train_loss'] = train_loss
+                            step_log['steps_per_sec'] = n_log_steps / (now - log_start_time)
+                            tepoch.set_postfix(loss=train_loss, refresh=False)
+                            log_loss_sum.zero_()
+                            n_log_steps = 0
+                            log_start_time = now
 
                         is_last_batch = (batch_idx == (len(train_dataloader)-1))
                         if not is_last_batch:
@@ -207,7 +305,7 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
 
                 # at the end of each epoch
                 # replace train_loss with epoch average
-                train_loss = np.mean(train_losses)
+                train_loss = (epoch_loss_sum / max(n_epoch_steps, 1)).item()
                 step_log['train_loss'] = train_loss
 
                 # ========= eval for this epoch ==========
@@ -226,15 +324,27 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                 if (self.epoch % cfg.training.val_every) == 0:
                     with torch.no_grad():
                         val_losses = list()
-                        with tqdm.tqdm(val_dataloader, desc=f"Validation epoch {self.epoch}", 
+                        # reuse host batches of the first validation run
+                        from_cache = cache_val_batches and (val_batch_cache is not None)
+                        val_batches = val_batch_cache if from_cache else val_dataloader
+                        new_val_batch_cache = list()
+                        with tqdm.tqdm(val_batches, desc=f"Validation epoch {self.epoch}", 
                                 leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
                             for batch_idx, batch in enumerate(tepoch):
-                                batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
-                                loss = self.model.compute_loss(batch)
-                                val_losses.append(loss)
+                                if cache_val_batches and (not from_cache):
+                                    if device.type == 'cuda':
+                                        batch = dict_apply(batch, lambda x: x.pin_memory())
+                                    new_val_batch_cache.append(batch)
+                                batch = batch_to_device(batch)
+                                batch = process_image_obs(batch, augment=False)
+                                with autocast():
+                                    loss = self.model.compute_loss(batch)
+                                val_losses.append(loss.float())
                                 if (cfg.training.max_val_steps is not None) \
                                     and batch_idx >= (cfg.training.max_val_steps-1):
                                     break
+                        if cache_val_batches and (not from_cache):
+                            val_batch_cache = new_val_batch_cache
                         if len(val_losses) > 0:
                             val_loss = torch.mean(torch.tensor(val_losses)).item()
                             # log epoch average validation loss
@@ -269,8 +379,11 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                 # checkpoint
                 if ((self.epoch + 1) % cfg.training.checkpoint_every) == 0:
                     # checkpointing
+                    save_tensor_file = cfg.checkpoint.get('save_tensor_file', False)
+                    last_ckpt_path = None
                     if cfg.checkpoint.save_last_ckpt:
-                        self.save_checkpoint()
+                        last_ckpt_path = self.save_checkpoint(
+                            save_tensor_file=save_tensor_file)
                     if cfg.checkpoint.save_last_snapshot:
                         self.save_snapshot()
 
@@ -280,13 +393,15 @@ class TrainDiffusionTransformerHybridWorkspace(BaseWorkspace):
                         new_key = key.replace('/', '_')
                         metric_dict[new_key] = value
                     
-                    # We can't copy the last checkpoint here
-                    # since save_checkpoint uses threads.
-                    # therefore at this point the file might have been empty!
                     topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
 
                     if topk_ckpt_path is not None:
-                        self.save_checkpoint(path=topk_ckpt_path)
+                        if last_ckpt_path is not None:
+                            # same state, link instead of serializing again
+                            self.link_checkpoint(last_ckpt_path, topk_ckpt_path)
+                        else:
+                            self.save_checkpoint(path=topk_ckpt_path,
+                                save_tensor_file=save_tensor_file)
                 # ========= eval end for this epoch ==========
                 policy.train()
 
@@ -25,7 +25,9 @@ from diffusion_policy.workspace.base_workspace import BaseWorkspace
 @click.option('-p', '--force_perturbs', default=None)
 @click.option('-d', '--device', default='cuda:0')
 @click.option('-n', '--num_samples', default=1)
-def main(checkpoint, output_dir, force_perturbs, device, num_samples):
+@click.option('-s', '--sampler', default=None, type=click.Choice(['ddpm', 'ddim', 'dpmsolver++']))
+@click.option('-k', '--inference_steps', default=None, type=int)
+def main(checkpoint, output_dir, force_perturbs, device, num_samples, sampler, inference_steps):
     if os.path.exists(output_dir):
         click.confirm(f"Output path {output_dir} already exists! Overwrite?", abort=True)
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -50,6 +52,11 @@ def main(checkpoint, output_dir, force_perturbs, device, num_samples):
     device = torch.device(device)
     policy.to(device)
     policy.eval()
+    if (sampler is not None) or (inference_steps is not None):
+        print(f"Sampling with {sampler or 'ddpm'}, {inference_steps} inference steps")
+        policy.set_inference_scheduler(
+            scheduler_type=sampler or 'ddpm', 
+            num_inference_steps=inference_steps)
     if force_perturbs and "chunk" in force_perturbs:
         policy.n_action_steps = perturb_cfg["chunk"]
         with open_dict(cfg):
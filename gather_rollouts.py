@@ -1,6 +1,6 @@
 """
 Usage:
-python gather_rollouts.py --checkpoint [checkpoint] -o [output] -n [number of rollouts] -e [encoder override (optional)]
+python gather_rollouts.py --checkpoint [checkpoint] -o [output] -n [number of rollouts] -e [encoder override (optional)] -s [ddpm|ddim|dpmsolver++ (optional)] -k [inference steps (optional)]
 """
 
 import sys
@@ -27,7 +27,9 @@ from diffusion_policy.workspace.base_workspace import BaseWorkspace
 @click.option('-d', '--device', default='cuda:0')
 @click.option('-n', '--num_samples', default=1)
 @click.option('-e', '--encoder', default=None)
-def main(checkpoint, output_dir, device, num_samples, encoder):
+@click.option('-s', '--sampler', default=None, type=click.Choice(['ddpm', 'ddim', 'dpmsolver++']))
+@click.option('-k', '--inference_steps', default=None, type=int)
+def main(checkpoint, output_dir, device, num_samples, encoder, sampler, inference_steps):
     if os.path.exists(output_dir):
         click.confirm(f"Output path {output_dir} already exists! Overwrite?", abort=True)
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
@@ -53,6 +55,11 @@ def main(checkpoint, output_dir, device, num_samples, encoder):
     device = torch.device(device)
     policy.to(device)
     policy.eval()
+    if (sampler is not None) or (inference_steps is not None):
+        print(f"Sampling with {sampler or 'ddpm'}, {inference_steps} inference steps")
+        policy.set_inference_scheduler(
+            scheduler_type=sampler or 'ddpm', 
+            num_inference_steps=inference_steps)
 
     with open_dict(cfg):
         cfg.task.env_runner.n_test = num_samples # many evals for lower variance
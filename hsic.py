@@ -1,36 +1,81 @@
+import math
 import torch
 
+def pairwise_sq_dists(X):
+    """ (B,N,D) -> (B,N,N) squared euclidean distances """
+    return torch.cdist(X, X, p=2) ** 2
+
+def median_sq_dist(X, max_points=None):
+    """
+    Median heuristic per batch element, (B,N,D) -> (B,).
+    With max_points the median is taken over a random subset of rows.
+    """
+    if (max_points is not None) and (X.shape[1] > max_points):
+        idxs = torch.randperm(X.shape[1], device=X.device)[:max_points]
+        X = X[:, idxs]
+    d2 = pairwise_sq_dists(X)
+    return torch.median(d2.reshape(d2.shape[0], -1), dim=-1).values
+
 def rbf_kernel(X, sigma=None):
-    """ Compute RBF kernel matrix for X """
-    pairwise_sq_dists = torch.cdist(X, X, p=2) ** 2
+    """ Compute RBF kernel matrix for X, (N,D) or (B,N,D) """
+    d2 = pairwise_sq_dists(X)
     if sigma is None:
-        sigma = torch.median(pairwise_sq_dists)  # Median heuristic
-    K = torch.exp(-pairwise_sq_dists / (2 * sigma ** 2))
+        # Median heuristic
+        sigma = torch.median(d2.reshape(*d2.shape[:-2], -1), dim=-1).values
+    if torch.is_tensor(sigma):
+        sigma = sigma[..., None, None]
+    K = torch.exp(-d2 / (2 * sigma ** 2))
     return K
 
 def center_kernel(K):
-    """ Center the kernel matrix K """
-    n = K.shape[0]
-    H = torch.eye(n, device=K.device) - (1.0 / n) * torch.ones((n, n), device=K.device)
-    return H @ K @ H
-
-def hsic(X, Y):
-    """ Compute HSIC between X and Y """
-    Kx = center_kernel(rbf_kernel(X))
-    Ky = center_kernel(rbf_kernel(Y))
-    return torch.trace(Kx @ Ky) / (X.shape[0] - 1) ** 2
-
-def batch_hsic(actions):
-    """ Compute HSIC for each batch """
-    B, N, D = actions.shape  # B=batch, N=sequence length, D=7
-    hsic_values = torch.zeros(B, device=actions.device)
-    
-    for b in range(B):
-        X = actions[b]  # Select the batch element
-        Y = X  # Can also compare with another variable if needed
-        hsic_values[b] = hsic(X, Y)
+    """ Center the kernel matrix K (= H @ K @ H without forming H) """
+    return K - K.mean(dim=-1, keepdim=True) - K.mean(dim=-2, keepdim=True) \
+        + K.mean(dim=(-2,-1), keepdim=True)
+
+def hsic(X, Y=None):
+    """ Compute HSIC between X and Y, (N,D) or (B,N,D) """
+    Kx = rbf_kernel(X)
+    Ky = Kx if Y is None else rbf_kernel(Y)
+    # trace(HKxH HKyH) = sum(HKxH * Ky), K symmetric and H idempotent
+    return torch.sum(center_kernel(Kx) * Ky, dim=(-2,-1)) / (X.shape[-2] - 1) ** 2
 
-    return hsic_values  # Shape: (B,)
+def rff_features(X, sigma, num_features=512, generator=None):
+    """
+    Random Fourier features of the RBF kernel used by rbf_kernel,
+    (B,N,D) -> (B,N,num_features) with phi(x) @ phi(y) ~= k(x,y)
+    """
+    B, N, D = X.shape
+    # k(x,y) = exp(-|x-y|^2 / (2 sigma^2)) -> w ~ N(0, 1/sigma^2)
+    W = torch.randn((B, D, num_features), device=X.device, dtype=X.dtype,
+        generator=generator) / sigma[:, None, None]
+    b = torch.rand((B, 1, num_features), device=X.device, dtype=X.dtype,
+        generator=generator) * (2 * math.pi)
+    return math.sqrt(2. / num_features) * torch.cos(X @ W + b)
+
+def hsic_rff(X, Y=None, num_features=512, max_points=1024):
+    """
+    HSIC with random Fourier features, O(N*num_features) memory
+    instead of O(N^2), for long trajectories. (B,N,D) -> (B,)
+    """
+    Px = rff_features(X, median_sq_dist(X, max_points=max_points), num_features)
+    Py = Px if Y is None else rff_features(
+        Y, median_sq_dist(Y, max_points=max_points), num_features)
+    Px = Px - Px.mean(dim=1, keepdim=True)
+    Py = Py - Py.mean(dim=1, keepdim=True)
+    # trace(H Px Px^T H Py Py^T) = |Px_c^T Py_c|_F^2
+    C = Px.transpose(1,2) @ Py
+    return torch.sum(C ** 2, dim=(-2,-1)) / (X.shape[1] - 1) ** 2
+
+def batch_hsic(actions, num_features=None):
+    """
+    Compute HSIC for each batch, (B,N,D) -> (B,)
+    num_features: use the random Fourier feature approximation
+    """
+    B, N, D = actions.shape  # B=batch, N=sequence length, D=7
+    actions = actions.to(torch.float32)
+    if num_features is not None:
+        return hsic_rff(actions, num_features=num_features)
+    return hsic(actions)  # Shape: (B,)
 
 
 if __name__ == "__main__":
@@ -39,3 +84,4 @@ if __name__ == "__main__":
     actions = torch.randn(B, N, D)  # Random action tensor
     hsic_values = batch_hsic(actions)
     print(hsic_values)  # Tensor of HSIC values for each batch
+    print(batch_hsic(actions, num_features=2048))
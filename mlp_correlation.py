@@ -17,18 +17,16 @@ class MLP(nn.Module):
 
 def batch_mlp_corr(actions, num_epochs=10, batch_size=2048, val_ratio=0.2):
     # actions with shape (num_envs, sequence, action_dim)
-    actions = torch.from_numpy(actions).float().cuda()
-    N, S, dim = actions.shape
-    model = MLP(dim, 512, dim).to(actions.device)
+    # or a list of (sequence_i, action_dim) of different lengths
+    actions = [torch.from_numpy(x).float().cuda() for x in actions]
+    dim = actions[0].shape[-1]
+    model = MLP(dim, 512, dim).to(actions[0].device)
     optimizer = optim.Adam(model.parameters(), lr=1e-3)
     criterion = nn.MSELoss()
 
-    x = actions[:, :-1, :]  # Shape: (N, S-1, dim)
-    y = actions[:, 1:, :]   # Shape: (N, S-1, dim)
-
-    # Reshape to combine batch and sequence dimensions
-    x = x.reshape(-1, dim)  # Shape: ((N*(S-1)), dim)
-    y = y.reshape(-1, dim)  # Shape: ((N*(S-1)), dim)
+    # consecutive action pairs of each sequence, combined
+    x = torch.cat([a[:-1] for a in actions])  # Shape: (sum(S_i-1), dim)
+    y = torch.cat([a[1:] for a in actions])   # Shape: (sum(S_i-1), dim)
 
     # Split x, y into train/val datasets
     dataset = TensorDataset(x, y)
@@ -50,7 +48,7 @@ def batch_mlp_corr(actions, num_epochs=10, batch_size=2048, val_ratio=0.2):
         num_train_batches = 0
 
         for xb, yb in train_loader:
-            xb, yb = xb.to(actions.device), yb.to(actions.device)
+            xb, yb = xb.to(x.device), yb.to(x.device)
             optimizer.zero_grad()
             preds = model(xb)
             loss = criterion(preds, yb)
@@ -70,7 +68,7 @@ def batch_mlp_corr(actions, num_epochs=10, batch_size=2048, val_ratio=0.2):
 
         with torch.no_grad():
             for xb, yb in val_loader:
-                xb, yb = xb.to(actions.device), yb.to(actions.device)
+                xb, yb = xb.to(x.device), yb.to(x.device)
                 preds = model(xb)
                 loss = criterion(preds, yb)
                 total_val_loss += loss.item()
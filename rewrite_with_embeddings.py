@@ -106,12 +106,55 @@ class HDF5Dataset(Dataset):
 
         return obs
 
+def _convert_h5_to_zarr_embeddings(dataset_path, zarr_path, policy, dataset_cfg, 
+        embedding_key='embedding', batch_size=1024):
+    """
+    Convert dataset_path to a ReplayBuffer, add embedding_key computed in
+    batched passes and save it to zarr_path (a .zarr.zip next to the hdf5 
+    is picked up by RobomimicReplayImageDataset(use_cache=True)).
+    """
+    import zarr
+    from diffusion_policy.dataset.robomimic_replay_image_dataset import _convert_robomimic_to_replay
+    from diffusion_policy.model.common.rotation_transformer import RotationTransformer
+    from diffusion_policy.common.embedding_util import compute_replay_embeddings
+
+    shape_meta = OmegaConf.to_container(dataset_cfg.shape_meta, resolve=True)
+    shape_meta['obs'].pop(embedding_key, None)
+    rgb_keys = [k for k, v in shape_meta['obs'].items() if v.get('type', 'low_dim') == 'rgb']
+    lowdim_keys = [k for k, v in shape_meta['obs'].items() if v.get('type', 'low_dim') == 'low_dim']
+
+    rot_rep_orig = dataset_cfg.get('rot_rep_orig', 'axis_angle')
+    rotation_transformer = RotationTransformer(
+        from_rep=rot_rep_orig, 
+        to_rep=dataset_cfg.get('rotation_rep', 'rotation_6d'),
+        from_convention='XYZ' if rot_rep_orig == 'euler_angles' else None)
+    replay_buffer = _convert_robomimic_to_replay(
+        store=zarr.MemoryStore(), 
+        shape_meta=shape_meta, 
+        dataset_path=dataset_path, 
+        abs_action=dataset_cfg.get('abs_action', False), 
+        rotation_transformer=rotation_transformer)
+
+    compute_replay_embeddings(replay_buffer, policy, 
+        rgb_keys=rgb_keys, lowdim_keys=lowdim_keys, 
+        embedding_key=embedding_key, batch_size=batch_size)
+
+    print(f"Saving ReplayBuffer to {zarr_path}")
+    if zarr_path.endswith('.zip'):
+        with zarr.ZipStore(zarr_path, mode='w') as zip_store:
+            replay_buffer.save_to_store(store=zip_store)
+    else:
+        replay_buffer.save_to_path(zarr_path)
+
+
 @click.command()
 @click.option('-c', '--checkpoint', required=True)
 @click.option('-o', '--output_dir', required=True)
 @click.option('-f', '--convert_file', required=True)
 @click.option('-d', '--device', default='cuda:0')
-def main(checkpoint, output_dir, convert_file, device):
+@click.option('-z', '--zarr_output', default=None, help='write a zarr ReplayBuffer with embeddings (e.g. <convert_file>.zarr.zip) instead of rewriting the hdf5')
+@click.option('-b', '--batch_size', default=1024, type=int)
+def main(checkpoint, output_dir, convert_file, device, zarr_output, batch_size):
 
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
@@ -127,6 +170,16 @@ def main(checkpoint, output_dir, convert_file, device):
     # get policy from workspace
     policy = workspace.model
 
+    if zarr_output is not None:
+        # normalizer is restored from the checkpoint
+        policy.to(torch.device(device))
+        policy.eval()
+        print(f"Using encoder from {checkpoint} to convert dataset {convert_file}")
+        _convert_h5_to_zarr_embeddings(convert_file, zarr_output, policy, 
+            cfg.task.dataset, batch_size=batch_size)
+        print("Done converting!")
+        return
+
     # configure dataset
     dataset: BaseImageDataset
     dataset = hydra.utils.instantiate(cfg.task.dataset)